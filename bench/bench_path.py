@@ -0,0 +1,84 @@
+"""
+Time how long it takes to build some pathological gardens.
+
+    python bench/bench_path.py
+"""
+import random
+import time
+
+from garden.path import Garden
+
+
+
+def deepChain(size):
+    """
+    A single chain of C{size} paths, added from the top down.
+    """
+    g = Garden()
+    for i in xrange(size, 0, -1):
+        g.addPath(str(i), 'v1', [
+            (str(i - 1), 'v1'),
+        ])
+    return g
+
+
+def shuffledChain(size):
+    """
+    A single chain of C{size} paths, added in random order.
+    """
+    links = range(1, size + 1)
+    random.Random(size).shuffle(links)
+    g = Garden()
+    for i in links:
+        g.addPath(str(i), 'v1', [
+            (str(i - 1), 'v1'),
+        ])
+    return g
+
+
+def wideDiamonds(size, width=10):
+    """
+    C{size} diamonds stacked on top of each other, each C{width} paths wide.
+    """
+    g = Garden()
+    for i in xrange(size):
+        middle = []
+        for j in xrange(width):
+            g.addPath('middle%d' % (j,), str(i), [
+                ('top', str(i)),
+            ])
+            middle.append(('middle%d' % (j,), str(i)))
+        g.addPath('top', str(i + 1), middle)
+    return g
+
+
+def bulkDiamonds(size, width=10):
+    """
+    The same gardens as L{wideDiamonds}, but added with L{Garden.addPaths}.
+    """
+    paths = []
+    for i in xrange(size):
+        middle = []
+        for j in xrange(width):
+            paths.append(('middle%d' % (j,), str(i), [('top', str(i))]))
+            middle.append(('middle%d' % (j,), str(i)))
+        paths.append(('top', str(i + 1), middle))
+    g = Garden()
+    g.addPaths(paths)
+    return g
+
+
+def timeit(name, func, *args):
+    start = time.time()
+    func(*args)
+    print '%-30s %8.3fs' % (name, time.time() - start)
+
+
+
+if __name__ == '__main__':
+    timeit('deepChain(4000)', deepChain, 4000)
+    timeit('shuffledChain(4000)', shuffledChain, 4000)
+    timeit('wideDiamonds(400)', wideDiamonds, 400)
+    timeit('wideDiamonds(40, width=100)', wideDiamonds, 40, 100)
+    timeit('bulkDiamonds(400)', bulkDiamonds, 400)
+    timeit('bulkDiamonds(40, width=100)', bulkDiamonds, 40, 100)
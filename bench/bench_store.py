@@ -0,0 +1,123 @@
+"""
+Time how long it takes to put data in and get it out of the stores.
+
+    python bench/bench_store.py
+"""
+import shutil
+import tempfile
+import time
+
+from twisted.internet import defer, task
+
+from garden.store import (SqliteStore, InMemoryStore, CachingStore, LogStore,
+                          ShardedStore)
+from garden.data import Data
+
+
+
+class FlatInMemoryStore(InMemoryStore):
+    """
+    The way L{InMemoryStore} used to look things up: by checking every key.
+    """
+
+
+    def __init__(self):
+        self._flat = {}
+
+
+    def get(self, entity, name=None, version=None, lineage=None):
+        ret = []
+        for key, value in self._flat.iteritems():
+            if key[0] != entity:
+                continue
+            if name is not None and key[1] != name:
+                continue
+            if version is not None and key[2] != version:
+                continue
+            if lineage is not None and key[3] != lineage:
+                continue
+            ret.append(Data(*key + (value,)))
+        return defer.succeed(ret)
+
+
+    def _put(self, data):
+        key = tuple(data[:4])
+        changed = self._flat.get(key) != data.value
+        self._flat[key] = data.value
+        return {'changed': changed}
+
+
+
+def makeData(entities, names=10):
+    ret = []
+    for e in xrange(entities):
+        for n in xrange(names):
+            ret.append(Data('entity%d' % (e,), 'name%d' % (n,), '1', 'ffff',
+                            'value %d %d' % (e, n)))
+    return ret
+
+
+@defer.inlineCallbacks
+def puts(store, data):
+    for d in data:
+        yield store.put(d)
+
+
+@defer.inlineCallbacks
+def putMany(store, data, size=500):
+    for i in xrange(0, len(data), size):
+        yield store.putMany(data[i:i + size])
+
+
+@defer.inlineCallbacks
+def gets(store, data):
+    for d in data:
+        yield store.get(d.entity, d.name, d.version)
+
+
+@defer.inlineCallbacks
+def timeit(name, func, *args):
+    start = time.time()
+    yield func(*args)
+    print '%-50s %8.3fs' % (name, time.time() - start)
+
+
+def cleanup(store):
+    store = getattr(store, 'store', store)
+    for shard in getattr(store, 'stores', []):
+        cleanup(shard)
+    if hasattr(store, 'pool'):
+        store.pool.close()
+    if isinstance(store, LogStore):
+        store.close()
+        shutil.rmtree(store.path)
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    data = makeData(500)
+    for label, factory in [
+            ('SqliteStore', lambda: SqliteStore(':memory:')),
+            ('ShardedStore(4 x SqliteStore)', lambda: ShardedStore([
+                SqliteStore(':memory:') for i in xrange(4)])),
+            ('CachingStore(SqliteStore)', lambda: CachingStore(
+                SqliteStore(':memory:'), max_entries=len(data))),
+            ('LogStore', lambda: LogStore(tempfile.mkdtemp())),
+            ('InMemoryStore', InMemoryStore),
+            ('InMemoryStore (flat scan)', FlatInMemoryStore),
+        ]:
+        store = factory()
+        yield timeit('%s put x%d' % (label, len(data)), puts, store, data)
+        cleanup(store)
+        store = factory()
+        yield timeit('%s putMany x%d' % (label, len(data)), putMany, store,
+                     data)
+        yield timeit('%s get x%d' % (label, len(data)), gets, store, data)
+        yield timeit('%s get again x%d' % (label, len(data)), gets, store,
+                     data)
+        cleanup(store)
+
+
+
+if __name__ == '__main__':
+    task.react(main, [])
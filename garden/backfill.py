@@ -0,0 +1,161 @@
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+
+
+
+class Backfill(object):
+    """
+    I compute a destination for every entity in a store that already has the
+    data it needs -- for instance, right after a new path version has been
+    added to the garden.
+
+    Entities are done in sorted order, a batch at a time, and after each batch
+    the last entity done is written to the C{checkpoint} file.  If I'm stopped
+    or interrupted, a new L{Backfill} with the same C{checkpoint} picks up
+    where I left off.
+    
+    While I'm paused (see L{pauseProducing}), I don't start another batch.
+    """
+
+    done = 0
+    total = 0
+    failures = 0
+
+
+    def __init__(self, gardener, store, name, version, concurrency=10,
+                 delay=0, checkpoint=None, progress=None, reactor=reactor):
+        """
+        @param gardener: Something with a C{garden} and a C{doPossibleWork}
+            method, like a L{Gardener} or L{WorkMaker}.
+        @param store: The L{IDataStore} to find entities in.
+
+        @param name: Destination name
+        @param version: Destination version
+
+        @param concurrency: Number of entities to work on at once.  This is
+            also the size of a batch.
+        @param delay: Seconds to wait between batches.
+
+        @type checkpoint: L{FilePath}
+        @param checkpoint: Where to record progress.
+
+        @param progress: If given, called with C{(done, total)} after each
+            batch.
+        """
+        self.gardener = gardener
+        self.store = store
+        self.name = name
+        self.version = version
+        self.concurrency = concurrency
+        self.delay = delay
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.reactor = reactor
+        self._stopped = False
+        self._paused = None
+
+
+    def entitiesNeeded(self):
+        """
+        Find the entities that have all the inputs for at least one of the
+        paths to my destination.
+
+        @return: A C{Deferred} list of entity names, sorted.
+        """
+        garden = self.gardener.garden
+        dlist = []
+        for input_list in garden.inputsFor(self.name, self.version):
+            entities = defer.gatherResults([self.store.entities(n, v)
+                                            for n, v in input_list])
+            dlist.append(entities)
+
+        def gotEntities(results):
+            ret = set()
+            for per_input in results:
+                common = set(per_input[0])
+                for entities in per_input[1:]:
+                    common.intersection_update(entities)
+                ret.update(common)
+            return sorted(ret)
+        return defer.gatherResults(dlist).addCallback(gotEntities)
+
+
+    def _lastDone(self):
+        """
+        Get the last entity recorded in my checkpoint, or C{None}.
+        """
+        if self.checkpoint is None or not self.checkpoint.exists():
+            return None
+        return self.checkpoint.getContent()
+
+
+    def run(self):
+        """
+        Do the work for all the entities that need it.
+
+        @return: A C{Deferred} that fires with the number of entities done
+            once they're all done (or I'm stopped).
+        """
+        self._stopped = False
+        d = self.entitiesNeeded()
+        d.addCallback(self._gotEntities)
+        return d
+
+
+    @defer.inlineCallbacks
+    def _gotEntities(self, entities):
+        last = self._lastDone()
+        if last is not None:
+            entities = [x for x in entities if x > last]
+        self.total = self.done + len(entities)
+
+        for i in xrange(0, len(entities), self.concurrency):
+            if self._stopped:
+                break
+            if i and self.delay:
+                yield task.deferLater(self.reactor, self.delay, lambda:None)
+            if self._paused is not None:
+                yield self._paused
+                if self._stopped:
+                    break
+            batch = entities[i:i + self.concurrency]
+            results = yield defer.DeferredList([
+                defer.maybeDeferred(self.gardener.doPossibleWork, entity,
+                                    self.name, self.version)
+                for entity in batch], consumeErrors=True)
+            for entity, (success, result) in zip(batch, results):
+                if not success:
+                    self.failures += 1
+                    log.err(result, "Error backfilling %r for %r" % (
+                            (self.name, self.version), entity))
+            self.done += len(batch)
+            if self.checkpoint is not None:
+                self.checkpoint.setContent(batch[-1])
+            if self.progress is not None:
+                self.progress(self.done, self.total)
+        defer.returnValue(self.done)
+
+
+    def stop(self):
+        """
+        Stop after the batch currently in progress.
+        """
+        self._stopped = True
+        self.resumeProducing()
+
+
+    def pauseProducing(self):
+        """
+        Wait before starting another batch until L{resumeProducing} is called.
+        """
+        if self._paused is None:
+            self._paused = defer.Deferred()
+
+
+    def resumeProducing(self):
+        """
+        Go back to starting batches.
+        """
+        paused, self._paused = self._paused, None
+        if paused is not None:
+            paused.callback(None)
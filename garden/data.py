@@ -53,6 +53,14 @@ def linealHash(name, version, input_hashes=None):
 
 
 
+def valueHash(value):
+    """
+    Compute the hash of a value, as used for L{IWorkInput.hash}.
+    """
+    return sha1(value).hexdigest()
+
+
+
 class Input(namedtuple('Input', ['entity', 'name', 'version', 'value'])):
     """
     I am a single piece of input data.
@@ -91,7 +99,7 @@ class WorkInput(namedtuple('WorkInput', ['name', 'version', 'lineage', 'value',
     
     def __new__(cls, name, version, lineage, value, hash=None):
         if not hash:
-            hash = sha1(value).hexdigest()
+            hash = valueHash(value)
         return cls.__bases__[0].__new__(cls, name, version, lineage, value, hash)
 
 
@@ -1,14 +1,17 @@
 from twisted.internet import defer
+from twisted.python import failure
 
 from zope.interface import implements
 
-from hashlib import sha1
 from itertools import product
 
 from garden.interface import (IGardener, IWorkInput, IWork, IInput, IData,
                               ISource, ISourceable, IResult, IResultError,
                               IReceiver)
-from garden.data import linealHash, Work
+from garden.data import linealHash, Work, valueHash
+from garden.path import diffGardens
+from garden.util import LRUCache
+from garden.scheduling import WorkCoalescer, InFlight
 
 
 def aggregateResult(deferred_list):
@@ -26,6 +29,10 @@ class InvalidResultFilter(object):
     """
     I discard results that were computed using inputs that are no longer valid
     or through a path that doesn't exist in the garden.
+    
+    If I'm given C{hashes}, a mapping of C{(entity, name, version, lineage)}
+    to the hash of the current value (kept up to date by a L{DataStorer}), I
+    check it before asking the C{store}.
     """
     
     implements(ISourceable, IReceiver)
@@ -35,9 +42,10 @@ class InvalidResultFilter(object):
     garden = None
     
     
-    def __init__(self, garden, store):
+    def __init__(self, garden, store, hashes=None):
         self.store = store
         self.garden = garden
+        self.hashes = hashes
 
 
     def receiverMapping(self):
@@ -52,38 +60,49 @@ class InvalidResultFilter(object):
         XXX
         """
         # check the garden
-        valid_inputs = self.garden.inputsFor(result.name, result.version)
         actual_inputs = [(x.name, x.version) for x in result.inputs]
-        if actual_inputs not in valid_inputs:
+        if not self.garden.hasPath(result.name, result.version, actual_inputs):
             return defer.succeed('invalid path')
         
-        dlist = []
-        
-        for i in result.inputs:
-            current_val = self.store.get(result.entity, i.name, i.version,
-                                         i.lineage)
-            current_val.addCallback(self._valueMatches, i.hash)
-            dlist.append(current_val)
-        
-        d = aggregateResult(dlist)
-        d.addCallback(self._inputsMatch)
+        keys = [(x.name, x.version, x.lineage) for x in result.inputs]
+        d = self._currentHashes(result.entity, keys)
+        d.addCallback(self._inputsMatch, [x.hash for x in result.inputs])
         d.addCallback(self._conditionallySend, result)
         return d
 
 
-    def _valueMatches(self, current_val, ihash):
+    def _currentHashes(self, entity, keys):
         """
-        XXX
+        Get the hashes of the current values for C{keys}, from my C{hashes}
+        if they're there or else from my C{store}.
         """
-        return sha1(current_val[0].value).hexdigest() == ihash
+        if self.hashes is None:
+            return self.store.getHashes(entity, keys)
+        
+        current = [self.hashes.get((entity,) + x) for x in keys]
+        missing = [x for x, h in zip(keys, current) if h is None]
+        if not missing:
+            return defer.succeed(current)
+        
+        def gotHashes(fetched):
+            fetched = dict(zip(missing, fetched))
+            for key, h in fetched.iteritems():
+                # don't overwrite anything stored while we were fetching
+                if h is not None and (entity,) + key not in self.hashes:
+                    self.hashes[(entity,) + key] = h
+            return [h or fetched[key] for key, h in zip(keys, current)]
+        return self.store.getHashes(entity, missing).addCallback(gotHashes)
 
 
-    def _inputsMatch(self, values):
+    def _inputsMatch(self, current_hashes, hashes):
         """
-        XXX
+        Check that the current value of each input has the expected hash.
+        
+        @param current_hashes: List of the hashes of the inputs' current
+            values (as from L{IDataStore.getHashes}).
+        @param hashes: List of expected hashes, one per input.
         """
-        matches = [x[1] for x in values]
-        return False not in matches
+        return list(current_hashes) == list(hashes)
 
 
     def _conditionallySend(self, do_send, result):
@@ -99,14 +118,18 @@ class DataStorer(object):
     """
     I store data to a L{IDataStore} before passing it on.  And I only pass it
     on if it has changed.
+    
+    If I'm given C{hashes}, I record the hash of every value I store in it,
+    keyed by C{(entity, name, version, lineage)}.
     """
 
     implements(ISourceable, IReceiver)
     sourceInterfaces = (IData,)
 
 
-    def __init__(self, store):
+    def __init__(self, store, hashes=None):
         self.store = store
+        self.hashes = hashes
 
 
     def receiverMapping(self):
@@ -125,24 +148,62 @@ class DataStorer(object):
 
 
     def _stored(self, result, data):
+        if self.hashes is not None:
+            key = (data.entity, data.name, data.version, data.lineage)
+            self.hashes[key] = valueHash(data.value)
         if not result['changed']:
             return
         return ISource(self).emit(data)
 
 
 
+def currentLineagesOnly(garden, name, version, combination):
+    """
+    A combination policy for L{WorkMaker} that only allows combinations of
+    inputs with lineages that the C{garden} leads to (see
+    L{Garden.lineagesFor}).  Inputs with too many lineages to list are
+    allowed whatever their lineage.
+    """
+    for data in combination:
+        lineages = garden.lineagesFor(data.name, data.version)
+        if lineages is not None and data.lineage not in lineages:
+            return False
+    return True
+
+
+
 class WorkMaker(object):
     """
     I spawn work based on data received and paths in the Garden.
+    
+    Work is made for each combination of the lineages of a path's inputs, one
+    combination at a time.  If C{max_in_flight} is given, no more than that
+    much work is emitted and not yet done at once, across all destinations;
+    the next combination isn't made until there's room for it.  Work is done
+    when its result is passed to L{workDone} (as the L{Gardener} does) or
+    emitting it fails.
+    
+    If C{policy} is given, it's called with C{(garden, name, version,
+    combination)} for each combination of inputs (a tuple of L{IData}) and
+    only those it returns C{True} for are made into work.  L{suppressed}
+    counts the others.
     """
     
     implements(ISourceable, IReceiver)
     sourceInterfaces = (IWork,)
+    
+    suppressed = 0
 
 
-    def __init__(self, garden, store):
+    def __init__(self, garden, store, max_in_flight=None, policy=None):
         self.garden = garden
         self.store = store
+        self.policy = policy
+        self._in_flight = None
+        self._tracker = None
+        if max_in_flight:
+            self._in_flight = defer.DeferredSemaphore(max_in_flight)
+            self._tracker = InFlight(self._in_flight.release)
 
 
     def receiverMapping(self):
@@ -178,27 +239,93 @@ class WorkMaker(object):
             dispatching the work.
         """
         input_lists = self.garden.inputsFor(name, version)
+        if not input_lists:
+            return aggregateResult([])
+        
+        # fetch every input of every path at once
+        keys = []
+        seen = set()
+        for input_list in input_lists:
+            for key in input_list:
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(tuple(key))
+        d = self.store.getMany(entity, keys)
+        d.addCallback(self._gotValues, keys, input_lists, entity, name,
+                      version)
+        return d
+
+
+    def _gotValues(self, values, keys, input_lists, entity, name, version):
+        values = dict(zip(keys, values))
         dlist = []
         for input_list in input_lists:
-            values = [self.store.get(entity, x[0], x[1]) for x in input_list]
-            value_list = aggregateResult(values)
-            value_list.addCallback(self._gotValueList, entity, name, version)
+            value_list = self._gotValueList([values[tuple(x)] for x in input_list],
+                                            entity, name, version)
             value_list.addCallback(lambda r:[x[1] for x in r])
             dlist.append(value_list)
         return aggregateResult(dlist)
 
 
     def _gotValueList(self, values, entity, name, version):
-        values = [x[1] for x in values]
+        combinations = self._combinations(values, name, version)
+        if self._in_flight is not None:
+            return self._emitBounded(combinations, entity, name, version)
         dlist = []
+        for combination in combinations:
+            dlist.append(self._emitWork(combination, entity, name, version))
+        return aggregateResult(dlist)
+
+
+    def _combinations(self, values, name, version):
+        """
+        Generate the combinations of C{values} allowed by my C{policy}.
+        """
+        policy = self.policy
         for combination in product(*values):
-            lineages = [x.lineage for x in combination]
-            work = Work(entity, name, version,
-                        linealHash(name, version, lineages),
-                        [IWorkInput(x) for x in combination])
-            d = ISource(self).emit(work)
+            if policy is not None and \
+                    not policy(self.garden, name, version, combination):
+                self.suppressed += 1
+                continue
+            yield combination
+
+
+    def _makeWork(self, combination, entity, name, version):
+        lineages = [x.lineage for x in combination]
+        return Work(entity, name, version,
+                    linealHash(name, version, lineages),
+                    [IWorkInput(x) for x in combination])
+
+
+    def _emitWork(self, combination, entity, name, version):
+        work = self._makeWork(combination, entity, name, version)
+        return ISource(self).emit(work)
+
+
+    @defer.inlineCallbacks
+    def _emitBounded(self, combinations, entity, name, version):
+        """
+        Emit work for C{combinations} while there's room in flight for it.
+        """
+        dlist = []
+        for combination in combinations:
+            yield self._in_flight.acquire()
+            work = self._makeWork(combination, entity, name, version)
+            passedOn = self._tracker.hold(work)
+            d = defer.maybeDeferred(ISource(self).emit, work)
+            d.addBoth(passedOn)
             dlist.append(d)
-        return aggregateResult(dlist)
+        result = yield aggregateResult(dlist)
+        defer.returnValue(result)
+
+
+    def workDone(self, result):
+        """
+        Make room for more work now that C{result} (an L{IResult} or
+        L{IResultError}) has come back for some.
+        """
+        if self._tracker is not None:
+            self._tracker.workDone(result)
 
 
 
@@ -229,32 +356,92 @@ class ToDataConverter(object):
 
 
 
+class _WorkSender(object):
+    """
+    I send work from a L{Gardener}'s work queue out to its subscribers.
+    """
+    
+    implements(IReceiver)
+    
+    
+    def __init__(self, gardener):
+        self.gardener = gardener
+
+
+    def receiverMapping(self):
+        return {
+            IWork: self.gardener.emit,
+        }
+
+
+
 class Gardener(object):
     """
     I coordinate work based on new data.
     
     I am currently not test driven, except for the functional test that is the
     README :(
+    
+    If C{hash_cache_size} is given, the hashes of that many of the most
+    recently used values are kept in memory for checking results against.
+    This is only safe if nothing else is writing to the C{store}, except a
+    L{LineageCollector} given me as its gardener, which forgets the hashes of
+    what it deletes.
+    
+    C{max_work_in_flight} and C{combination_policy} are passed on to the
+    L{WorkMaker} as C{max_in_flight} and C{policy}.
+    
+    Work that's already been sent out and hasn't had a result come back yet
+    isn't sent out again.  Instead, the duplicate waits for the result of the
+    first (or, if sending the first finishes without one, for that).
+    L{duplicates} counts these.
+    
+    If C{coalesce_delay} is given, work is held for that many seconds by a
+    L{WorkCoalescer} and only the latest work for a destination is sent out.
+    
+    If C{work_queue} is given (like a L{WorkQueue}), work is sent out through
+    it instead of straight to my subscribers, and results are passed to its
+    C{workDone}.
     """
     
     implements(IGardener)
     sourceInterfaces = (IData, IWork)
     
+    duplicates = 0
+    
     
-    def __init__(self, garden, store):
+    def __init__(self, garden, store, hash_cache_size=None,
+                 max_work_in_flight=None, combination_policy=None,
+                 coalesce_delay=None, work_queue=None):
         self.garden = garden
         self.store = store
+        self.hashes = None
+        self._pending = {}
+        if hash_cache_size:
+            self.hashes = LRUCache(hash_cache_size)
         
         # the chain
-        self.result_filter = InvalidResultFilter(garden, store)
+        self.result_filter = InvalidResultFilter(garden, store, self.hashes)
         self.to_data = ToDataConverter()        
-        self.storer = DataStorer(store)
-        self.work_maker = WorkMaker(garden, store)
+        self.storer = DataStorer(store, self.hashes)
+        self.work_maker = WorkMaker(garden, store, max_work_in_flight,
+                                    combination_policy)
         
         ISource(self.result_filter).subscribe(self.to_data)
         ISource(self.to_data).subscribe(self.storer)
         ISource(self.storer).subscribe(self.work_maker)
-        ISource(self.work_maker).subscribe(self)
+        self.coalescer = None
+        if coalesce_delay:
+            self.coalescer = WorkCoalescer(coalesce_delay)
+            ISource(self.work_maker).subscribe(self.coalescer)
+            ISource(self.coalescer).subscribe(self)
+        else:
+            ISource(self.work_maker).subscribe(self)
+        
+        self.work_queue = work_queue
+        if work_queue is not None:
+            work_queue.garden = garden
+            ISource(work_queue).subscribe(_WorkSender(self))
 
 
     def receiverMapping(self):
@@ -279,7 +466,15 @@ class Gardener(object):
 
 
     def resultReceived(self, result):
-        return self.result_filter.resultReceived(result)
+        waiters = self._pending.pop(self._workKey(result), None)
+        # make room for more work before the result makes more of it
+        self.work_maker.workDone(result)
+        if self.work_queue is not None:
+            self.work_queue.workDone(result)
+        d = self.result_filter.resultReceived(result)
+        if waiters:
+            d.addBoth(self._notifyWaiters, waiters)
+        return d
 
 
     def dataReceived(self, data):
@@ -287,9 +482,90 @@ class Gardener(object):
 
 
     def workReceived(self, work):
-        return self.emit(work)
+        key = self._workKey(work)
+        if key in self._pending:
+            self.duplicates += 1
+            d = defer.Deferred()
+            self._pending[key].append(d)
+            return d
+        waiters = self._pending[key] = []
+        if self.work_queue is not None:
+            d = defer.maybeDeferred(self.work_queue.workReceived, work)
+        else:
+            d = defer.maybeDeferred(self.emit, work)
+        d.addCallbacks(self._sent, self._sendFailed,
+                       callbackArgs=(key, waiters),
+                       errbackArgs=(key, waiters))
+        return d
+
+
+    def _workKey(self, work):
+        """
+        Get what identifies a piece of work (or the result of it): the
+        destination, its lineage and the hashes of the input values.
+        """
+        return (work.entity, work.name, work.version, work.lineage,
+                tuple([x.hash for x in work.inputs]))
+
+
+    def _notifyWaiters(self, result, waiters):
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        return result
+
+
+    def _sent(self, result, key, waiters):
+        """
+        Forget work that's been sent out if no result came back for it by the
+        time sending it finished, so it isn't held up forever if none does.
+        """
+        if self._pending.get(key) is waiters:
+            del self._pending[key]
+            self._notifyWaiters(result, waiters)
+        return result
+
+
+    def _sendFailed(self, err, key, waiters):
+        """
+        Forget work that couldn't be sent out, so it can be sent again.
+        """
+        if self._pending.get(key) is waiters:
+            del self._pending[key]
+            self._notifyWaiters(err, waiters)
+        return err
 
 
     def doPossibleWork(self, entity, name, version):
         return self.work_maker.doPossibleWork(entity, name, version)
 
+
+    def registerProducer(self, producer):
+        """
+        Have C{producer} (something with C{pauseProducing} and
+        C{resumeProducing} methods, like a L{WebInputSource}) paused while my
+        work queue is full.  Without a work queue, it's never paused.
+        """
+        if self.work_queue is not None:
+            self.work_queue.registerProducer(producer)
+
+
+    def setGarden(self, garden):
+        """
+        Start using a different garden, without interrupting work in progress.
+        Results for paths that aren't in the new garden will be discarded.
+        
+        @param garden: A L{Garden} or L{FrozenGarden}.
+        
+        @return: The C{(added, removed)} paths, as from L{diffGardens}.
+        """
+        diff = diffGardens(self.garden, garden)
+        self.garden = garden
+        self.result_filter.garden = garden
+        self.work_maker.garden = garden
+        if self.work_queue is not None:
+            self.work_queue.garden = garden
+        return diff
+
@@ -7,13 +7,38 @@ import json
 
 from garden.data import Input
 from garden.interface import IReceiver, ISourceable, IInput, ISource, IData
+from garden.store import eachPage
 
 
 
 class WebInputSource(Resource):
+    """
+    I emit input POSTed to me.
+    
+    While I'm paused (see L{pauseProducing}), input is turned away with a
+    503 response and a C{Retry-After} header of L{retry_after} seconds, so
+    nothing piles up in memory and senders know to try again later.
+    """
     
     implements(ISourceable)
     sourceInterfaces = IInput,
+    
+    paused = False
+    retry_after = 1
+
+
+    def pauseProducing(self):
+        """
+        Turn away input instead of emitting it.
+        """
+        self.paused = True
+
+
+    def resumeProducing(self):
+        """
+        Go back to emitting input as it comes in.
+        """
+        self.paused = False
 
     
     def render_GET(self, request):
@@ -36,7 +61,13 @@ class WebInputSource(Resource):
         version = request.args['version'][0]
         value = request.args['value'][0]
         
-        res = ISource(self).emit(Input(entity, name, version, value))
+        if self.paused:
+            request.setResponseCode(503)
+            request.setHeader('Retry-After', str(self.retry_after))
+            return 'busy'
+        
+        data = Input(entity, name, version, value)
+        res = ISource(self).emit(data)
         def received(result):
             request.write('success')
             request.finish()
@@ -146,3 +177,81 @@ class WebDataFeed(Resource):
                 continue
             s.write(sseMsg('data', json.dumps([entity, name, version, lineage, value])))
         return defer.succeed('received')
+
+
+
+class WebDataQuery(Resource):
+    """
+    I let you get an entity's data from a store over HTTP, without the whole
+    lot of it being in memory at once.
+    
+    C{GET ?entity=E} (with optional C{name}, C{version} and C{limit}) gets a
+    JSON object with a page of C{data} and the cursor of the C{next} page,
+    which you pass back as C{after} to get it.  With C{stream=1}, all the
+    data is sent instead, one JSON list per line, as it's read a page at a
+    time.
+    """
+    
+    max_limit = 1000
+
+
+    def __init__(self, store):
+        Resource.__init__(self)
+        self.store = store
+
+
+    def render_GET(self, request):
+        args = dict([(k, v[0]) for k, v in request.args.items()])
+        entity = args.get('entity')
+        if not entity:
+            request.setResponseCode(400)
+            return 'entity is required'
+        try:
+            limit = min(int(args.get('limit', 100)), self.max_limit)
+        except ValueError:
+            request.setResponseCode(400)
+            return 'limit must be a number'
+        
+        if args.get('stream'):
+            d = self.renderStream(request, entity, args.get('name'),
+                                  args.get('version'), limit)
+        else:
+            d = self.store.getPage(entity, args.get('name'),
+                                   args.get('version'), args.get('after'),
+                                   limit)
+            d.addCallback(self.renderPage, request)
+        
+        def error(err):
+            if request.startedWriting:
+                # too late to say so; just cut the response short
+                request.finish()
+                return
+            request.setResponseCode(500)
+            request.write('error')
+            request.finish()
+        d.addErrback(error)
+        return NOT_DONE_YET
+
+
+    def renderPage(self, result, request):
+        page, after = result
+        request.setHeader('Content-type', 'application/json')
+        request.write(json.dumps({
+            'data': [list(x) for x in page],
+            'next': after,
+        }))
+        request.finish()
+
+
+    def renderStream(self, request, entity, name, version, limit):
+        request.setHeader('Content-type', 'application/x-ndjson')
+        gone = []
+        request.notifyFinish().addErrback(gone.append)
+        
+        def gotPage(page):
+            if gone:
+                return False
+            request.write(''.join([json.dumps(list(x)) + '\n' for x in page]))
+        d = eachPage(self.store, entity, gotPage, name, version, limit)
+        d.addCallback(lambda ignored: gone or request.finish())
+        return d
@@ -155,6 +155,34 @@ class IDataStore(Interface):
         """
 
 
+    def putMany(data_list):
+        """
+        Save several pieces of data in the store at once.
+        
+        @param data_list: A list of IData.
+        
+        @rtype: C{Deferred}
+        @return: On successful storage, will callback with a list of
+            dictionaries, one for each item in C{data_list}, like those
+            L{put} returns.
+        """
+
+
+    def delete(entity, keys):
+        """
+        Remove several data points of one entity from the store at once.
+        
+        @type entity: str
+        @param entity: Entity name
+        
+        @param keys: A list of tuples C{(name, version, lineage)}.  Ones that
+            aren't in the store are ignored.
+        
+        @rtype: C{Deferred}
+        @return: Will callback with the number of data points removed.
+        """
+
+
     def get(entity, name=None, version=None, lineage=None):
         """
         Get data from the store
@@ -182,6 +210,93 @@ class IDataStore(Interface):
         """
 
 
+    def getPage(entity, name=None, version=None, after=None, limit=100):
+        """
+        Get some of an entity's data from the store, for going through a lot
+        of it without having it all at once.
+        
+        @type entity: str
+        @param entity: Entity name
+        
+        @type name: str
+        @param name: If given, only data of this name.
+        
+        @type version: str
+        @param version: If given, only data of this version.
+        
+        @param after: The cursor returned with the previous page, or C{None}
+            for the first page.
+        
+        @param limit: Most data points to return.
+        
+        @rtype: C{Deferred}
+        @return: Will callback with a tuple C{(data, cursor)}: a list of up to
+            C{limit} tuples like L{get} returns, in an order that's the same
+            from page to page, and an opaque string to pass as C{after} to
+            get the next page, or C{None} if this is the last page.
+        """
+
+
+    def getMany(entity, keys):
+        """
+        Get several sets of data for one entity from the store at once.
+        
+        @type entity: str
+        @param entity: Entity name
+        
+        @param keys: A list of tuples C{(name, version)} or C{(name, version,
+            lineage)}.
+        
+        @rtype: C{Deferred}
+        @return: On a successful fetch, this will callback with a list with
+            one item for each of C{keys}: the list of tuples that L{get} would
+            return for that key.
+        """
+
+
+    def getManyEntities(keys):
+        """
+        Like L{getMany}, but for any number of entities.
+        
+        @param keys: A list of tuples C{(entity, name, version)} or C{(entity,
+            name, version, lineage)}.
+        """
+
+
+    def getHashes(entity, keys):
+        """
+        Get the hashes of the values of several data points of an entity,
+        without fetching the values.
+        
+        @type entity: str
+        @param entity: Entity name
+        
+        @param keys: A list of tuples C{(name, version, lineage)}.
+        
+        @rtype: C{Deferred}
+        @return: On a successful fetch, this will callback with a list with
+            one item for each of C{keys}: the hash of that data point's value
+            (as computed by L{garden.data.valueHash}) or C{None} if there's
+            no such data point.
+        """
+
+
+    def entities(name=None, version=None):
+        """
+        Get the entities that have data in the store.
+        
+        @type name: str
+        @param name: If given, only entities with data of this name.
+        
+        @type version: str
+        @param version: If given, only entities with data of this version.
+        
+        @rtype: C{Deferred}
+        @return: On a successful fetch, this will callback with a sorted list
+            of entity names.
+        """
+
+
 
 class IWorker(ISourceable, IReceiver):
     pass
@@ -1,7 +1,12 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+from array import array
+from itertools import product
+import struct
+import sys
 
 
 from garden.error import Error
+from garden.data import linealHash
 
 
 
@@ -10,6 +15,11 @@ class CycleError(Error):
 
 
 
+# The most lineages L{Garden.lineagesFor} will list for one (name, version).
+MAX_LINEAGES = 1000
+
+
+
 class Garden(object):
     """
     I am a garden of forking paths.
@@ -19,6 +29,17 @@ class Garden(object):
     def __init__(self):
         self._destinations = defaultdict(lambda:[])
         self._inputs = defaultdict(lambda:[])
+        # topological ordinal of every (name, version) in the garden.  Inputs
+        # always have a lower ordinal than the destinations requiring them.
+        self._order = {}
+        self._first_ordinal = 0
+        self._last_ordinal = -1
+        # (direction, (name, version)) -> everything reachable that way
+        self._reachable = {}
+        # (name, version) -> its possible lineages
+        self._lineages = {}
+        # (name, version) -> its depth, once it's been asked for
+        self._depths = None
     
     
     def addPath(self, name, version, inputs):
@@ -31,24 +52,153 @@ class Garden(object):
         @raise CycleError: If adding this path would create circular
             dependencies/recursion.
         """
+        inputs = [tuple(x) for x in inputs]
         if (name, version) in inputs:
             raise CycleError(name, version, inputs)
         
-        def ancestors(n, v):
-            input_lists = self.inputsFor(n, v)
-            for input_list in input_lists:
-                for i in input_list:
-                    yield i
-                    for x in ancestors(*i):
-                        yield x
-        # check each input line
+        # nodes seen for the first time, to forget if the path is rejected
+        new = set([x for x in inputs + [(name, version)]
+                   if x not in self._order])
         for i in inputs:
-            if (name, version) in ancestors(*i):
-                raise CycleError(name, version, inputs)
+            self._ordinal(i, first=True)
+        dst = self._ordinal((name, version))
+        
+        # only inputs that currently sort after the destination can possibly
+        # introduce a cycle.
+        for i in inputs:
+            if self._order[i] > dst:
+                if not self._reorder(i, (name, version)):
+                    for node in new:
+                        del self._order[node]
+                    raise CycleError(name, version, inputs)
+                dst = self._order[(name, version)]
 
         self._destinations[(name, version)].append(inputs)
-        for iname, iversion in inputs:
-            self._inputs[(iname, iversion)].append((name, version))
+        for i in inputs:
+            self._inputs[i].append((name, version))
+        self._reachable.clear()
+        self._lineages.clear()
+        self._depths = None
+
+
+    def removePath(self, name, version, inputs):
+        """
+        Remove a path added with L{addPath} or L{addPaths}.
+        
+        @param name: Destination name
+        @param version: Destination version
+        @param inputs: The list of 2-tuples (name, version) the path was
+            added with.
+        
+        @raise ValueError: If there's no such path.
+        """
+        dst = (name, version)
+        inputs = [tuple(x) for x in inputs]
+        input_lists = self._destinations.get(dst, [])
+        if inputs not in input_lists:
+            raise ValueError("No such path", name, version, inputs)
+        
+        # taking edges away never invalidates the topological order
+        input_lists.remove(inputs)
+        if not input_lists:
+            del self._destinations[dst]
+        for i in inputs:
+            required_by = self._inputs[i]
+            required_by.remove(dst)
+            if not required_by:
+                del self._inputs[i]
+        self._reachable.clear()
+        self._lineages.clear()
+        self._depths = None
+
+
+    def addPaths(self, paths):
+        """
+        Add many paths at once.  This is much faster than calling L{addPath}
+        for each one, because the whole garden is only checked for cycles once.
+        
+        @param paths: An iterable of 3-tuples C{(name, version, inputs)}, each
+            like the arguments to L{addPath}.
+        
+        @raise CycleError: If the paths (together with the paths I already
+            have) contain circular dependencies.  The error's argument is a
+            list of 2-tuples (name, version) going from input to destination
+            around one such cycle, starting and ending with the same thing.
+            None of the paths are added in that case.
+        """
+        destinations = defaultdict(lambda:[])
+        for k, v in self._destinations.iteritems():
+            destinations[k] = list(v)
+        required_by = defaultdict(lambda:[])
+        for k, v in self._inputs.iteritems():
+            required_by[k] = list(v)
+        
+        order = list(self._order)
+        known = set(order)
+        for name, version, inputs in paths:
+            dst = (name, version)
+            inputs = [tuple(x) for x in inputs]
+            if dst in inputs:
+                raise CycleError([dst, dst])
+            for node in [dst] + inputs:
+                if node not in known:
+                    known.add(node)
+                    order.append(node)
+            destinations[dst].append(inputs)
+            for i in inputs:
+                required_by[i].append(dst)
+        
+        # Kahn: repeatedly take the things whose inputs are all accounted for.
+        pending = {}
+        for node in order:
+            pending[node] = sum([len(x) for x in destinations.get(node, ())])
+        ready = deque([x for x in order if not pending[x]])
+        order = []
+        while ready:
+            node = ready.popleft()
+            order.append(node)
+            for child in required_by.get(node, ()):
+                pending[child] -= 1
+                if not pending[child]:
+                    ready.append(child)
+        
+        if len(order) < len(pending):
+            raise CycleError(self._findCycle(destinations, pending))
+        
+        self._destinations = destinations
+        self._inputs = required_by
+        self._order = dict(zip(order, xrange(len(order))))
+        self._first_ordinal = 0
+        self._last_ordinal = len(order) - 1
+        self._reachable.clear()
+        self._lineages.clear()
+        self._depths = None
+
+
+    def _findCycle(self, destinations, pending):
+        """
+        Find one cycle among the things a topological sort couldn't place.
+        
+        @param pending: Mapping of (name, version) to the number of inputs it
+            has that haven't been placed.
+        
+        @return: A list of 2-tuples (name, version) from input to destination
+            around the cycle, with the first one repeated at the end.
+        """
+        # everything unplaced has an unplaced input, so walking backwards
+        # through unplaced inputs must eventually come around again.
+        node = [x for x in pending if pending[x]][0]
+        seen = []
+        while node not in seen:
+            seen.append(node)
+            for input_list in destinations[node]:
+                unplaced = [x for x in input_list if pending[x]]
+                if unplaced:
+                    node = unplaced[0]
+                    break
+        cycle = seen[seen.index(node):] + [node]
+        cycle.reverse()
+        return cycle
 
 
     def pathsRequiring(self, name, version):
@@ -59,7 +209,7 @@ class Garden(object):
         @return: A list of 2-tuples (name, version) of destinations requiring
             the given input. 
         """
-        return self._inputs[(name, version)]
+        return self._inputs.get((name, version), [])
 
 
     def inputsFor(self, name, version):
@@ -72,7 +222,526 @@ class Garden(object):
         @return: A list of lists of 2-tuples (name, version) of inputs needed
             to reach the given destination.
         """
-        return self._destinations[(name, version)]
+        return self._destinations.get((name, version), [])
+
+
+    def hasPath(self, name, version, inputs):
+        """
+        @param name: Destination name
+        @param version: Destination version
+        @param inputs: List of 2-tuples (name, version) of inputs.
+        
+        @return: C{True} if there's a path to the destination from exactly
+            these inputs (in this order), otherwise C{False}.
+        """
+        inputs = [tuple(x) for x in inputs]
+        return inputs in self._destinations.get((name, version), ())
+
+
+    def paths(self):
+        """
+        Get all my paths.
+        
+        @return: A list of 3-tuples C{(name, version, inputs)} where C{inputs}
+            is a tuple of 2-tuples (name, version), with destinations in
+            topological order.
+        """
+        ret = []
+        for dst in sorted(self._destinations, key=self._order.__getitem__):
+            for inputs in self._destinations[dst]:
+                ret.append(dst + (tuple(inputs),))
+        return ret
+
+
+    def downstreamOf(self, name, version):
+        """
+        Get everything that eventually requires the given input.
+        
+        @return: A tuple of 2-tuples (name, version) in topological order
+            (inputs before the destinations requiring them).
+        """
+        return self._reach('down', (name, version))
+
+
+    def upstreamOf(self, name, version):
+        """
+        Get everything that the given destination eventually requires.
+        
+        @return: A tuple of 2-tuples (name, version) in topological order
+            (inputs before the destinations requiring them).
+        """
+        return self._reach('up', (name, version))
+
+
+    def _reach(self, direction, node):
+        key = (direction, node)
+        if key in self._reachable:
+            return self._reachable[key]
+        found = set()
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if direction == 'down':
+                following = self._inputs.get(current, ())
+            else:
+                following = []
+                for input_list in self._destinations.get(current, ()):
+                    following.extend(input_list)
+            for x in following:
+                if x not in found:
+                    found.add(x)
+                    stack.append(x)
+        ret = self._reachable[key] = tuple(sorted(found,
+                                                  key=self._order.__getitem__))
+        return ret
+
+
+    def lineagesFor(self, name, version):
+        """
+        Get the lineages that data for C{(name, version)} can have given my
+        paths: the lineage of data put in directly as input, and of data
+        computed by each path from data with any of its inputs' lineages.
+        
+        There can be a lot of these if there are many ways to compute
+        something from many ways to compute its inputs -- the number grows
+        with the product of the inputs' numbers -- so if there are more than
+        L{MAX_LINEAGES} they aren't listed.
+        
+        @return: A C{frozenset} of lineal hashes (see L{linealHash}), empty
+            if C{(name, version)} isn't in me, or C{None} if there are too
+            many.
+        """
+        if (name, version) not in self._order:
+            return frozenset()
+        return _lineagesFor(self, (name, version), self._lineages)
+
+
+    def depthOf(self, name, version):
+        """
+        Get the number of paths in the longest chain of them leading to
+        C{(name, version)}: 0 for inputs (and things not in me), 1 for things
+        computed only from inputs, and so on.
+        """
+        if self._depths is None:
+            self._depths = _depthsOf(self, sorted(self._order,
+                                                  key=self._order.__getitem__))
+        return self._depths.get((name, version), 0)
+
+
+    def freeze(self):
+        """
+        Compile me into a read-only L{FrozenGarden}.  Paths added to me
+        afterwards will not show up in it.
+        """
+        nodes = sorted(self._order, key=self._order.__getitem__)
+        return FrozenGarden(nodes, self._destinations, self._inputs)
+
+
+    def dump(self, fh):
+        """
+        Write me to a file.  See L{FrozenGarden.dump}.
+        """
+        self.freeze().dump(fh)
+
+
+    def _ordinal(self, node, first=False):
+        """
+        Get the topological ordinal of C{node}.  A never-before-seen node has
+        no paths yet, so it's put before (if C{first}) or after all the others.
+        """
+        try:
+            return self._order[node]
+        except KeyError:
+            if first:
+                self._first_ordinal -= 1
+                ordinal = self._first_ordinal
+            else:
+                self._last_ordinal += 1
+                ordinal = self._last_ordinal
+            self._order[node] = ordinal
+            return ordinal
+
+
+    def _reorder(self, src, dst):
+        """
+        Make room in the topological order for a new edge from C{src} to C{dst}
+        where C{src} currently sorts after C{dst} (Pearce-Kelly).  Only the
+        nodes whose ordinals lie between the two endpoints are visited.
+        
+        @return: C{False} (and the order untouched) if C{dst} already leads to
+            C{src}, meaning the edge would create a cycle.  Otherwise C{True}.
+        """
+        order = self._order
+        lower = order[dst]
+        upper = order[src]
+        
+        # destinations reachable from dst that sort before src
+        forward = set([dst])
+        stack = [dst]
+        while stack:
+            node = stack.pop()
+            for child in self._inputs.get(node, ()):
+                if child == src:
+                    return False
+                if child not in forward and order[child] < upper:
+                    forward.add(child)
+                    stack.append(child)
+        
+        # inputs leading to src that sort after dst
+        backward = set([src])
+        stack = [src]
+        while stack:
+            node = stack.pop()
+            for input_list in self._destinations.get(node, ()):
+                for parent in input_list:
+                    if parent not in backward and order[parent] > lower:
+                        backward.add(parent)
+                        stack.append(parent)
+        
+        # reuse the affected ordinals, putting src's ancestors before dst's
+        # descendants.
+        key = order.__getitem__
+        nodes = sorted(backward, key=key) + sorted(forward, key=key)
+        ordinals = sorted([order[x] for x in nodes])
+        for node, ordinal in zip(nodes, ordinals):
+            order[node] = ordinal
+        return True
+
+
+
+def _lineagesFor(garden, node, memo):
+    """
+    Compute the lineages of C{node} in C{garden} (and of everything it
+    requires), remembering them in C{memo}.  A node with more than
+    L{MAX_LINEAGES} (or with an input that has) gets C{None}, without them
+    being listed.
+    """
+    if node in memo:
+        return memo[node]
+    for current in garden.upstreamOf(*node) + (node,):
+        if current not in memo:
+            memo[current] = _nodeLineages(garden, current, memo)
+    return memo[node]
+
+
+
+def _nodeLineages(garden, node, memo):
+    lineages = set([linealHash(*node)])
+    for input_list in garden.inputsFor(*node):
+        input_lineages = [memo[tuple(x)] for x in input_list]
+        if None in input_lineages:
+            return None
+        count = 1
+        for x in input_lineages:
+            count *= len(x)
+        if len(lineages) + count > MAX_LINEAGES:
+            return None
+        for combination in product(*input_lineages):
+            lineages.add(linealHash(node[0], node[1], list(combination)))
+    return frozenset(lineages)
 
 
 
+def _depthsOf(garden, nodes):
+    """
+    Compute the depth of each of C{nodes}, all the nodes of C{garden} in
+    topological order (see L{Garden.depthOf}).
+    """
+    depths = {}
+    for node in nodes:
+        depth = 0
+        for input_list in garden.inputsFor(*node):
+            for input_node in input_list:
+                depth = max(depth, depths[tuple(input_node)] + 1)
+        depths[node] = depth
+    return depths
+
+
+
+def diffGardens(old, new):
+    """
+    Compare the paths in two gardens (frozen or not).
+    
+    @return: A 2-tuple of lists C{(added, removed)} of 3-tuples C{(name,
+        version, inputs)} like L{Garden.paths} returns.  C{added} are paths in
+        C{new} but not in C{old} and C{removed} are paths in C{old} but not in
+        C{new}.
+    """
+    old_paths = set(old.paths())
+    new_paths = set(new.paths())
+    added = [x for x in new.paths() if x not in old_paths]
+    removed = [x for x in old.paths() if x not in new_paths]
+    return added, removed
+
+
+
+def loadGarden(fh):
+    """
+    Load a garden written by L{FrozenGarden.dump}.  The garden isn't checked
+    for cycles (or anything else) while loading, so only load trusted files.
+    
+    @param fh: A file opened for reading in binary mode.
+    
+    @rtype: L{FrozenGarden}
+    
+    @raise ValueError: If C{fh} doesn't contain a dumped garden.
+    """
+    if fh.read(len(FrozenGarden.MAGIC)) != FrozenGarden.MAGIC:
+        raise ValueError("Not a garden file")
+    
+    def readArray():
+        count, = struct.unpack('<I', fh.read(4))
+        a = array('i')
+        a.fromstring(fh.read(count * a.itemsize))
+        if len(a) != count:
+            raise ValueError("Truncated garden file")
+        if sys.byteorder != 'little':
+            a.byteswap()
+        return a
+    
+    names = fh.read(struct.unpack('<I', fh.read(4))[0])
+    names = names.split('\0') if names else []
+    garden = FrozenGarden([], {}, {})
+    garden._nodes = tuple(zip(names[0::2], names[1::2]))
+    garden._ids = dict(zip(garden._nodes, xrange(len(garden._nodes))))
+    garden._required_offsets = readArray()
+    garden._required = readArray()
+    garden._path_offsets = readArray()
+    garden._input_offsets = readArray()
+    garden._inputs = readArray()
+    garden._buildLookups()
+    return garden
+
+
+
+class FrozenGarden(object):
+    """
+    I am a read-only garden of forking paths, compiled for fast lookups.  Get
+    one with L{Garden.freeze}.
+    
+    Every (name, version) is numbered in topological order, and the paths
+    between them are kept in flat arrays of those numbers.  The answers to
+    L{pathsRequiring} and L{inputsFor} are built from those once, when I'm
+    made, so looking them up doesn't build anything.  Looking up things that
+    aren't in me doesn't make me any bigger.
+    """
+    
+    MAGIC = 'GARDEN\0\1'
+    
+    
+    def __init__(self, nodes, destinations, required_by):
+        """
+        @param nodes: List of all the 2-tuples (name, version) in the garden,
+            in topological order.
+        @param destinations: Mapping of each (name, version) to the list of
+            input lists that lead to it.
+        @param required_by: Mapping of each (name, version) to the list of
+            destinations requiring it.
+        """
+        self._nodes = tuple(nodes)
+        self._ids = dict(zip(self._nodes, xrange(len(self._nodes))))
+        ids = self._ids
+        
+        # the destinations requiring node i are
+        #   _required[_required_offsets[i]:_required_offsets[i + 1]]
+        self._required_offsets = array('i', [0])
+        self._required = array('i')
+        
+        # the paths to node i are numbered
+        #   _path_offsets[i] through _path_offsets[i + 1] - 1
+        # and the inputs for path p are
+        #   _inputs[_input_offsets[p]:_input_offsets[p + 1]]
+        self._path_offsets = array('i', [0])
+        self._input_offsets = array('i', [0])
+        self._inputs = array('i')
+        
+        self._reachable = {}
+        self._lineages = {}
+        self._depths = None
+        for node in self._nodes:
+            self._required.extend([ids[x] for x in required_by.get(node, ())])
+            self._required_offsets.append(len(self._required))
+            for input_list in destinations.get(node, ()):
+                self._inputs.extend([ids[x] for x in input_list])
+                self._input_offsets.append(len(self._inputs))
+            self._path_offsets.append(len(self._input_offsets) - 1)
+        self._buildLookups()
+
+
+    def _buildLookups(self):
+        """
+        Build the tuples returned by L{pathsRequiring} and L{inputsFor} from
+        my arrays.
+        """
+        nodes = self._nodes
+        required_offsets = self._required_offsets
+        path_offsets = self._path_offsets
+        input_offsets = self._input_offsets
+        self._requiring = {}
+        self._inputs_for = {}
+        for i, node in enumerate(nodes):
+            start, end = required_offsets[i], required_offsets[i + 1]
+            if end > start:
+                self._requiring[node] = tuple([nodes[x] for x in
+                                               self._required[start:end]])
+            paths = []
+            for p in xrange(path_offsets[i], path_offsets[i + 1]):
+                paths.append(tuple([nodes[x] for x in
+                    self._inputs[input_offsets[p]:input_offsets[p + 1]]]))
+            if paths:
+                self._inputs_for[node] = tuple(paths)
+
+
+    def pathsRequiring(self, name, version):
+        """
+        @param name: Input name
+        @param version: Input version
+        
+        @return: A tuple of 2-tuples (name, version) of destinations requiring
+            the given input.
+        """
+        return self._requiring.get((name, version), ())
+
+
+    def inputsFor(self, name, version):
+        """
+        Get the inputs needed for a particular destination.
+        
+        @param name: Destination name
+        @param version: Destination version
+        
+        @return: A tuple of tuples of 2-tuples (name, version) of inputs needed
+            to reach the given destination.
+        """
+        return self._inputs_for.get((name, version), ())
+
+
+    def hasPath(self, name, version, inputs):
+        """
+        @param name: Destination name
+        @param version: Destination version
+        @param inputs: List of 2-tuples (name, version) of inputs.
+        
+        @return: C{True} if there's a path to the destination from exactly
+            these inputs (in this order), otherwise C{False}.
+        """
+        i = self._ids.get((name, version))
+        if i is None:
+            return False
+        ids = self._ids
+        wanted = [ids.get(tuple(x)) for x in inputs]
+        offsets = self._input_offsets
+        for p in xrange(self._path_offsets[i], self._path_offsets[i + 1]):
+            start, end = offsets[p], offsets[p + 1]
+            if end - start == len(wanted) and self._inputs[start:end].tolist() == wanted:
+                return True
+        return False
+
+
+    def paths(self):
+        """
+        Get all my paths.
+        
+        @return: A list of 3-tuples C{(name, version, inputs)} where C{inputs}
+            is a tuple of 2-tuples (name, version), with destinations in
+            topological order.
+        """
+        ret = []
+        for node in self._nodes:
+            for inputs in self.inputsFor(*node):
+                ret.append(node + (inputs,))
+        return ret
+
+
+    def lineagesFor(self, name, version):
+        """
+        See L{Garden.lineagesFor}.
+        """
+        if (name, version) not in self._ids:
+            return frozenset()
+        return _lineagesFor(self, (name, version), self._lineages)
+
+
+    def depthOf(self, name, version):
+        """
+        See L{Garden.depthOf}.
+        """
+        if self._depths is None:
+            self._depths = _depthsOf(self, self._nodes)
+        return self._depths.get((name, version), 0)
+
+
+    def dump(self, fh):
+        """
+        Write me to a file in a compact format that L{loadGarden} can read
+        back quickly, without checking for cycles all over again.
+        
+        The format is C{MAGIC}, then the null-separated names and versions
+        in topological order, then each of my arrays as a count followed by
+        that many little-endian 32-bit integers.  Each count and the length
+        of the names is a little-endian 32-bit unsigned integer.
+        
+        @param fh: A file opened for writing in binary mode.
+        """
+        names = []
+        for name, version in self._nodes:
+            names.extend([name, version])
+        names = '\0'.join(names)
+        fh.write(self.MAGIC)
+        fh.write(struct.pack('<I', len(names)))
+        fh.write(names)
+        for a in [self._required_offsets, self._required, self._path_offsets,
+                  self._input_offsets, self._inputs]:
+            if sys.byteorder != 'little':
+                a = array(a.typecode, a)
+                a.byteswap()
+            fh.write(struct.pack('<I', len(a)))
+            fh.write(a.tostring())
+
+
+    def downstreamOf(self, name, version):
+        """
+        Get everything that eventually requires the given input.
+        
+        @return: A tuple of 2-tuples (name, version) in topological order
+            (inputs before the destinations requiring them).
+        """
+        return self._reach('down', (name, version))
+
+
+    def upstreamOf(self, name, version):
+        """
+        Get everything that the given destination eventually requires.
+        
+        @return: A tuple of 2-tuples (name, version) in topological order
+            (inputs before the destinations requiring them).
+        """
+        return self._reach('up', (name, version))
+
+
+    def _reach(self, direction, node):
+        key = (direction, node)
+        if key in self._reachable:
+            return self._reachable[key]
+        i = self._ids.get(node)
+        if i is None:
+            return ()
+        if direction == 'down':
+            # destinations requiring node i
+            offsets, targets = self._required_offsets, self._required
+        else:
+            # inputs of every path to node i (they're stored contiguously)
+            offsets = [self._input_offsets[x] for x in self._path_offsets]
+            targets = self._inputs
+        found = set()
+        stack = [i]
+        while stack:
+            current = stack.pop()
+            following = targets[offsets[current]:offsets[current + 1]]
+            for x in following:
+                if x not in found:
+                    found.add(x)
+                    stack.append(x)
+        nodes = self._nodes
+        ret = self._reachable[key] = tuple([nodes[x] for x in sorted(found)])
+        return ret
@@ -0,0 +1,142 @@
+from twisted.internet import defer, reactor, task
+
+from garden.store import eachPage
+from garden.data import linealHash
+
+
+
+class LineageCollector(object):
+    """
+    I delete computed data from a store that can't be produced by the current
+    garden: data for a (name, version) that isn't in the garden at all, and
+    data with a lineage that none of the garden's paths lead to any more (see
+    L{Garden.lineagesFor}).  Input data can't be computed again, so it's
+    never deleted, and neither is data for a (name, version) with too many
+    lineages to list.
+
+    Entities are done in sorted order, and each entity's data is gone
+    through a page at a time.  Deleting is done a few data points at a time,
+    in small transactions, with a C{delay} between them so a running gardener
+    isn't starved.
+    """
+
+    deleted = 0
+    entities_done = 0
+
+
+    def __init__(self, gardener, store, batch_size=100, delay=0,
+                 page_size=1000, reactor=reactor):
+        """
+        @param gardener: Something with a C{garden}, like a L{Gardener}.  The
+            garden is looked at again for each entity, so a new one swapped
+            in while I'm running is used from then on.  If it has C{hashes}
+            (see L{Gardener}), the hashes of the data I delete are forgotten
+            from them.
+        @param store: The L{IDataStore} to delete from.
+
+        @param batch_size: Most data points to delete at once.
+        @param delay: Seconds to wait after each delete.
+
+        @param page_size: Most data points to look at at once.
+        """
+        self.gardener = gardener
+        self.store = store
+        self.batch_size = batch_size
+        self.delay = delay
+        self.page_size = page_size
+        self.reactor = reactor
+        self._stopped = False
+
+
+    def staleKeys(self, data_list):
+        """
+        Find the computed data that can't be produced by the current garden.
+
+        @param data_list: A list of L{IData}.
+
+        @return: A list of tuples C{(name, version, lineage)}.
+        """
+        garden = self.gardener.garden
+        lineages = {}
+        ret = []
+        for data in data_list:
+            key = (data.name, data.version)
+            if data.lineage == linealHash(*key):
+                # input data
+                continue
+            if key not in lineages:
+                lineages[key] = garden.lineagesFor(*key)
+            if lineages[key] is not None and data.lineage not in lineages[key]:
+                ret.append((data.name, data.version, data.lineage))
+        return ret
+
+
+    def collectEntity(self, entity):
+        """
+        Delete all the stale data of one entity.
+
+        @return: A C{Deferred} number of data points deleted.
+        """
+        before = self.deleted
+        d = eachPage(self.store, entity,
+                     lambda page: self._collectPage(entity, page),
+                     limit=self.page_size)
+        return d.addCallback(lambda ignored: self.deleted - before)
+
+
+    @defer.inlineCallbacks
+    def _collectPage(self, entity, data_list):
+        keys = self.staleKeys(data_list)
+        for i in xrange(0, len(keys), self.batch_size):
+            if self._stopped:
+                break
+            batch = keys[i:i + self.batch_size]
+            self.deleted += yield self.store.delete(entity, batch)
+            self._forgetHashes(entity, batch)
+            if self.delay:
+                yield task.deferLater(self.reactor, self.delay, lambda:None)
+        defer.returnValue(not self._stopped)
+
+
+    def _forgetHashes(self, entity, keys):
+        """
+        Forget the gardener's cached hashes of deleted data, so results
+        computed from it aren't taken to be current.
+        """
+        hashes = getattr(self.gardener, 'hashes', None)
+        if hashes is None:
+            return
+        for key in keys:
+            hashes.pop((entity,) + tuple(key), None)
+
+
+    def run(self):
+        """
+        Delete the stale data of every entity in the store.
+
+        @return: A C{Deferred} that fires with the number of data points
+            deleted once it's done (or I'm stopped).
+        """
+        self._stopped = False
+        self.deleted = 0
+        self.entities_done = 0
+        d = self.store.entities()
+        d.addCallback(self._gotEntities)
+        return d
+
+
+    @defer.inlineCallbacks
+    def _gotEntities(self, entities):
+        for entity in entities:
+            if self._stopped:
+                break
+            yield self.collectEntity(entity)
+            self.entities_done += 1
+        defer.returnValue(self.deleted)
+
+
+    def stop(self):
+        """
+        Stop after the delete currently in progress.
+        """
+        self._stopped = True
@@ -0,0 +1,361 @@
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+from zope.interface import implements
+
+from itertools import count
+import heapq
+
+from garden.interface import ISourceable, IReceiver, IWork, ISource
+
+
+
+def workKey(work):
+    """
+    Get the destination and path of a piece of work (or the result of it):
+    C{(entity, name, version, lineage)}.
+    """
+    return (work.entity, work.name, work.version, work.lineage)
+
+
+
+class InFlight(object):
+    """
+    I keep track of work that's been passed on and isn't done, calling
+    C{release} once for each piece when it's done.
+
+    Work is done when a result for its destination and path comes back (see
+    L{workDone}), or else when passing it on finishes.  Waiting for passing
+    it on to finish isn't enough by itself, because that waits for all the
+    work made from the result too, which may be waiting for room.
+    """
+
+
+    def __init__(self, release):
+        """
+        @param release: Function called with no arguments for each piece of
+            work that's done.
+        """
+        self.release = release
+        self._held = {}
+
+
+    def hold(self, work):
+        """
+        Start keeping track of C{work}, before passing it on.
+
+        @return: A function to add to both the callbacks and errbacks of the
+            C{Deferred} from passing on the work.
+        """
+        key = workKey(work)
+        token = object()
+        self._held.setdefault(key, []).append(token)
+        def passedOn(result):
+            self._drop(key, token)
+            return result
+        return passedOn
+
+
+    def _drop(self, key, token):
+        tokens = self._held.get(key, [])
+        if token in tokens:
+            tokens.remove(token)
+            if not tokens:
+                del self._held[key]
+            self.release()
+
+
+    def workDone(self, result):
+        """
+        Release all the work in flight for the destination and path of
+        C{result} (an L{IResult} or L{IResultError}).
+        """
+        for ignored in self._held.pop(workKey(result), []):
+            self.release()
+
+
+    def __len__(self):
+        return sum(map(len, self._held.values()))
+
+
+
+class WorkCoalescer(object):
+    """
+    I hold on to work for a while before passing it on, so that a burst of
+    inputs for an entity makes one piece of work instead of a cascade of
+    them.
+
+    Work for the same C{(entity, name, version, lineage)} -- the same
+    destination by the same path -- is held until none has come in for
+    C{delay} seconds, and then only the latest is passed on.  If C{max_delay}
+    is given, work is passed on after that long even if more keeps coming.
+    L{coalesced} counts the work that was replaced by later work.
+    """
+
+    implements(ISourceable, IReceiver)
+    sourceInterfaces = (IWork,)
+
+    coalesced = 0
+
+
+    def __init__(self, delay, max_delay=None, reactor=reactor):
+        """
+        @param delay: Seconds with no new work for a destination to wait before
+            passing on its latest work.
+        @param max_delay: Most seconds to hold on to work.
+        """
+        self.delay = delay
+        self.max_delay = max_delay
+        self.reactor = reactor
+        self._held = {}
+
+
+    def receiverMapping(self):
+        return {
+            IWork: self.workReceived,
+        }
+
+
+    def workReceived(self, work):
+        """
+        Hold on to C{work}, replacing any work held for the same destination
+        and path.
+
+        @return: A C{Deferred} that fires with the result of passing on the
+            latest work once it's passed on.
+        """
+        key = workKey(work)
+        d = defer.Deferred()
+        held = self._held.get(key)
+        if held is None:
+            call = self.reactor.callLater(self.delay, self._send, key)
+            self._held[key] = [work, [d], call, self.reactor.seconds()]
+            return d
+
+        self.coalesced += 1
+        held[0] = work
+        held[1].append(d)
+        wait = self.delay
+        if self.max_delay is not None:
+            left = held[3] + self.max_delay - self.reactor.seconds()
+            wait = max(0, min(wait, left))
+        held[2].reset(wait)
+        return d
+
+
+    def pending(self):
+        """
+        Get the number of pieces of work I'm holding on to.
+        """
+        return len(self._held)
+
+
+    def _send(self, key):
+        work, waiters, call, ignored = self._held.pop(key)
+        d = defer.maybeDeferred(ISource(self).emit, work)
+        return d.addBoth(self._notifyWaiters, waiters)
+
+
+    def _notifyWaiters(self, result, waiters):
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+    def flush(self):
+        """
+        Pass on all the work I'm holding on to now.
+
+        @return: A C{Deferred} that fires once it's all been passed on.
+        """
+        dlist = []
+        for key in sorted(self._held):
+            self._held[key][2].cancel()
+            dlist.append(self._send(key))
+        return defer.DeferredList(dlist)
+
+
+
+def depthPriority(garden, work):
+    """
+    A priority for L{WorkQueue} that puts work nearer the garden's inputs
+    first: the number of paths in the longest chain of them leading to the
+    work's destination (see L{Garden.depthOf}).
+    """
+    return garden.depthOf(work.name, work.version)
+
+
+
+def pathPriority(priorities, default=0):
+    """
+    Make a priority for L{WorkQueue} from a dictionary of C{(name, version)}
+    to priority (lower goes first).  Destinations not in it get C{default}.
+    """
+    def priority(garden, work):
+        return priorities.get((work.name, work.version), default)
+    return priority
+
+
+
+class WorkQueue(object):
+    """
+    I pass on work no more than C{concurrency} pieces at a time, in order of
+    priority, taking turns between entities.
+
+    If C{priority} is given, it's called with C{(garden, work)} and work with
+    lower priorities goes first (see L{depthPriority} and L{pathPriority}).
+    Work with the same priority is fairly queued by entity: each entity's
+    work is tagged with a virtual finishing time, advancing by C{1 /
+    entity_weight(entity)} per piece, so an entity with a lot of work queued
+    doesn't hold up one with a little.
+
+    Work is done when its result is passed to L{workDone} (as the
+    L{Gardener} does), or else when passing it on finishes.
+
+    If C{max_queued} is given, the producers registered with
+    L{registerProducer} are paused when that much work is queued and resumed
+    once half of it has been passed on.  Work that comes in while they're
+    paused is still queued.
+    """
+
+    implements(ISourceable, IReceiver)
+    sourceInterfaces = (IWork,)
+
+    dispatched = 0
+    in_flight = 0
+    total_wait = 0
+    max_wait = 0
+    paused = False
+
+
+    def __init__(self, concurrency=10, priority=None, entity_weight=None,
+                 garden=None, max_queued=None, reactor=reactor):
+        """
+        @param concurrency: Most work to have passed on and not done at once.
+        @param priority: Function of C{(garden, work)} to a priority.
+        @param entity_weight: Function of an entity to its share of turns.
+        @param garden: The garden given to C{priority}.
+        @param max_queued: Amount of queued work at which to pause producers.
+        """
+        self.concurrency = concurrency
+        self.priority = priority
+        self.entity_weight = entity_weight
+        self.garden = garden
+        self.max_queued = max_queued
+        self.reactor = reactor
+        self._producers = []
+        self._queue = []
+        self._tags = {}
+        self._vtime = 0
+        self._counter = count()
+        self._dispatching = False
+        self._tracker = InFlight(self._done)
+
+
+    def receiverMapping(self):
+        return {
+            IWork: self.workReceived,
+        }
+
+
+    def workReceived(self, work):
+        """
+        Queue C{work}.
+
+        @return: A C{Deferred} that fires with the result of passing on the
+            work once it's been passed on.
+        """
+        priority = 0
+        if self.priority is not None:
+            priority = self.priority(self.garden, work)
+        weight = 1
+        if self.entity_weight is not None:
+            weight = self.entity_weight(work.entity)
+        tag = max(self._vtime, self._tags.get(work.entity, 0)) + 1.0 / weight
+        self._tags[work.entity] = tag
+
+        d = defer.Deferred()
+        heapq.heappush(self._queue, (priority, tag, next(self._counter),
+                                     work, d, self.reactor.seconds()))
+        self._dispatch()
+        if self.max_queued and not self.paused and \
+                len(self._queue) >= self.max_queued:
+            self.paused = True
+            for producer in self._producers:
+                producer.pauseProducing()
+        return d
+
+
+    def registerProducer(self, producer):
+        """
+        Have C{producer} paused and resumed (with its C{pauseProducing} and
+        C{resumeProducing} methods) as my queue fills up and drains.
+        """
+        self._producers.append(producer)
+        if self.paused:
+            producer.pauseProducing()
+
+
+    def _dispatch(self):
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            while self._queue and self.in_flight < self.concurrency:
+                priority, tag, ignored, work, d, queued = heapq.heappop(
+                    self._queue)
+                self._vtime = max(self._vtime, tag)
+                if self._tags.get(work.entity) == tag:
+                    # nothing else queued for this entity
+                    del self._tags[work.entity]
+
+                wait = self.reactor.seconds() - queued
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.dispatched += 1
+                self.in_flight += 1
+                passedOn = self._tracker.hold(work)
+                result = defer.maybeDeferred(ISource(self).emit, work)
+                result.addBoth(passedOn)
+                result.chainDeferred(d)
+        finally:
+            self._dispatching = False
+        if self.paused and len(self._queue) <= self.max_queued // 2:
+            self.paused = False
+            for producer in self._producers:
+                producer.resumeProducing()
+
+
+    def _done(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+
+    def workDone(self, result):
+        """
+        Make room for more work now that C{result} (an L{IResult} or
+        L{IResultError}) has come back for some.
+        """
+        self._tracker.workDone(result)
+
+
+    def stats(self):
+        """
+        Get a dictionary of how I'm doing: the work C{queued} and
+        C{in_flight}, whether producers are C{paused}, the work C{dispatched}
+        so far and the C{mean_wait} and C{max_wait} in seconds between work
+        being queued and passed on.
+        """
+        mean_wait = 0
+        if self.dispatched:
+            mean_wait = self.total_wait / float(self.dispatched)
+        return {
+            'queued': len(self._queue),
+            'in_flight': self.in_flight,
+            'paused': self.paused,
+            'dispatched': self.dispatched,
+            'mean_wait': mean_wait,
+            'max_wait': self.max_wait,
+        }
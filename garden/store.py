@@ -1,9 +1,18 @@
 from zope.interface import implements
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
 from twisted.enterprise import adbapi
+from twisted.python import log
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import zlib
 
 from garden.interface import IDataStore
-from garden.data import Data
+from garden.data import Data, valueHash
+from garden.util import LRUCache, LFUCache
 
 
 sqlite = None
@@ -15,39 +24,190 @@ except:
 if not sqlite:
     import sqlite3 as sqlite
 
+# INSERT ... ON CONFLICT DO UPDATE showed up in SQLite 3.24.0
+_HAS_UPSERT = sqlite.sqlite_version_info >= (3, 24, 0)
+
+# crc32 of the rest of the record, lengths of the entity, name, version,
+# lineage and value (which follow), and the value's hash.
+_RECORD = struct.Struct('<IHHHHI40s')
+# value length of a record of a deletion
+_TOMBSTONE = 0xffffffff
+
+_SELECT_DATA = ('select entity, name, version, lineage, blobs.value '
+                'from data join blobs on blobs.hash = data.hash')
+
 
 
 class SqliteStore(object):
+    """
+    I store data in an SQLite database.
+    
+    If C{group_interval} is given, I'm in write-behind mode: calls to L{put}
+    are queued and written together in one transaction (a group commit) once
+    C{group_interval} seconds have passed since the first of them, or as soon
+    as C{group_size} of them are waiting.  Each L{put}'s C{Deferred} still
+    only fires once its data is committed.
+    
+    All writing is done by a single connection.  If C{readers} is more than
+    0, the database is switched to write-ahead logging (WAL) and reads are
+    done by a separate pool of up to C{readers} read-only connections, so
+    they don't wait for writes.  Databases in memory can't be shared between
+    connections, so they ignore C{readers}.
+    
+    Each distinct value is stored once, in the C{blobs} table, keyed by its
+    hash.  Data rows refer to it by hash, and triggers keep count of the rows
+    referring to each value and delete it when there are none.
+    """
 
     implements(IDataStore)
 
 
-    def __init__(self, connstr, reactor=reactor):
+    def __init__(self, connstr, reactor=reactor, group_interval=None,
+                 group_size=100, readers=0):
+        if connstr == ':memory:':
+            readers = 0
         self.pool = adbapi.ConnectionPool(sqlite.__name__, connstr,
             check_same_thread=False,
-            cp_min=1, cp_max=1)
+            cp_min=1, cp_max=1,
+            cp_openfun=self._openWriter if readers else None)
         self.pool.start()
         
+        self.read_pool = self.pool
+        if readers:
+            self.read_pool = adbapi.ConnectionPool(sqlite.__name__, connstr,
+                check_same_thread=False,
+                cp_min=1, cp_max=readers,
+                cp_openfun=self._openReader)
+            self.read_pool.start()
+        
         self.connstr = connstr
         self.reactor = reactor
-        self._initDatabase()
+        self.group_interval = group_interval
+        self.group_size = group_size
+        self._pending = []
+        self._flush_call = None
+        # until the tables exist, reads wait in line behind their creation
+        self._initialized = False
+        self._initDatabase().addCallback(self._doneInitializing)
+
+
+    def _openWriter(self, conn):
+        conn.execute('pragma journal_mode = wal')
+
+
+    def _openReader(self, conn):
+        conn.execute('pragma query_only = 1')
+
+
+    def _doneInitializing(self, result):
+        self._initialized = True
 
 
     def runQuery(self, qry, params=()):
         return self.pool.runQuery(qry, params)
 
 
+    def runReadQuery(self, qry, params=()):
+        """
+        Run a query that only reads, using a reader connection if I have them.
+        """
+        if not self._initialized:
+            return self.pool.runQuery(qry, params)
+        return self.read_pool.runQuery(qry, params)
+
+
+    def runReadInteraction(self, func, *args):
+        """
+        Like L{runReadQuery} but for running a function with a cursor.
+        """
+        if not self._initialized:
+            return self.pool.runInteraction(func, *args)
+        return self.read_pool.runInteraction(func, *args)
+
+
     def _initDatabase(self):
-        return self.runQuery('''create table if not exists data (
+        return self.pool.runInteraction(self._createTables)
+
+
+    def _createDataTable(self, c, table='data'):
+        c.execute('''create table if not exists %s (
                 id integer primary key,
                 entrydate timestamp default current_timestamp,
                 entity text,
                 name text,
                 version text,
                 lineage text,
-                value text,
+                hash text,
                 unique (entity, name, version, lineage)
+            )''' % (table,))
+
+
+    def _createTables(self, c):
+        self._createDataTable(c)
+        # each distinct value is stored once, with a count of the data rows
+        # that have it.
+        c.execute('''create table if not exists blobs (
+                hash text primary key,
+                value text,
+                refs integer not null default 0
             )''')
+        
+        c.execute('pragma table_info(data)')
+        columns = [x[1] for x in c.fetchall()]
+        if 'value' in columns:
+            self._migrateValues(c, columns)
+        
+        c.execute('create index if not exists data_entity_id '
+                  'on data (entity, id)')
+        
+        c.execute('''create trigger if not exists data_ref
+            after insert on data begin
+                update blobs set refs = refs + 1 where hash = new.hash;
+            end''')
+        c.execute('''create trigger if not exists data_reref
+            after update of hash on data
+            when old.hash is not new.hash begin
+                update blobs set refs = refs + 1 where hash = new.hash;
+                update blobs set refs = refs - 1 where hash = old.hash;
+                delete from blobs where hash = old.hash and refs <= 0;
+            end''')
+        c.execute('''create trigger if not exists data_unref
+            after delete on data begin
+                update blobs set refs = refs - 1 where hash = old.hash;
+                delete from blobs where hash = old.hash and refs <= 0;
+            end''')
+
+
+    def _migrateValues(self, c, columns):
+        """
+        Move the values of a database made before they were kept in the
+        C{blobs} table into it.  The C{data} table is then made over without
+        its C{value} column, so this is only done once.
+        """
+        # databases made before values' hashes were stored
+        if 'hash' not in columns:
+            c.execute('alter table data add column hash text')
+        while True:
+            c.execute('select id, value from data where hash is null limit 500')
+            rows = c.fetchall()
+            if not rows:
+                break
+            c.executemany('update data set hash = ? where id = ?',
+                          [(valueHash(value), id) for id, value in rows])
+        
+        c.execute('''insert into blobs (hash, value, refs)
+            select hash, min(value), count(*) from data
+            where value is not null
+            group by hash''')
+        
+        # the new table has no triggers, so the refs counted above stay put
+        self._createDataTable(c, 'data_without_values')
+        c.execute('''insert into data_without_values
+            (id, entrydate, entity, name, version, lineage, hash)
+            select id, entrydate, entity, name, version, lineage, hash
+            from data''')
+        c.execute('drop table data')
+        c.execute('alter table data_without_values rename to data')
 
 
     def put(self, data):
@@ -56,40 +216,117 @@ class SqliteStore(object):
         
         @type data: L{Data}
         """
-        def interaction(c):
-            c.execute('''select value from data where
-                entity = ?
-                and name = ?
-                and version = ?
-                and lineage = ?''', (data.entity, data.name, data.version,
-                                     data.lineage))
-            result = c.fetchone()
-            changed = True
-            if not result:
-                c.execute('''insert into data
-                    (entity, name, version, lineage, value)
-                    values (?, ?, ?, ?, ?)''',
-                    (data.entity,
-                     data.name,
-                     data.version,
-                     data.lineage,
-                     data.value))
-            else:
-                changed = result[0] != data.value
-                c.execute('''update data
-                    set value=?
-                    where
-                        entity = ?
-                        and name = ?
-                        and version = ?
-                        and lineage = ?''',
-                    (data.value,
-                     data.entity,
-                     data.name,
-                     data.version,
-                     data.lineage))
-            return {'changed': changed}
-        return self.pool.runInteraction(interaction)
+        if self.group_interval is None:
+            return self.pool.runInteraction(self._put, data)
+        d = defer.Deferred()
+        self._pending.append((data, d))
+        if len(self._pending) >= self.group_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.reactor.callLater(self.group_interval,
+                                                      self.flush)
+        return d
+
+
+    def putMany(self, data_list):
+        """
+        Put several pieces of data in this store in a single transaction.
+        
+        @param data_list: A list of L{Data}.
+        """
+        # anything queued by put was put first.
+        self.flush()
+        return self.pool.runInteraction(self._putMany, data_list)
+
+
+    def _putMany(self, c, data_list):
+        return [self._put(c, data) for data in data_list]
+
+
+    def delete(self, entity, keys):
+        """
+        Delete data from this store in a single transaction.
+        """
+        # anything queued by put was put first.
+        self.flush()
+        if not keys:
+            return defer.succeed(0)
+        return self.pool.runInteraction(self._delete, entity, keys)
+
+
+    def _delete(self, c, entity, keys):
+        c.executemany('''delete from data where
+            entity = ?
+            and name = ?
+            and version = ?
+            and lineage = ?''', [(entity,) + tuple(x) for x in keys])
+        return c.rowcount
+
+
+    def flush(self):
+        """
+        Write everything queued by L{put} in write-behind mode now.
+        
+        @return: A C{Deferred} that fires once it's all committed.
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return defer.succeed(None)
+        
+        def written(results):
+            for (data, d), result in zip(pending, results):
+                d.callback(result)
+        def failed(err):
+            for data, d in pending:
+                d.errback(err)
+        d = self.pool.runInteraction(self._putMany, [x[0] for x in pending])
+        return d.addCallbacks(written, failed)
+
+
+    def _put(self, c, data):
+        """
+        Put data in the database using cursor C{c}.
+        """
+        hash = valueHash(data.value)
+        c.execute('insert or ignore into blobs (hash, value) values (?, ?)',
+                  (hash, data.value))
+        args = (data.entity, data.name, data.version, data.lineage, hash)
+        if _HAS_UPSERT:
+            # the update (and so the count of changed rows) is skipped when
+            # the value hasn't changed.
+            c.execute('''insert into data
+                (entity, name, version, lineage, hash)
+                values (?, ?, ?, ?, ?)
+                on conflict (entity, name, version, lineage)
+                do update set hash = excluded.hash
+                where hash is not excluded.hash''', args)
+            return {'changed': c.rowcount > 0}
+        
+        c.execute('''select hash from data where
+            entity = ?
+            and name = ?
+            and version = ?
+            and lineage = ?''', args[:4])
+        result = c.fetchone()
+        changed = True
+        if not result:
+            c.execute('''insert into data
+                (entity, name, version, lineage, hash)
+                values (?, ?, ?, ?, ?)''', args)
+        else:
+            changed = result[0] != hash
+            c.execute('''update data
+                set hash=?
+                where
+                    entity = ?
+                    and name = ?
+                    and version = ?
+                    and lineage = ?''', args[4:] + args[:4])
+        return {'changed': changed}
 
 
     def _donePutting(self, result):
@@ -97,7 +334,7 @@ class SqliteStore(object):
 
 
     def get(self, entity, name=None, version=None, lineage=None):
-        qry = 'select entity, name, version, lineage, value from data'
+        qry = _SELECT_DATA
         wheres = ['entity = ?']
         args = [entity]
         if name:
@@ -110,13 +347,123 @@ class SqliteStore(object):
             wheres.append('lineage = ?')
             args.append(lineage)
         qry = qry + ' where ' + ' AND '.join(wheres)
-        return self.runQuery(qry, tuple(args)).addCallback(self._gotData)
+        return self.runReadQuery(qry, tuple(args)).addCallback(self._gotData)
 
 
     def _gotData(self, data):
         return [Data(*x) for x in data]
 
 
+    def getPage(self, entity, name=None, version=None, after=None,
+                limit=100):
+        """
+        Pages are in the order the data was first put, and the cursor is
+        the row id of the last one.
+        """
+        qry = _SELECT_DATA.replace('select ', 'select data.id, ', 1)
+        wheres = ['entity = ?']
+        args = [entity]
+        if name:
+            wheres.append('name = ?')
+            args.append(name)
+        if version:
+            wheres.append('version = ?')
+            args.append(version)
+        if after is not None:
+            wheres.append('data.id > ?')
+            args.append(int(after))
+        # one more than asked for, to know if there's another page
+        qry += ' where ' + ' AND '.join(wheres) + ' order by data.id limit ?'
+        args.append(limit + 1)
+        d = self.runReadQuery(qry, tuple(args))
+        return d.addCallback(self._gotPage, limit)
+
+
+    def _gotPage(self, rows, limit):
+        cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cursor = str(rows[-1][0])
+        return [Data(*x[1:]) for x in rows], cursor
+
+
+    def getMany(self, entity, keys):
+        return self.getManyEntities([(entity,) + tuple(x) for x in keys])
+
+
+    def getManyEntities(self, keys):
+        if not keys:
+            return defer.succeed([])
+        return self.runReadInteraction(self._getManyEntities, keys)
+
+
+    def _getManyEntities(self, c, keys, chunk_size=200):
+        """
+        Get the data for all C{keys} with as few queries as possible (there's
+        a limit to how many parameters a query can have).
+        """
+        found = {}
+        for i in xrange(0, len(keys), chunk_size):
+            wheres = []
+            args = []
+            for key in keys[i:i + chunk_size]:
+                if len(key) == 3:
+                    wheres.append('(entity = ? and name = ? and version = ?)')
+                else:
+                    wheres.append('(entity = ? and name = ? and version = ?'
+                                  ' and lineage = ?)')
+                args.extend(key)
+            c.execute(_SELECT_DATA + ' where ' + ' or '.join(wheres),
+                      tuple(args))
+            for row in c.fetchall():
+                if tuple(row[:4]) in found:
+                    # already found by an overlapping key in another chunk
+                    continue
+                data = Data(*row)
+                found.setdefault(tuple(row[:3]), []).append(data)
+                found[tuple(row[:4])] = [data]
+        return [list(found.get(tuple(x), [])) for x in keys]
+
+
+    def getHashes(self, entity, keys):
+        if not keys:
+            return defer.succeed([])
+        return self.runReadInteraction(self._getHashes, entity, keys)
+
+
+    def _getHashes(self, c, entity, keys, chunk_size=300):
+        found = {}
+        for i in xrange(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            wheres = ['(name = ? and version = ? and lineage = ?)'] * len(chunk)
+            args = [entity]
+            for key in chunk:
+                args.extend(key)
+            c.execute('select name, version, lineage, hash from data '
+                      'where entity = ? and (' + ' or '.join(wheres) + ')',
+                      tuple(args))
+            for name, version, lineage, hash in c.fetchall():
+                found[(name, version, lineage)] = hash
+        return [found.get(tuple(x)) for x in keys]
+
+
+    def entities(self, name=None, version=None):
+        qry = 'select distinct entity from data'
+        wheres = []
+        args = []
+        if name:
+            wheres.append('name = ?')
+            args.append(name)
+        if version:
+            wheres.append('version = ?')
+            args.append(version)
+        if wheres:
+            qry = qry + ' where ' + ' AND '.join(wheres)
+        qry = qry + ' order by entity'
+        d = self.runReadQuery(qry, tuple(args))
+        return d.addCallback(lambda rows: [x[0] for x in rows])
+
+
 
 class InMemoryStore(object):
     """
@@ -127,30 +474,1013 @@ class InMemoryStore(object):
 
 
     def __init__(self):
+        # entity -> (name, version) -> lineage -> value
         self._data = {}
+        # (entity, name, version, lineage) -> hash of value
+        self._hashes = {}
+        self._sorted = _SortedKeys()
 
 
-    def _matchKey(self, key, entity, name=None, version=None, lineage=None):
-        if key[0] != entity:
-            return False
-        if name is not None and key[1] != name:
-            return False
-        if version is not None and key[2] != version:
-            return False
-        if lineage is not None and key[3] != lineage:
-            return False
-        return True
+    def _matching(self, entity, name=None, version=None, lineage=None):
+        """
+        Get the stored data matching the given parameters.
+        
+        @return: A list of tuples C{(name, version, lineage, value)}.
+        """
+        by_name = self._data.get(entity)
+        if not by_name:
+            return []
+        if name is not None and version is not None:
+            keys = [(name, version)] if (name, version) in by_name else []
+        else:
+            keys = [x for x in by_name
+                    if (name is None or x[0] == name)
+                    and (version is None or x[1] == version)]
+        ret = []
+        for key in keys:
+            by_lineage = by_name[key]
+            if lineage is None:
+                ret.extend([key + x for x in sorted(by_lineage.iteritems())])
+            elif lineage in by_lineage:
+                ret.append(key + (lineage, by_lineage[lineage]))
+        return ret
 
 
     def get(self, entity, name=None, version=None, lineage=None):
-        keys = [x for x in self._data if self._matchKey(x, entity, name, version, lineage)]
-        return defer.succeed([Data(*k + (self._data[k],)) for k in keys])
+        return defer.succeed([Data(entity, *x) for x in
+                              self._matching(entity, name, version, lineage)])
+
+
+    def getPage(self, entity, name=None, version=None, after=None,
+                limit=100):
+        """
+        Pages are in order of C{(name, version, lineage)}.
+        """
+        keys = self._sorted.keys(entity, self._data.get(entity, {}))
+        keys = _pageKeys(keys, name, version, after, limit)
+        page = [Data(entity, *x + (self._data[entity][x[:2]][x[2]],))
+                for x in keys[:limit]]
+        return defer.succeed((page, _pageCursor(keys, limit)))
+
+
+    def getMany(self, entity, keys):
+        return self.getManyEntities([(entity,) + tuple(x) for x in keys])
+
+
+    def getManyEntities(self, keys):
+        ret = []
+        for key in keys:
+            ret.append([Data(key[0], *x) for x in self._matching(*key)])
+        return defer.succeed(ret)
 
 
     def put(self, data):
+        return defer.succeed(self._put(data))
+
+
+    def putMany(self, data_list):
+        return defer.succeed([self._put(data) for data in data_list])
+
+
+    def _put(self, data):
         entity, name, version, lineage, value = data
-        old_value = self._data.get((entity, name, version, lineage), None)
+        by_lineage = self._data.setdefault(entity, {}).setdefault(
+            (name, version), {})
+        if lineage not in by_lineage:
+            self._sorted.added(entity, (name, version, lineage))
+        old_value = by_lineage.get(lineage, None)
         changed = value != old_value
-        self._data[(entity, name, version, lineage)] = value
-        return defer.succeed({'changed': changed})
+        by_lineage[lineage] = value
+        if changed:
+            self._hashes[(entity, name, version, lineage)] = valueHash(value)
+        return {'changed': changed}
+
+
+    def delete(self, entity, keys):
+        by_name = self._data.get(entity, {})
+        count = 0
+        for name, version, lineage in keys:
+            by_lineage = by_name.get((name, version), {})
+            if lineage not in by_lineage:
+                continue
+            del by_lineage[lineage]
+            del self._hashes[(entity, name, version, lineage)]
+            self._sorted.removed(entity, (name, version, lineage))
+            count += 1
+            if not by_lineage:
+                del by_name[(name, version)]
+        if not by_name:
+            self._data.pop(entity, None)
+        return defer.succeed(count)
+
+
+    def getHashes(self, entity, keys):
+        return defer.succeed([self._hashes.get((entity,) + tuple(x))
+                              for x in keys])
+
+
+    def entities(self, name=None, version=None):
+        entities = []
+        for entity, by_name in self._data.iteritems():
+            for key in by_name:
+                if (name is None or key[0] == name) and \
+                        (version is None or key[1] == version):
+                    entities.append(entity)
+                    break
+        return defer.succeed(sorted(entities))
+
+
+
+@defer.inlineCallbacks
+def eachPage(store, entity, func, name=None, version=None, limit=100):
+    """
+    Call C{func} with each page of an entity's data in C{store} (see
+    L{IDataStore.getPage}), one page at a time.  If C{func} returns a
+    C{Deferred}, the next page isn't fetched until it fires.  If it returns
+    (or its C{Deferred} fires with) C{False}, no more pages are fetched.
+    
+    @return: A C{Deferred} that fires with the number of data points handed
+        to C{func}.
+    """
+    count = 0
+    after = None
+    while True:
+        page, after = yield store.getPage(entity, name, version, after, limit)
+        count += len(page)
+        if page:
+            result = yield func(page)
+            if result is False:
+                break
+        if after is None:
+            break
+    defer.returnValue(count)
+
+
+
+class _SortedKeys(object):
+    """
+    I keep the C{(name, version, lineage)}s of each entity's data in a
+    mapping like L{InMemoryStore}'s in order, for paging through.  An
+    entity's keys are sorted the first time they're asked for, and kept in
+    order after that as data is added and deleted.
+    """
+
+
+    def __init__(self):
+        self._keys = {}
+
+
+    def keys(self, entity, by_name):
+        """
+        Get the sorted keys of C{entity}, whose data is in C{by_name}.
+        """
+        keys = self._keys.get(entity)
+        if keys is None:
+            keys = []
+            for key, by_lineage in by_name.iteritems():
+                keys.extend([key + (x,) for x in by_lineage])
+            keys.sort()
+            self._keys[entity] = keys
+        return keys
+
+
+    def added(self, entity, key):
+        keys = self._keys.get(entity)
+        if keys is not None:
+            bisect.insort(keys, key)
+
+
+    def removed(self, entity, key):
+        keys = self._keys.get(entity)
+        if keys is None:
+            return
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+        if not keys:
+            del self._keys[entity]
+
+
+
+def _pageKeys(keys, name, version, after, limit):
+    """
+    Get the C{(name, version, lineage)}s for a page of an entity's data (and
+    the one after it, if there is one) from all of its keys, sorted.
+    """
+    start = 0
+    if name is not None:
+        prefix = (name,) if version is None else (name, version)
+        start = bisect.bisect_left(keys, prefix)
+    if after is not None:
+        start = max(start, bisect.bisect_right(keys, tuple(json.loads(after))))
+    ret = []
+    for i in xrange(start, len(keys)):
+        key = keys[i]
+        if name is not None and key[0] != name:
+            break
+        if version is not None and key[1] != version:
+            if name is not None:
+                break
+            continue
+        ret.append(key)
+        if len(ret) > limit:
+            break
+    return ret
+
+
+
+def _pageCursor(keys, limit):
+    if len(keys) <= limit:
+        return None
+    return json.dumps(keys[limit - 1])
+
+
+
+class _Segment(object):
+    """
+    One file of a L{LogStore}, memory mapped.
+    
+    @ivar key: C{(number, part)}.  Segments are replayed in order of their
+        keys.
+    @ivar end: Where the next record will go.
+    @ivar garbage: Bytes of records that have been superseded.
+    """
+    
+    end = 0
+    garbage = 0
+
+
+    def __init__(self, path, key, size=None):
+        """
+        Open the segment at C{path}, or if C{size} is given, create it with
+        room for C{size} bytes of records.
+        """
+        self.path = path
+        self.key = key
+        if size is not None:
+            self.file = open(path, 'w+b')
+            self.file.truncate(size)
+        else:
+            self.file = open(path, 'r+b')
+        self.map = None
+        self._map()
+
+
+    def _map(self):
+        self.file.seek(0, 2)
+        if self.file.tell():
+            self.map = mmap.mmap(self.file.fileno(), 0)
+
+
+    def records(self):
+        """
+        Read the records in me, stopping at the first one that is incomplete
+        or corrupt.
+        
+        @return: An iterator of tuples C{(offset, size, entity, name,
+            version, lineage, value length, hash)}.  The value length is
+            C{None} for a record of a deletion.
+        """
+        m = self.map
+        if m is None:
+            return
+        offset = 0
+        length = len(m)
+        header_size = _RECORD.size
+        while offset + header_size <= length:
+            fields = _RECORD.unpack_from(m, offset)
+            crc, lengths, hash = fields[0], fields[1:6], fields[6]
+            if not crc and not any(lengths):
+                break
+            value_len = lengths[4]
+            if value_len == _TOMBSTONE:
+                value_len = None
+            size = header_size + sum(lengths[:4]) + (value_len or 0)
+            if offset + size > length:
+                break
+            if zlib.crc32(m[offset + 4:offset + size]) & 0xffffffff != crc:
+                break
+            start = offset + header_size
+            keys = []
+            for x in lengths[:4]:
+                keys.append(m[start:start + x].decode('utf-8'))
+                start += x
+            yield (offset, size) + tuple(keys) + (value_len, hash)
+            offset += size
+        self.end = offset
+
+
+    def append(self, record):
+        """
+        Write C{record} after the others.
+        
+        @return: The offset it was written at, or C{None} if there isn't room
+            for it.
+        """
+        offset = self.end
+        if self.map is None or offset + len(record) > len(self.map):
+            return None
+        self.map[offset:offset + len(record)] = record
+        self.end += len(record)
+        return offset
+
+
+    def read(self, offset, size):
+        return self.map[offset:offset + size]
+
+
+    def seal(self):
+        """
+        Cut off the unused end of the file.
+        """
+        self.close()
+        self.file = open(self.path, 'r+b')
+        self.file.truncate(self.end)
+        self._map()
+
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+
+class LogStore(object):
+    """
+    I store data by appending it to log files (segments) in the directory
+    C{path}, and keep an index of where the latest value for each C{(entity,
+    name, version, lineage)} is in memory.  Values are read from the
+    segments through C{mmap}.
+    
+    When I'm opened, the segments are replayed to rebuild the index, and a
+    new segment is started.  Each new segment has room for C{segment_size}
+    bytes; once it's full, another is started.
+    
+    Superseded records are garbage.  L{compact} rewrites the live records
+    from all but the newest segment into new segments and deletes the old
+    ones; if C{compact_interval} is given, that's done every that many
+    seconds when at least C{compact_ratio} of what I've written is garbage.
+    """
+    
+    implements(IDataStore)
+
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, sync=False,
+                 compact_interval=None, compact_ratio=0.5, reactor=reactor):
+        """
+        @param path: Directory for the segments.  It's made if it doesn't
+            exist.
+        
+        @param sync: If C{True}, data is flushed to disk before each
+            C{put} or C{putMany} returns.
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self.sync = sync
+        self.compact_ratio = compact_ratio
+        self.reactor = reactor
+        # entity -> (name, version) -> lineage -> (segment, offset, size,
+        # value length, hash)
+        self._index = {}
+        self._sorted = _SortedKeys()
+        self._segments = []
+        self._compacting = None
+        self._cooperator = task.Cooperator(
+            scheduler=lambda x: reactor.callLater(0, x))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._replay()
+        self._active = self._newSegment((self._nextNumber(), 0))
+        
+        self._compact_call = None
+        if compact_interval:
+            self._compact_call = task.LoopingCall(self._maybeCompact)
+            self._compact_call.clock = reactor
+            self._compact_call.start(compact_interval, now=False)
+
+
+    def _segmentPath(self, key):
+        return os.path.join(self.path, '%08d-%04d.seg' % key)
+
+
+    def _replay(self):
+        keys = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.seg'):
+                continue
+            try:
+                keys.append(tuple([int(x) for x in name[:-4].split('-')]))
+            except ValueError:
+                continue
+        for key in sorted(keys):
+            segment = _Segment(self._segmentPath(key), key)
+            for record in segment.records():
+                self._indexRecord(segment, record)
+            if not segment.end:
+                segment.close()
+                os.remove(segment.path)
+                continue
+            if segment.end < len(segment.map):
+                log.msg('Ignoring %d bytes at the end of %s' % (
+                        len(segment.map) - segment.end, segment.path))
+                segment.seal()
+            self._segments.append(segment)
+
+
+    def _nextNumber(self):
+        if not self._segments:
+            return 0
+        return self._segments[-1].key[0] + 1
+
+
+    def _newSegment(self, key, size=None):
+        size = max(size or 0, self.segment_size)
+        segment = _Segment(self._segmentPath(key), key, size)
+        self._segments.append(segment)
+        self._segments.sort(key=lambda x: x.key)
+        return segment
+
+
+    def _indexRecord(self, segment, record):
+        """
+        Point the index at C{record}, which has just been read from or
+        written to C{segment}.
+        """
+        offset, size, entity, name, version, lineage, value_len, hash = record
+        by_name = self._index.setdefault(entity, {})
+        by_lineage = by_name.setdefault((name, version), {})
+        old = by_lineage.get(lineage)
+        if old is not None:
+            old[0].garbage += old[2]
+        if value_len is not None:
+            if old is None:
+                self._sorted.added(entity, (name, version, lineage))
+            by_lineage[lineage] = (segment, offset, size, value_len, hash)
+            return
+        
+        # a deletion is only needed until what it deletes is compacted away
+        segment.garbage += size
+        if old is not None:
+            self._sorted.removed(entity, (name, version, lineage))
+        by_lineage.pop(lineage, None)
+        if not by_lineage:
+            del by_name[(name, version)]
+        if not by_name:
+            del self._index[entity]
+
+
+    def _value(self, entry):
+        segment, offset, size, value_len, hash = entry
+        return segment.read(offset + size - value_len,
+                            value_len).decode('utf-8')
+
+
+    def _matching(self, entity, name=None, version=None, lineage=None):
+        """
+        Get the data matching the given parameters.
+        """
+        by_name = self._index.get(entity)
+        if not by_name:
+            return []
+        if name is not None and version is not None:
+            keys = [(name, version)] if (name, version) in by_name else []
+        else:
+            keys = [x for x in by_name
+                    if (name is None or x[0] == name)
+                    and (version is None or x[1] == version)]
+        ret = []
+        for key in keys:
+            by_lineage = by_name[key]
+            if lineage is None:
+                lineages = sorted(by_lineage)
+            elif lineage in by_lineage:
+                lineages = [lineage]
+            else:
+                continue
+            for x in lineages:
+                ret.append(Data(entity, key[0], key[1], x,
+                                self._value(by_lineage[x])))
+        return ret
+
+
+    def get(self, entity, name=None, version=None, lineage=None):
+        return defer.succeed(self._matching(entity, name, version, lineage))
+
+
+    def getPage(self, entity, name=None, version=None, after=None,
+                limit=100):
+        """
+        Pages are in order of C{(name, version, lineage)}.
+        """
+        by_name = self._index.get(entity, {})
+        keys = _pageKeys(self._sorted.keys(entity, by_name), name, version,
+                         after, limit)
+        page = [Data(entity, *x + (self._value(by_name[x[:2]][x[2]]),))
+                for x in keys[:limit]]
+        return defer.succeed((page, _pageCursor(keys, limit)))
+
+
+    def getMany(self, entity, keys):
+        return self.getManyEntities([(entity,) + tuple(x) for x in keys])
+
+
+    def getManyEntities(self, keys):
+        return defer.succeed([self._matching(*key) for key in keys])
+
+
+    def put(self, data):
+        return self.putMany([data]).addCallback(lambda x: x[0])
+
+
+    def putMany(self, data_list):
+        ret = [self._put(data) for data in data_list]
+        if self.sync:
+            self._active.map.flush()
+        return defer.succeed(ret)
+
+
+    def _put(self, data):
+        entity, name, version, lineage, value = data
+        hash = valueHash(value)
+        old = self._index.get(entity, {}).get((name, version), {}).get(lineage)
+        if old is not None and old[4] == hash:
+            return {'changed': False}
+        self._append(entity, name, version, lineage, value, hash)
+        return {'changed': True}
+
+
+    def delete(self, entity, keys):
+        by_name = self._index.get(entity, {})
+        count = 0
+        for name, version, lineage in keys:
+            if lineage in by_name.get((name, version), {}):
+                self._append(entity, name, version, lineage, None, '')
+                count += 1
+        if self.sync:
+            self._active.map.flush()
+        return defer.succeed(count)
+
+
+    def _append(self, entity, name, version, lineage, value, hash):
+        """
+        Write a record to the active segment (or a new one if it's full) and
+        index it.  A C{value} of C{None} records a deletion.
+        """
+        fields = [x.encode('utf-8') if isinstance(x, unicode) else x
+                  for x in (entity, name, version, lineage, value or '')]
+        lengths = [len(x) for x in fields]
+        value_len = lengths[4]
+        if value is None:
+            lengths[4] = _TOMBSTONE
+            value_len = None
+        body = ''.join(fields)
+        header = _RECORD.pack(0, *(lengths + [hash]))[4:]
+        crc = zlib.crc32(header + body) & 0xffffffff
+        record = struct.pack('<I', crc) + header + body
+        
+        offset = self._active.append(record)
+        if offset is None:
+            self._active.seal()
+            self._active = self._newSegment((self._nextNumber(), 0),
+                                            len(record))
+            offset = self._active.append(record)
+        self._indexRecord(self._active, (offset, len(record), entity, name,
+                                         version, lineage, value_len, hash))
+
+
+    def getHashes(self, entity, keys):
+        by_name = self._index.get(entity, {})
+        ret = []
+        for name, version, lineage in keys:
+            entry = by_name.get((name, version), {}).get(lineage)
+            ret.append(entry[4] if entry is not None else None)
+        return defer.succeed(ret)
+
+
+    def entities(self, name=None, version=None):
+        entities = []
+        for entity, by_name in self._index.iteritems():
+            for key in by_name:
+                if (name is None or key[0] == name) and \
+                        (version is None or key[1] == version):
+                    entities.append(entity)
+                    break
+        return defer.succeed(sorted(entities))
+
+
+    def size(self):
+        """
+        Bytes of records in all my segments.
+        """
+        return sum([x.end for x in self._segments])
+
+
+    def garbage(self):
+        """
+        Bytes of superseded records in all my segments.
+        """
+        return sum([x.garbage for x in self._segments])
+
+
+    def _maybeCompact(self):
+        size = self.size()
+        if size and self.garbage() >= size * self.compact_ratio:
+            return self.compact()
+
+
+    def compact(self):
+        """
+        Copy the live records out of all the segments but the one being
+        written to, and delete them.  This is done a bit at a time, and
+        data can be put while it's happening.
+        
+        @return: A C{Deferred} that fires when it's done, or when it's
+            abandoned by L{close}.
+        """
+        if self._compacting is not None:
+            return self._compacting
+        old = list(self._segments)
+        self._active.seal()
+        self._active = self._newSegment((self._nextNumber(), 0))
+        d = self._cooperator.cooperate(self._copyLive(old)).whenDone()
+        self._compacting = d
+        
+        def done(result):
+            self._compacting = None
+            return result
+        def abandoned(err):
+            # by close
+            err.trap(task.SchedulerStopped)
+        d.addBoth(done)
+        return d.addErrback(abandoned)
+
+
+    def _copyLive(self, segments, batch=100):
+        """
+        Copy the records in C{segments} that are still in the index into new
+        segments, then delete C{segments}.
+        """
+        number = segments[-1].key[0]
+        part = 1
+        out = self._newSegment((number, part))
+        count = 0
+        for segment in segments:
+            for record in segment.records():
+                offset, size, entity, name, version, lineage = record[:6]
+                by_lineage = self._index.get(entity, {}).get((name, version),
+                                                             {})
+                entry = by_lineage.get(lineage)
+                if entry is None or entry[0] is not segment \
+                        or entry[1] != offset:
+                    continue
+                raw = segment.read(offset, size)
+                new_offset = out.append(raw)
+                if new_offset is None:
+                    out.seal()
+                    part += 1
+                    out = self._newSegment((number, part), size)
+                    new_offset = out.append(raw)
+                by_lineage[lineage] = (out,) + (new_offset,) + entry[2:]
+                count += 1
+                if count % batch == 0:
+                    yield None
+        out.seal()
+        for segment in segments:
+            segment.close()
+            os.remove(segment.path)
+            self._segments.remove(segment)
+
+
+    def flush(self):
+        """
+        Flush what's been written to disk.
+        """
+        self._active.map.flush()
+        return defer.succeed(None)
+
+
+    def close(self):
+        """
+        Stop compacting and close all the segments.  A compaction that's in
+        progress is abandoned; it's safe to start again later.
+        """
+        if self._compact_call is not None and self._compact_call.running:
+            self._compact_call.stop()
+        self._cooperator.stop()
+        self._active.seal()
+        for segment in self._segments:
+            segment.close()
+        self._segments = []
+
+
+
+class CachingStore(object):
+    """
+    I keep recently used data from another L{IDataStore} in memory.
+    
+    Data is cached for each C{(entity, name, version)}, all lineages
+    together, so only C{get}s that give at least a name and version are
+    served from the cache -- which is how the L{WorkMaker} asks.  Everything
+    I C{put} is written through to the other store, and then updated in the
+    cache if it's there.
+    
+    @ivar hits: Number of C{(entity, name, version)}s served from the cache.
+    @ivar misses: Number that had to be fetched from the other store.
+    """
+    
+    implements(IDataStore)
+    
+    hits = 0
+    misses = 0
+    
+    policies = {
+        'lru': LRUCache,
+        'lfu': LFUCache,
+    }
+
+
+    def __init__(self, store, max_entries=None, max_bytes=None, policy='lru'):
+        """
+        @param store: The L{IDataStore} to cache.
+        
+        @param max_entries: Most C{(entity, name, version)}s to cache.
+        @param max_bytes: Most bytes of values to cache.
+        
+        @param policy: Which to forget first when the cache is full: C{'lru'}
+            for the least recently used or C{'lfu'} for the least frequently
+            used.
+        """
+        if policy not in self.policies:
+            raise ValueError("Unknown cache policy: %r" % (policy,))
+        self.store = store
+        self.cache = self.policies[policy](max_entries, max_bytes,
+                                           self._sizeOf)
+        # (entity, name, version) -> list of fetches in progress, each a list
+        # that's emptied if the fetch becomes stale.
+        self._fetching = {}
+
+
+    def _sizeOf(self, data_list):
+        return sum([len(x.value) for x in data_list])
+
+
+    def get(self, entity, name=None, version=None, lineage=None):
+        if name is None or version is None:
+            return self.store.get(entity, name, version, lineage)
+        key = (entity, name, version)
+        if lineage is not None:
+            key += (lineage,)
+        return self.getManyEntities([key]).addCallback(lambda x: x[0])
+
+
+    def getPage(self, entity, name=None, version=None, after=None,
+                limit=100):
+        return self.store.getPage(entity, name, version, after, limit)
+
+
+    def getMany(self, entity, keys):
+        return self.getManyEntities([(entity,) + tuple(x) for x in keys])
+
+
+    def getManyEntities(self, keys):
+        found = {}
+        missing = []
+        for key in keys:
+            key = tuple(key[:3])
+            if key in found:
+                continue
+            data_list = self.cache.get(key)
+            if data_list is None:
+                if key not in missing:
+                    missing.append(key)
+            else:
+                found[key] = data_list
+        self.hits += len(found)
+        self.misses += len(missing)
+        if not missing:
+            return defer.succeed(self._select(keys, found))
+        
+        fetches = []
+        for key in missing:
+            fetch = [True]
+            self._fetching.setdefault(key, []).append(fetch)
+            fetches.append(fetch)
+        if len(missing) == 1:
+            d = self.store.get(*missing[0]).addCallback(lambda x: [x])
+        else:
+            d = self.store.getManyEntities(missing)
+        d.addBoth(self._fetched, missing, fetches)
+        d.addCallback(self._gotFetched, keys, found, missing, fetches)
+        return d
+
+
+    def _fetched(self, result, missing, fetches):
+        for key, fetch in zip(missing, fetches):
+            in_progress = self._fetching[key]
+            in_progress.remove(fetch)
+            if not in_progress:
+                del self._fetching[key]
+        return result
+
+
+    def _gotFetched(self, results, keys, found, missing, fetches):
+        for key, fetch, data_list in zip(missing, fetches, results):
+            found[key] = data_list
+            if fetch:
+                self.cache[key] = data_list
+        return self._select(keys, found)
+
+
+    def _select(self, keys, found):
+        """
+        Pick the data for each of C{keys} out of the data for their C{(entity,
+        name, version)}s.
+        """
+        ret = []
+        for key in keys:
+            data_list = found[tuple(key[:3])]
+            if len(key) > 3:
+                data_list = [x for x in data_list if x.lineage == key[3]]
+            ret.append(list(data_list))
+        return ret
+
+
+    def put(self, data):
+        return self.store.put(data).addCallback(self._stored, [data])
+
+
+    def putMany(self, data_list):
+        return self.store.putMany(data_list).addCallback(self._stored,
+                                                         data_list)
+
+
+    def _stored(self, result, data_list):
+        for data in data_list:
+            key = (data.entity, data.name, data.version)
+            for fetch in self._fetching.get(key, []):
+                # it may have been fetched before this was stored
+                del fetch[:]
+            cached = self.cache.get(key)
+            if cached is None:
+                continue
+            cached = [x for x in cached if x.lineage != data.lineage]
+            cached.append(Data(*data))
+            self.cache[key] = cached
+        return result
+
+
+    def delete(self, entity, keys):
+        return self.store.delete(entity, keys).addCallback(self._deleted,
+                                                           entity, keys)
+
+
+    def _deleted(self, result, entity, keys):
+        for name, version, lineage in keys:
+            key = (entity, name, version)
+            for fetch in self._fetching.get(key, []):
+                del fetch[:]
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache[key] = [x for x in cached if x.lineage != lineage]
+        return result
+
+
+    def getHashes(self, entity, keys):
+        return self.store.getHashes(entity, keys)
+
+
+    def entities(self, name=None, version=None):
+        return self.store.entities(name, version)
+
+
+    def flush(self):
+        """
+        Flush the other store, if it can be flushed.
+        """
+        flush = getattr(self.store, 'flush', None)
+        if flush is None:
+            return defer.succeed(None)
+        return flush()
+
+
+
+class ShardedStore(object):
+    """
+    I split data between several L{IDataStore}s (shards) by entity, so each
+    entity's data is all in one shard.  With a L{SqliteStore} for each shard,
+    each in its own file, writes to different shards happen in parallel.
+    
+    Which shard an entity belongs to depends on how many shards there are,
+    so don't change that for an existing set of stores.
+    """
+    
+    implements(IDataStore)
+
+
+    def __init__(self, stores):
+        self.stores = list(stores)
+
+
+    def shardFor(self, entity):
+        """
+        Get the store that C{entity}'s data is in.
+        """
+        if isinstance(entity, unicode):
+            entity = entity.encode('utf-8')
+        return self.stores[(zlib.crc32(entity) & 0xffffffff) % len(self.stores)]
+
+
+    def _split(self, items, entity_of):
+        """
+        Group C{items} by the shard they belong in.
+        
+        @return: A list of C{(store, indexes of its items, its items)}.
+        """
+        by_store = {}
+        ret = []
+        for i, item in enumerate(items):
+            store = self.shardFor(entity_of(item))
+            group = by_store.get(id(store))
+            if group is None:
+                group = by_store[id(store)] = (store, [], [])
+                ret.append(group)
+            group[1].append(i)
+            group[2].append(item)
+        return ret
+
+
+    def _gather(self, groups, size, method):
+        """
+        Call C{method} on each group's store with its items, and put the
+        results back in the order of the items they were split from.
+        """
+        def gotResults(results):
+            ret = [None] * size
+            for (store, indexes, items), result in zip(groups, results):
+                for i, x in zip(indexes, result):
+                    ret[i] = x
+            return ret
+        d = defer.gatherResults([getattr(store, method)(items)
+                                 for store, indexes, items in groups],
+                                consumeErrors=True)
+        return d.addCallback(gotResults).addErrback(_unwrapFirstError)
+
+
+    def get(self, entity, name=None, version=None, lineage=None):
+        return self.shardFor(entity).get(entity, name, version, lineage)
+
+
+    def getPage(self, entity, name=None, version=None, after=None,
+                limit=100):
+        return self.shardFor(entity).getPage(entity, name, version, after,
+                                             limit)
+
+
+    def getMany(self, entity, keys):
+        return self.shardFor(entity).getMany(entity, keys)
+
+
+    def getManyEntities(self, keys):
+        groups = self._split(keys, lambda x: x[0])
+        return self._gather(groups, len(keys), 'getManyEntities')
+
+
+    def put(self, data):
+        return self.shardFor(data.entity).put(data)
+
+
+    def putMany(self, data_list):
+        groups = self._split(data_list, lambda x: x.entity)
+        return self._gather(groups, len(data_list), 'putMany')
+
+
+    def delete(self, entity, keys):
+        return self.shardFor(entity).delete(entity, keys)
+
+
+    def getHashes(self, entity, keys):
+        return self.shardFor(entity).getHashes(entity, keys)
+
+
+    def entities(self, name=None, version=None):
+        d = defer.gatherResults([x.entities(name, version)
+                                 for x in self.stores], consumeErrors=True)
+        d.addErrback(_unwrapFirstError)
+        return d.addCallback(lambda results: sorted(sum(results, [])))
+
+
+    def flush(self):
+        """
+        Flush all the shards that can be flushed.
+        """
+        return defer.gatherResults([x.flush() for x in self.stores
+                                    if hasattr(x, 'flush')])
+
+
 
+def _unwrapFirstError(err):
+    err.trap(defer.FirstError)
+    return err.value.subFailure
@@ -0,0 +1,194 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, task
+from twisted.python.filepath import FilePath
+
+from garden.backfill import Backfill
+from garden.store import InMemoryStore
+from garden.path import Garden
+from garden.data import Data
+
+
+
+class FakeGardener(object):
+
+
+    def __init__(self, garden):
+        self.garden = garden
+        self.called = []
+        self.pending = []
+        self.fail_for = set()
+
+
+    def doPossibleWork(self, entity, name, version):
+        self.called.append((entity, name, version))
+        if entity in self.fail_for:
+            return defer.fail(Exception('foo'))
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+
+    def finish(self):
+        pending, self.pending = self.pending, []
+        for d in pending:
+            d.callback('done')
+
+
+
+class BackfillTest(TestCase):
+
+
+    def setUp(self):
+        self.garden = Garden()
+        self.garden.addPath('cake', '1', [
+            ('eggs', '1'),
+            ('flour', '1'),
+        ])
+        self.garden.addPath('cake', '1', [
+            ('mix', '1'),
+        ])
+        self.store = InMemoryStore()
+        self.gardener = FakeGardener(self.garden)
+
+
+    def put(self, entity, name):
+        self.store.put(Data(entity, name, '1', 'xxxx', 'value'))
+
+
+    def test_entitiesNeeded(self):
+        """
+        Only entities that have all the inputs of at least one path need to be
+        backfilled.
+        """
+        self.put('a', 'eggs')
+        self.put('b', 'eggs')
+        self.put('b', 'flour')
+        self.put('c', 'mix')
+        self.put('d', 'flour')
+        self.put('e', 'cake')
+
+        b = Backfill(self.gardener, self.store, 'cake', '1')
+        self.assertEqual(self.successResultOf(b.entitiesNeeded()), ['b', 'c'])
+
+
+    def test_run(self):
+        """
+        Work is done in batches no bigger than the concurrency, and progress
+        is reported after each batch.
+        """
+        for entity in 'abcde':
+            self.put(entity, 'mix')
+        progress = []
+        b = Backfill(self.gardener, self.store, 'cake', '1', concurrency=2,
+                     progress=lambda *a: progress.append(a))
+        d = b.run()
+        self.assertEqual(self.gardener.called, [
+            ('a', 'cake', '1'),
+            ('b', 'cake', '1'),
+        ])
+        self.gardener.finish()
+        self.assertEqual(progress, [(2, 5)])
+        self.assertEqual(len(self.gardener.called), 4)
+        self.gardener.finish()
+        self.assertNoResult(d)
+        self.gardener.finish()
+        self.assertEqual(self.gardener.called[-1], ('e', 'cake', '1'))
+        self.assertEqual(progress, [(2, 5), (4, 5), (5, 5)])
+        self.assertEqual(self.successResultOf(d), 5)
+
+
+    def test_delay(self):
+        """
+        You can wait a while between batches.
+        """
+        for entity in 'abc':
+            self.put(entity, 'mix')
+        clock = task.Clock()
+        b = Backfill(self.gardener, self.store, 'cake', '1', concurrency=2,
+                     delay=5, reactor=clock)
+        d = b.run()
+        self.gardener.finish()
+        self.assertEqual(len(self.gardener.called), 2)
+        clock.advance(5)
+        self.assertEqual(len(self.gardener.called), 3)
+        self.gardener.finish()
+        self.assertEqual(self.successResultOf(d), 3)
+
+
+    def test_checkpoint(self):
+        """
+        A backfill started with the checkpoint of one that was stopped picks up
+        where the first one left off.
+        """
+        for entity in 'abcde':
+            self.put(entity, 'mix')
+        checkpoint = FilePath(self.mktemp())
+        b = Backfill(self.gardener, self.store, 'cake', '1', concurrency=2,
+                     checkpoint=checkpoint)
+        d = b.run()
+        b.stop()
+        self.gardener.finish()
+        self.assertEqual(self.successResultOf(d), 2)
+        self.assertEqual(checkpoint.getContent(), 'b')
+
+        self.gardener.called = []
+        b = Backfill(self.gardener, self.store, 'cake', '1', concurrency=2,
+                     checkpoint=checkpoint)
+        d = b.run()
+        self.gardener.finish()
+        self.gardener.finish()
+        self.assertEqual(self.gardener.called, [
+            ('c', 'cake', '1'),
+            ('d', 'cake', '1'),
+            ('e', 'cake', '1'),
+        ])
+        self.assertEqual(self.successResultOf(d), 3)
+        self.assertEqual(checkpoint.getContent(), 'e')
+
+
+    def test_pause(self):
+        """
+        While paused, no new batch is started.
+        """
+        for entity in 'abc':
+            self.put(entity, 'mix')
+        b = Backfill(self.gardener, self.store, 'cake', '1', concurrency=2)
+        d = b.run()
+        b.pauseProducing()
+        self.gardener.finish()
+        self.assertEqual(len(self.gardener.called), 2)
+        
+        b.resumeProducing()
+        self.assertEqual(len(self.gardener.called), 3)
+        self.gardener.finish()
+        self.assertEqual(self.successResultOf(d), 3)
+
+
+    def test_stopWhilePaused(self):
+        """
+        Stopping while paused stops without another batch.
+        """
+        for entity in 'abc':
+            self.put(entity, 'mix')
+        b = Backfill(self.gardener, self.store, 'cake', '1', concurrency=2)
+        d = b.run()
+        b.pauseProducing()
+        self.gardener.finish()
+        b.stop()
+        self.assertEqual(self.successResultOf(d), 2)
+        self.assertEqual(len(self.gardener.called), 2)
+
+
+    def test_failure(self):
+        """
+        Failing to do the work for one entity doesn't stop the others.
+        """
+        for entity in 'abc':
+            self.put(entity, 'mix')
+        self.gardener.fail_for.add('b')
+        b = Backfill(self.gardener, self.store, 'cake', '1')
+        d = b.run()
+        self.gardener.finish()
+        self.assertEqual(self.successResultOf(d), 3)
+        self.assertEqual(b.failures, 1)
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 1)
@@ -3,17 +3,22 @@ from twisted.internet import defer
 
 from zope.interface.verify import verifyObject
 
-from mock import create_autospec, call
+from mock import create_autospec, call, Mock
 from hashlib import sha1
 
 from garden.interface import (IGardener, IReceiver, ISourceable, IWork, IData,
                               IInput, IResult, IResultError, ISource)
 from garden.store import InMemoryStore
+from garden import path
 from garden.path import Garden
-from garden.data import linealHash, Data, Result, Work
+from garden.data import linealHash, Data, Result, Work, Input
 from garden.gardener import (Gardener, ToDataConverter,
-                             InvalidResultFilter, DataStorer, WorkMaker)
+                             InvalidResultFilter, DataStorer, WorkMaker,
+                             currentLineagesOnly)
 from garden.test.fake import FakeReceiver
+from garden.util import LRUCache
+from garden.scheduling import WorkCoalescer, WorkQueue
+from garden.worker import BlockingWorker
 
 
 
@@ -34,6 +39,292 @@ class GardenerTest(TestCase):
 
 
 
+    def test_setGarden(self):
+        """
+        You can swap in a new garden while running, and you get told what
+        changed.
+        """
+        old = Garden()
+        old.addPath('cake', '1', [('eggs', '1')])
+        new = Garden()
+        new.addPath('cake', '2', [('eggs', '1')])
+        
+        g = Gardener(old, InMemoryStore())
+        added, removed = g.setGarden(new)
+        self.assertEqual(added, [('cake', '2', (('eggs', '1'),))])
+        self.assertEqual(removed, [('cake', '1', (('eggs', '1'),))])
+        self.assertEqual(g.garden, new)
+        self.assertEqual(g.work_maker.garden, new)
+        self.assertEqual(g.result_filter.garden, new)
+
+
+    def test_hashCacheSize(self):
+        """
+        If you give a hash cache size, the result filter and data storer share
+        a cache of current hashes.
+        """
+        g = Gardener(Garden(), InMemoryStore(), hash_cache_size=10)
+        self.assertTrue(isinstance(g.hashes, LRUCache))
+        self.assertEqual(g.hashes.max_size, 10)
+        self.assertIdentical(g.result_filter.hashes, g.hashes)
+        self.assertIdentical(g.storer.hashes, g.hashes)
+        
+        g = Gardener(Garden(), InMemoryStore())
+        self.assertEqual(g.hashes, None)
+
+
+    def test_workMakerOptions(self):
+        """
+        You can limit the work in flight and which combinations of inputs are
+        made into work.
+        """
+        g = Gardener(Garden(), InMemoryStore(), max_work_in_flight=5,
+                     combination_policy=currentLineagesOnly)
+        self.assertEqual(g.work_maker._in_flight.limit, 5)
+        self.assertEqual(g.work_maker.policy, currentLineagesOnly)
+
+
+    def test_coalesceDelay(self):
+        """
+        If you give a coalesce delay, work goes through a L{WorkCoalescer}.
+        """
+        g = Gardener(Garden(), InMemoryStore(), coalesce_delay=2)
+        self.assertTrue(isinstance(g.coalescer, WorkCoalescer))
+        self.assertEqual(g.coalescer.delay, 2)
+        
+        g = Gardener(Garden(), InMemoryStore())
+        self.assertEqual(g.coalescer, None)
+
+
+    def test_workQueue(self):
+        """
+        If you give a work queue, work is sent out through it.
+        """
+        garden = Garden()
+        q = WorkQueue(concurrency=1)
+        g = Gardener(garden, InMemoryStore(), work_queue=q)
+        self.assertIdentical(q.garden, garden)
+        recv = FakeReceiver([IWork], lambda x: defer.Deferred())
+        g.subscribe(recv)
+        
+        work1 = Work('bob', 'cake', '1', 'xxxx', [('eggs', '1', 'aaaa', 'a')])
+        work2 = Work('bob', 'cake', '1', 'xxxx', [('eggs', '1', 'aaaa', 'b')])
+        d = g.workReceived(work1)
+        g.workReceived(work2)
+        recv.receive.assert_called_once_with(work1)
+        self.assertEqual(q.stats()['queued'], 1)
+        
+        recv.results[0].callback('done')
+        self.successResultOf(d)
+        self.assertEqual(recv.receive.call_count, 2)
+        
+        new = Garden()
+        g.setGarden(new)
+        self.assertIdentical(q.garden, new)
+
+
+    def test_workQueue_chain(self):
+        """
+        Work sent out through the queue is done when its result comes back,
+        so work made from the result isn't stuck behind it.
+        """
+        garden = Garden()
+        garden.addPath('b', '1', [('a', '1')])
+        garden.addPath('c', '1', [('b', '1')])
+        q = WorkQueue(concurrency=2)
+        g = Gardener(garden, InMemoryStore(), work_queue=q)
+        sent = []
+        def receive(work):
+            d = defer.Deferred()
+            sent.append((work, d))
+            return d
+        g.subscribe(FakeReceiver([IWork], receive))
+        
+        g.inputReceived(Input('joe', 'a', '1', 'x'))
+        g.inputReceived(Input('bob', 'a', '1', 'x'))
+        for work, d in list(sent):
+            g.resultReceived(work.toResult('y')).chainDeferred(d)
+        self.assertEqual([(x.entity, x.name) for x, d in sent],
+                         [('joe', 'b'), ('bob', 'b'), ('joe', 'c'),
+                          ('bob', 'c')])
+        self.assertEqual(q.stats()['queued'], 0)
+
+
+    def test_registerProducer(self):
+        """
+        Producers registered with me are paused while my work queue is full.
+        """
+        q = WorkQueue(concurrency=1, max_queued=1)
+        g = Gardener(Garden(), InMemoryStore(), work_queue=q)
+        g.subscribe(FakeReceiver([IWork], lambda x: defer.Deferred()))
+        producer = Mock()
+        g.registerProducer(producer)
+        
+        g.workReceived(Work('bob', 'cake', '1', 'xxxx', []))
+        g.workReceived(Work('joe', 'cake', '1', 'xxxx', []))
+        producer.pauseProducing.assert_called_once_with()
+        
+        # without a queue, nothing is paused
+        Gardener(Garden(), InMemoryStore()).registerProducer(producer)
+
+
+    def test_registerProducer_resumed(self):
+        """
+        Producers are resumed once results come back and the queue drains,
+        even when the results make more work.
+        """
+        garden = Garden()
+        garden.addPath('b', '1', [('a', '1')])
+        garden.addPath('c', '1', [('b', '1')])
+        q = WorkQueue(concurrency=1, max_queued=2)
+        g = Gardener(garden, InMemoryStore(), work_queue=q)
+        sent = []
+        def receive(work):
+            d = defer.Deferred()
+            sent.append((work, d))
+            return d
+        g.subscribe(FakeReceiver([IWork], receive))
+        producer = Mock()
+        g.registerProducer(producer)
+        
+        for entity in ['joe', 'bob', 'sam']:
+            g.inputReceived(Input(entity, 'a', '1', 'x'))
+        producer.pauseProducing.assert_called_once_with()
+        
+        while sent:
+            work, d = sent.pop(0)
+            g.resultReceived(work.toResult('y')).chainDeferred(d)
+        self.assertFalse(q.paused)
+        self.assertEqual(producer.resumeProducing.call_count,
+                         producer.pauseProducing.call_count)
+        self.assertEqual(q.stats()['dispatched'], 6)
+
+
+    def test_maxWorkInFlight_chain(self):
+        """
+        Work in flight is done when its result comes back, not when all the
+        work made from the result is done, so a limit on work in flight
+        doesn't hold up a chain of paths.
+        """
+        garden = Garden()
+        garden.addPath('b', '1', [('a', '1')])
+        garden.addPath('c', '1', [('b', '1')])
+        garden.addPath('d', '1', [('c', '1')])
+        store = InMemoryStore()
+        g = Gardener(garden, store, max_work_in_flight=1)
+        worker = BlockingWorker()
+        for name in ['b', 'c', 'd']:
+            worker.registerFunction(name, '1', lambda x: x + '!')
+        g.subscribe(worker)
+        worker.subscribe(g)
+        
+        self.successResultOf(g.inputReceived(Input('joe', 'a', '1', 'x')))
+        d = self.successResultOf(store.get('joe', 'd', '1'))
+        self.assertEqual([x.value for x in d], ['x!!!'])
+
+
+    def test_duplicateWork(self):
+        """
+        Work that's the same as work already sent out isn't sent out again
+        until the result of the first has come back.  It waits for that
+        result instead.
+        """
+        garden = Garden()
+        garden.addPath('cake', '1', [('eggs', '1')])
+        g = Gardener(garden, InMemoryStore())
+        recv = FakeReceiver([IWork], lambda x: defer.Deferred())
+        g.subscribe(recv)
+        work = Work('bob', 'cake', '1', 'xxxx', [('eggs', '1', 'aaaa', 'foo')])
+        
+        g.workReceived(work)
+        d = g.workReceived(work)
+        self.assertEqual(recv.receive.call_count, 1)
+        self.assertEqual(g.duplicates, 1)
+        self.assertNoResult(d)
+        
+        # different input values are different work
+        g.workReceived(Work('bob', 'cake', '1', 'xxxx',
+                            [('eggs', '1', 'aaaa', 'bar')]))
+        self.assertEqual(recv.receive.call_count, 2)
+        
+        r = g.resultReceived(work.toResult('cake value'))
+        self.assertEqual(self.successResultOf(d), self.successResultOf(r))
+        
+        g.workReceived(work)
+        self.assertEqual(recv.receive.call_count, 3)
+
+
+    def test_duplicateWork_resultError(self):
+        """
+        An error result also lets the work be sent out again.
+        """
+        g = Gardener(Garden(), InMemoryStore())
+        recv = FakeReceiver([IWork], lambda x: defer.Deferred())
+        g.subscribe(recv)
+        work = Work('bob', 'cake', '1', 'xxxx', [('eggs', '1', 'aaaa', 'foo')])
+        
+        g.workReceived(work)
+        d = g.workReceived(work)
+        g.resultReceived(work.toResultError('error'))
+        self.successResultOf(d)
+        
+        g.workReceived(work)
+        self.assertEqual(recv.receive.call_count, 2)
+
+
+    def test_duplicateWork_sentWithoutResult(self):
+        """
+        If sending work out finishes without a result coming back, duplicates
+        waiting on it are told and it can be sent again.
+        """
+        g = Gardener(Garden(), InMemoryStore())
+        sent = []
+        def receive(work):
+            d = defer.Deferred()
+            sent.append(d)
+            return d
+        recv = FakeReceiver([IWork], receive)
+        g.subscribe(recv)
+        work = Work('bob', 'cake', '1', 'xxxx', [('eggs', '1', 'aaaa', 'foo')])
+        
+        g.workReceived(work)
+        d = g.workReceived(work)
+        sent[0].callback('sent')
+        self.successResultOf(d)
+        
+        g.workReceived(work)
+        self.assertEqual(recv.receive.call_count, 2)
+        self.assertEqual(g._pending.keys(), [g._workKey(work)])
+        sent[1].callback('sent')
+        self.assertEqual(g._pending, {})
+
+
+    def test_duplicateWork_sendFailed(self):
+        """
+        If work can't be sent out, duplicates waiting on it fail too and it
+        can be sent again.
+        """
+        g = Gardener(Garden(), InMemoryStore())
+        sent = []
+        def receive(work):
+            d = defer.Deferred()
+            sent.append(d)
+            return d
+        recv = FakeReceiver([IWork], receive)
+        g.subscribe(recv)
+        work = Work('bob', 'cake', '1', 'xxxx', [('eggs', '1', 'aaaa', 'foo')])
+        
+        first = g.workReceived(work)
+        d = g.workReceived(work)
+        sent[0].errback(Exception('foo'))
+        self.failureResultOf(first)
+        self.failureResultOf(d)
+        
+        g.workReceived(work)
+        self.assertEqual(recv.receive.call_count, 2)
+
+
+
 class ToDataConverterTest(TestCase):
 
 
@@ -134,6 +425,154 @@ class InvalidResultFilterTest(TestCase):
         self.assertTrue(self.successResultOf(r))
 
 
+    def test_resultReceived_frozenGarden(self):
+        """
+        A frozen garden works just as well as a regular one.
+        """
+        store = InMemoryStore()
+        store.put(Data('joe', 'cake', '1', 'xxxx', 'chocolate'))
+        
+        garden = Garden()
+        garden.addPath('happiness', '1', [
+            ('cake', '1'),
+        ])
+        
+        receiver = FakeReceiver([IResult])
+        
+        f = InvalidResultFilter(garden.freeze(), store)
+        ISource(f).subscribe(receiver)
+        
+        f.resultReceived(Result('joe', 'happiness', '1', 'bbbb', 'yes', [
+            ('money', '1', 'xxxx', sha1('chocolate').hexdigest()),
+        ]))
+        self.assertEqual(receiver.receive.call_count, 0)
+        
+        result = Result('joe', 'happiness', '1', 'bbbb', 'yes', [
+            ('cake', '1', 'xxxx', sha1('chocolate').hexdigest()),
+        ])
+        r = f.resultReceived(result)
+        receiver.receive.assert_called_once_with(result)
+        self.assertTrue(self.successResultOf(r))
+
+
+    def test_resultReceived_oneFetch(self):
+        """
+        The hashes of all the inputs' current values are fetched from the
+        store at once (and not the values themselves).
+        """
+        store = InMemoryStore()
+        store.put(Data('joe', 'cake', '1', 'xxxx', 'chocolate'))
+        store.put(Data('joe', 'ice cream', '1', 'yyyy', 'vanilla'))
+        store.getHashes = create_autospec(store.getHashes,
+                                          side_effect=store.getHashes)
+        
+        garden = Garden()
+        garden.addPath('happiness', '1', [
+            ('cake', '1'),
+            ('ice cream', '1'),
+        ])
+        
+        receiver = FakeReceiver([IResult])
+        f = InvalidResultFilter(garden, store)
+        ISource(f).subscribe(receiver)
+        
+        result = Result('joe', 'happiness', '1', 'bbbb', 'yes', [
+            ('cake', '1', 'xxxx', sha1('chocolate').hexdigest()),
+            ('ice cream', '1', 'yyyy', sha1('vanilla').hexdigest()),
+        ])
+        f.resultReceived(result)
+        store.getHashes.assert_called_once_with('joe', [
+            ('cake', '1', 'xxxx'),
+            ('ice cream', '1', 'yyyy'),
+        ])
+        receiver.receive.assert_called_once_with(result)
+
+
+    def test_resultReceived_hashCache(self):
+        """
+        Hashes in the cache aren't fetched from the store, and hashes fetched
+        from the store are added to the cache.
+        """
+        store = InMemoryStore()
+        store.put(Data('joe', 'cake', '1', 'xxxx', 'chocolate'))
+        store.put(Data('joe', 'ice cream', '1', 'yyyy', 'vanilla'))
+        store.getHashes = create_autospec(store.getHashes,
+                                          side_effect=store.getHashes)
+        
+        garden = Garden()
+        garden.addPath('happiness', '1', [
+            ('cake', '1'),
+            ('ice cream', '1'),
+        ])
+        
+        hashes = LRUCache(10)
+        hashes[('joe', 'cake', '1', 'xxxx')] = sha1('chocolate').hexdigest()
+        receiver = FakeReceiver([IResult])
+        f = InvalidResultFilter(garden, store, hashes)
+        ISource(f).subscribe(receiver)
+        
+        result = Result('joe', 'happiness', '1', 'bbbb', 'yes', [
+            ('cake', '1', 'xxxx', sha1('chocolate').hexdigest()),
+            ('ice cream', '1', 'yyyy', sha1('vanilla').hexdigest()),
+        ])
+        f.resultReceived(result)
+        store.getHashes.assert_called_once_with('joe', [
+            ('ice cream', '1', 'yyyy'),
+        ])
+        receiver.receive.assert_called_once_with(result)
+        self.assertEqual(hashes[('joe', 'ice cream', '1', 'yyyy')],
+                         sha1('vanilla').hexdigest())
+        
+        f.resultReceived(result)
+        self.assertEqual(store.getHashes.call_count, 1, "Should have used "
+                         "the cache for everything")
+        self.assertEqual(receiver.receive.call_count, 2)
+
+
+    def test_resultReceived_hashCacheStale(self):
+        """
+        A result computed from a value that has since been replaced (as
+        recorded in the cache) is not passed on.
+        """
+        store = InMemoryStore()
+        garden = Garden()
+        garden.addPath('happiness', '1', [
+            ('cake', '1'),
+        ])
+        
+        hashes = LRUCache(10)
+        hashes[('joe', 'cake', '1', 'xxxx')] = sha1('vanilla').hexdigest()
+        receiver = FakeReceiver([IResult])
+        f = InvalidResultFilter(garden, store, hashes)
+        ISource(f).subscribe(receiver)
+        
+        r = f.resultReceived(Result('joe', 'happiness', '1', 'bbbb', 'yes', [
+            ('cake', '1', 'xxxx', sha1('chocolate').hexdigest()),
+        ]))
+        self.assertEqual(receiver.receive.call_count, 0)
+        self.successResultOf(r)
+
+
+    def test_resultReceived_missingInput(self):
+        """
+        If an input isn't in the store anymore, the result isn't passed on.
+        """
+        garden = Garden()
+        garden.addPath('happiness', '1', [
+            ('cake', '1'),
+        ])
+        
+        receiver = FakeReceiver([IResult])
+        f = InvalidResultFilter(garden, InMemoryStore())
+        ISource(f).subscribe(receiver)
+        
+        r = f.resultReceived(Result('joe', 'happiness', '1', 'bbbb', 'yes', [
+            ('cake', '1', 'xxxx', sha1('chocolate').hexdigest()),
+        ]))
+        self.assertEqual(receiver.receive.call_count, 0)
+        self.successResultOf(r)
+
+
     def test_resultReceived_invalidPath(self):
         """
         If a result is received that was computed using arguments that don't
@@ -222,6 +661,26 @@ class DataStorerTest(TestCase):
                          "along unchanged data")
 
 
+    def test_dataReceived_hashCache(self):
+        """
+        The hash of every value stored is recorded in the cache, whether or not
+        it changed.
+        """
+        store = InMemoryStore()
+        hashes = LRUCache(10)
+        s = DataStorer(store, hashes)
+        ISource(s).subscribe(FakeReceiver([IData]))
+        
+        s.dataReceived(Data('ham', 'cake', '1', 'xxxx', 'value'))
+        self.assertEqual(hashes[('ham', 'cake', '1', 'xxxx')],
+                         sha1('value').hexdigest())
+        
+        hashes.pop(('ham', 'cake', '1', 'xxxx'))
+        s.dataReceived(Data('ham', 'cake', '1', 'xxxx', 'value'))
+        self.assertEqual(hashes[('ham', 'cake', '1', 'xxxx')],
+                         sha1('value').hexdigest())
+
+
 
 class WorkMakerTest(TestCase):
 
@@ -344,6 +803,139 @@ class WorkMakerTest(TestCase):
         self.assertEqual(len(self.successResultOf(r)), 2)
 
 
+    def test_doPossibleWork_maxInFlight(self):
+        """
+        If there's a limit on work in flight, the next combination isn't made
+        into work until some of the work in flight is done.
+        """
+        store = InMemoryStore()
+        garden = Garden()
+        garden.addPath('cake', '1', [
+            ('eggs', '1'),
+            ('flour', '1'),
+        ])
+        recv = FakeReceiver([IWork], lambda x: defer.Deferred())
+        w = WorkMaker(garden, store, max_in_flight=2)
+        ISource(w).subscribe(recv)
+        
+        store.put(Data('sam', 'eggs', '1', 'aaaa', 'eggs value'))
+        for lineage in ['bbbb', 'cccc', 'dddd']:
+            store.put(Data('sam', 'flour', '1', lineage, 'flour value'))
+        
+        r = w.doPossibleWork('sam', 'cake', '1')
+        self.assertEqual(recv.receive.call_count, 2)
+        recv.results[0].callback('done')
+        self.assertEqual(recv.receive.call_count, 3)
+        self.assertNoResult(r)
+        recv.results[1].callback('done')
+        recv.results[2].callback('done')
+        self.assertEqual(len(self.successResultOf(r)), 1)
+        self.assertEqual(recv.receive.call_count, 3)
+
+
+    def test_doPossibleWork_maxInFlightResult(self):
+        """
+        Work in flight is done once a result for it comes back, even if
+        emitting it hasn't finished.
+        """
+        store = InMemoryStore()
+        garden = Garden()
+        garden.addPath('cake', '1', [('eggs', '1')])
+        recv = FakeReceiver([IWork], lambda x: defer.Deferred())
+        w = WorkMaker(garden, store, max_in_flight=1)
+        ISource(w).subscribe(recv)
+        store.put(Data('sam', 'eggs', '1', 'aaaa', 'eggs value'))
+        store.put(Data('sam', 'eggs', '1', 'bbbb', 'eggs value'))
+        
+        w.doPossibleWork('sam', 'cake', '1')
+        self.assertEqual(recv.receive.call_count, 1)
+        
+        # a result for other work makes no room
+        w.workDone(Result('sam', 'cake', '1', 'xxxx', 'value', []))
+        self.assertEqual(recv.receive.call_count, 1)
+        
+        first = recv.receive.call_args[0][0]
+        w.workDone(first.toResult('value'))
+        self.assertEqual(recv.receive.call_count, 2)
+        
+        # finishing emitting it doesn't make room twice
+        recv.results[0].callback('done')
+        self.assertEqual(w._in_flight.tokens, 0)
+
+
+    def test_doPossibleWork_maxInFlightError(self):
+        """
+        Work that fails still makes room for more.
+        """
+        store = InMemoryStore()
+        garden = Garden()
+        garden.addPath('cake', '1', [('eggs', '1')])
+        recv = FakeReceiver([IWork], lambda x: defer.fail(Exception('foo')))
+        w = WorkMaker(garden, store, max_in_flight=1)
+        ISource(w).subscribe(recv)
+        store.put(Data('sam', 'eggs', '1', 'aaaa', 'eggs value'))
+        store.put(Data('sam', 'eggs', '1', 'bbbb', 'eggs value'))
+        
+        r = w.doPossibleWork('sam', 'cake', '1')
+        self.assertEqual(recv.receive.call_count, 2)
+        self.failureResultOf(r)
+
+
+    def test_doPossibleWork_policy(self):
+        """
+        A policy can keep combinations from being made into work, and those
+        are counted.
+        """
+        store, garden, w, recv = self.mkCakeSetup()
+        kept = []
+        def policy(garden_arg, name, version, combination):
+            self.assertIdentical(garden_arg, garden)
+            self.assertEqual((name, version), ('cake', '1'))
+            keep = combination[1].lineage != 'cccc'
+            if keep:
+                kept.append(combination)
+            return keep
+        w.policy = policy
+        
+        store.put(Data('sam', 'eggs', '1', 'aaaa', 'eggs value'))
+        store.put(Data('sam', 'flour', '1', 'bbbb', 'flour value'))
+        store.put(Data('sam', 'flour', '1', 'cccc', 'flour value 2'))
+        
+        w.doPossibleWork('sam', 'cake', '1')
+        self.assertEqual(recv.receive.call_count, 1)
+        self.assertEqual(kept[0][1].lineage, 'bbbb')
+        self.assertEqual(w.suppressed, 1)
+
+
+    def test_currentLineagesOnly(self):
+        """
+        The current lineages policy only allows inputs with lineages the
+        garden leads to.
+        """
+        garden = Garden()
+        garden.addPath('cake', '1', [('eggs', '1')])
+        eggs = linealHash('eggs', '1')
+        self.assertTrue(currentLineagesOnly(garden, 'cake', '1', (
+            Data('sam', 'eggs', '1', eggs, 'value'),
+        )))
+        self.assertFalse(currentLineagesOnly(garden, 'cake', '1', (
+            Data('sam', 'eggs', '1', 'aaaa', 'value'),
+        )))
+
+
+    def test_currentLineagesOnly_tooMany(self):
+        """
+        Inputs with too many lineages to list are allowed.
+        """
+        self.patch(path, 'MAX_LINEAGES', 1)
+        garden = Garden()
+        garden.addPath('cake', '1', [('eggs', '1')])
+        garden.addPath('eggs', '1', [('chicken', '1')])
+        self.assertTrue(currentLineagesOnly(garden, 'cake', '1', (
+            Data('sam', 'eggs', '1', 'aaaa', 'value'),
+        )))
+
+
     def test_doPossibleWork_multiPath(self):
         """
         If there's data for multiple paths, do work for all paths.
@@ -367,6 +959,41 @@ class WorkMakerTest(TestCase):
         self.assertEqual(len(self.successResultOf(r)), 2)
 
 
+    def test_doPossibleWork_oneFetch(self):
+        """
+        The inputs for all the paths are fetched from the store at once.
+        """
+        store, garden, w, recv = self.mkCakeSetup()
+        store.getMany = create_autospec(store.getMany,
+                                        side_effect=store.getMany)
+        w.doPossibleWork('sam', 'cake', '1')
+        store.getMany.assert_called_once_with('sam', [
+            ('eggs', '1'),
+            ('flour', '1'),
+            ('flour', 'new'),
+        ])
+
+
+    def test_doPossibleWork_frozenGarden(self):
+        """
+        A frozen garden works just as well as a regular one.
+        """
+        store, garden, _, _ = self.mkCakeSetup()
+        receiver = FakeReceiver([IWork])
+        w = WorkMaker(garden.freeze(), store)
+        ISource(w).subscribe(receiver)
+
+        store.put(Data('sam', 'eggs', '1', 'aaaa', 'eggs value'))
+        store.put(Data('sam', 'flour', 'new', 'cccc', 'flour value 2'))
+        
+        r = w.doPossibleWork('sam', 'cake', '1')
+        receiver.receive.assert_called_once_with(Work('sam', 'cake', '1',
+            linealHash('cake', '1', ['aaaa', 'cccc']),
+            [('eggs', '1', 'aaaa', 'eggs value'),
+             ('flour', 'new', 'cccc', 'flour value 2')]))
+        self.assertTrue(r.called)
+
+
     def test_dataReceived_errorReceiving(self):
         """
         If the work_receiver errsback on receiving any of the pieces of work,
@@ -398,7 +1025,7 @@ class WorkMakerTest(TestCase):
         fail
         """
         store = InMemoryStore()
-        store.get = create_autospec(store.get, side_effect=lambda *a: defer.fail(Exception('foo')))
+        store.getMany = create_autospec(store.getMany, side_effect=lambda *a: defer.fail(Exception('foo')))
         
         garden = Garden()
         garden.addPath('cake', '1', [
@@ -2,6 +2,7 @@ from twisted.trial.unittest import TestCase
 from zope.interface.verify import verifyObject
 
 from urllib import urlencode
+import json
 
 from mock import Mock
 from StringIO import StringIO
@@ -12,9 +13,10 @@ from twisted.web.test.test_web import DummyChannel
 from twisted.web.http_headers import Headers
 from twisted.web.http import parse_qs
 
-from garden.data import Input
+from garden.data import Input, Data
 from garden.interface import IInput, ISource, ISourceable, IReceiver, IData
-from garden.http import WebInputSource, WebDataFeed
+from garden.http import WebInputSource, WebDataFeed, WebDataQuery
+from garden.store import InMemoryStore
 from garden.test.fake import FakeReceiver
 
 import cgi
@@ -143,6 +145,42 @@ class WebInputSourceTest(TestCase):
                         "something as a response")
 
 
+    def test_pauseProducing(self):
+        """
+        Input that comes in while paused is turned away with a 503 and a
+        Retry-After header, until resumed.
+        """
+        receiver = FakeReceiver([IInput])
+        w = WebInputSource()
+        ISource(w).subscribe(receiver)
+        w.pauseProducing()
+        
+        def post(value):
+            payload = urlencode({
+                'entity': 'Joe',
+                'name': 'cake',
+                'version': '1',
+                'value': value,
+            })
+            request = requestMock('/', 'POST', body=payload, headers={
+                'Content-Type': ['application/x-www-form-urlencoded'],
+            })
+            self.successResultOf(_render(w, request))
+            return request
+        
+        request = post('a')
+        request.setResponseCode.assert_called_once_with(503)
+        self.assertEqual(request.responseHeaders.getRawHeaders('retry-after'),
+                         [str(w.retry_after)])
+        self.assertEqual(receiver.receive.call_count, 0)
+        
+        w.resumeProducing()
+        request = post('b')
+        receiver.receive.assert_called_once_with(Input('Joe', 'cake', '1',
+                                                       'b'))
+        self.assertEqual(request.setResponseCode.call_count, 0)
+
+
 
 class WebDataFeedTest(TestCase):
 
@@ -154,3 +192,72 @@ class WebDataFeedTest(TestCase):
         self.assertEqual(mapping[IData], feed.dataReceived)
 
 
+
+class WebDataQueryTest(TestCase):
+
+
+    def setUp(self):
+        self.store = InMemoryStore()
+        for i in xrange(5):
+            self.store.put(Data('Joe', 'cake', '1', str(i), 'value %d' % (i,)))
+        self.store.put(Data('Joe', 'pie', '1', 'ffff', 'apple'))
+        self.resource = WebDataQuery(self.store)
+
+
+    def get(self, **args):
+        request = requestMock('/')
+        request.args = dict([(k, [str(v)]) for k, v in args.items()])
+        self.successResultOf(_render(self.resource, request))
+        body = ''.join([x[0][0] for x in request.write.call_args_list])
+        return request, body
+
+
+    def test_page(self):
+        """
+        You get a page of data and the cursor of the next page, which you can
+        use to get it.
+        """
+        request, body = self.get(entity='Joe', name='cake', limit=3)
+        result = json.loads(body)
+        self.assertEqual(result['data'], [
+            ['Joe', 'cake', '1', str(i), 'value %d' % (i,)] for i in xrange(3)
+        ])
+        self.assertNotEqual(result['next'], None)
+        
+        request, body = self.get(entity='Joe', name='cake', limit=3,
+                                 after=result['next'])
+        result = json.loads(body)
+        self.assertEqual([x[3] for x in result['data']], ['3', '4'])
+        self.assertEqual(result['next'], None)
+
+
+    def test_stream(self):
+        """
+        You can get all the data, one JSON list per line.
+        """
+        request, body = self.get(entity='Joe', stream=1, limit=2)
+        lines = [json.loads(x) for x in body.splitlines()]
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[-1], ['Joe', 'pie', '1', 'ffff', 'apple'])
+        self.assertEqual(request.write.call_count, 3, "Should write a page "
+                         "at a time")
+
+
+    def test_badRequest(self):
+        """
+        The entity is required, and the limit has to be a number.
+        """
+        request, body = self.get()
+        request.setResponseCode.assert_called_once_with(400)
+        request, body = self.get(entity='Joe', limit='foo')
+        request.setResponseCode.assert_called_once_with(400)
+
+
+    def test_error(self):
+        """
+        An error getting the data is an error response.
+        """
+        self.store.getPage = lambda *a: defer.fail(ValueError('foo'))
+        request, body = self.get(entity='Joe')
+        request.setResponseCode.assert_called_once_with(500)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 0)
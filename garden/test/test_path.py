@@ -1,7 +1,11 @@
 from twisted.trial.unittest import TestCase
 
+from StringIO import StringIO
 
-from garden.path import Garden, CycleError
+
+from garden.path import (Garden, FrozenGarden, CycleError, loadGarden,
+                         diffGardens)
+from garden.data import linealHash
 
 
 class GardenTest(TestCase):
@@ -23,6 +27,161 @@ class GardenTest(TestCase):
         ])
 
 
+    def test_lookupMissing(self):
+        """
+        Looking up things that aren't in the garden returns nothing, and
+        doesn't add them.
+        """
+        g = Garden()
+        self.assertEqual(list(g.pathsRequiring('foo', 'v1')), [])
+        self.assertEqual(list(g.inputsFor('foo', 'v1')), [])
+        self.assertEqual(len(g._inputs), 0)
+        self.assertEqual(len(g._destinations), 0)
+
+
+    def test_hasPath(self):
+        """
+        You can ask if there's a path from a particular list of inputs.
+        """
+        g = Garden()
+        g.addPath('foo', 'v1', [
+            ('bar', 'a'),
+            ('cow', 'b'),
+        ])
+        self.assertTrue(g.hasPath('foo', 'v1', [('bar', 'a'), ('cow', 'b')]))
+        self.assertTrue(g.hasPath('foo', 'v1', [['bar', 'a'], ['cow', 'b']]))
+        self.assertFalse(g.hasPath('foo', 'v1', [('cow', 'b'), ('bar', 'a')]))
+        self.assertFalse(g.hasPath('foo', 'v1', [('bar', 'a')]))
+        self.assertFalse(g.hasPath('foo', 'v2', [('bar', 'a'), ('cow', 'b')]))
+
+
+    def test_downstreamOf(self):
+        """
+        You can find everything that eventually depends on an input, in
+        topological order.
+        """
+        g = Garden()
+        g.addPath('letter', 'v1', [('percent', 'v1')])
+        g.addPath('percent', 'v1', [('assignments', 'v1'), ('exams', 'v1')])
+        g.addPath('report', 'v1', [('letter', 'v1'), ('exams', 'v1')])
+        self.assertEqual(g.downstreamOf('exams', 'v1'), (
+            ('percent', 'v1'),
+            ('letter', 'v1'),
+            ('report', 'v1'),
+        ))
+        self.assertEqual(g.downstreamOf('report', 'v1'), ())
+        self.assertEqual(g.downstreamOf('nothing', 'v1'), ())
+        
+        g.addPath('percent', 'v2', [('assignments', 'v1'), ('exams', 'v1')])
+        self.assertEqual(set(g.downstreamOf('assignments', 'v1')), set([
+            ('percent', 'v1'),
+            ('percent', 'v2'),
+            ('letter', 'v1'),
+            ('report', 'v1'),
+        ]), "Should notice paths added after the last call")
+
+
+    def test_upstreamOf(self):
+        """
+        You can find everything a destination eventually depends on, in
+        topological order.
+        """
+        g = Garden()
+        g.addPath('letter', 'v1', [('percent', 'v1')])
+        g.addPath('percent', 'v1', [('assignments', 'v1')])
+        self.assertEqual(g.upstreamOf('letter', 'v1'), (
+            ('assignments', 'v1'),
+            ('percent', 'v1'),
+        ))
+        self.assertEqual(g.upstreamOf('assignments', 'v1'), ())
+        
+        g.addPaths([
+            ('assignments', 'v1', [('homework', 'v1')]),
+        ])
+        self.assertEqual(g.upstreamOf('letter', 'v1'), (
+            ('homework', 'v1'),
+            ('assignments', 'v1'),
+            ('percent', 'v1'),
+        ), "Should notice paths added after the last call")
+
+
+    def test_removePath(self):
+        """
+        You can remove paths from a Garden.
+        """
+        g = Garden()
+        g.addPath('foo', 'v1', [
+            ('bar', 'a'),
+            ('cow', 'b'),
+        ])
+        g.addPath('foo', 'v1', [
+            ('bar', 'a'),
+        ])
+        self.assertEqual(g.downstreamOf('cow', 'b'), (('foo', 'v1'),))
+        g.removePath('foo', 'v1', [
+            ('bar', 'a'),
+            ('cow', 'b'),
+        ])
+        self.assertEqual(list(g.inputsFor('foo', 'v1')), [
+            [('bar', 'a')],
+        ])
+        self.assertEqual(list(g.pathsRequiring('bar', 'a')), [('foo', 'v1')])
+        self.assertEqual(list(g.pathsRequiring('cow', 'b')), [])
+        self.assertEqual(g.downstreamOf('cow', 'b'), ())
+        
+        g.removePath('foo', 'v1', [('bar', 'a')])
+        self.assertEqual(g.paths(), [])
+        
+        # and the garden is still usable
+        g.addPath('bar', 'a', [('foo', 'v1')])
+
+
+    def test_removePath_missing(self):
+        """
+        Removing a path that isn't there is an error.
+        """
+        g = Garden()
+        g.addPath('foo', 'v1', [('bar', 'a')])
+        self.assertRaises(ValueError, g.removePath, 'foo', 'v1', [
+            ('bar', 'b'),
+        ])
+        self.assertRaises(ValueError, g.removePath, 'foo', 'v2', [
+            ('bar', 'a'),
+        ])
+
+
+    def test_paths(self):
+        """
+        You can list all the paths in a garden, in topological order.
+        """
+        g = Garden()
+        g.addPath('letter', 'v1', [('percent', 'v1')])
+        g.addPath('percent', 'v1', [('assignments', 'v1'), ('exams', 'v1')])
+        g.addPath('letter', 'v1', [('percent', 'v2')])
+        expected = [
+            ('percent', 'v1', (('assignments', 'v1'), ('exams', 'v1'))),
+            ('letter', 'v1', (('percent', 'v1'),)),
+            ('letter', 'v1', (('percent', 'v2'),)),
+        ]
+        self.assertEqual(g.paths(), expected)
+        self.assertEqual(g.freeze().paths(), expected)
+
+
+    def test_diffGardens(self):
+        """
+        You can see which paths were added to and removed from a garden.
+        """
+        old = Garden()
+        old.addPath('letter', 'v1', [('percent', 'v1')])
+        old.addPath('letter', 'v2', [('percent', 'v1')])
+        new = Garden()
+        new.addPath('letter', 'v1', [('percent', 'v1')])
+        new.addPath('letter', 'v3', [('percent', 'v1')])
+        added, removed = diffGardens(old, new.freeze())
+        self.assertEqual(added, [('letter', 'v3', (('percent', 'v1'),))])
+        self.assertEqual(removed, [('letter', 'v2', (('percent', 'v1'),))])
+
+
     def test_addPath_obviousCycle(self):
         """
         It's illegal to add a destination that depends directly on itself.
@@ -83,3 +242,400 @@ class GardenTest(TestCase):
             ('b', 'v1'),
         ])
 
+
+
+    def test_addPath_cycleLeavesGardenUnchanged(self):
+        """
+        A path that would create a cycle is not added.
+        """
+        g = Garden()
+        g.addPath('b', 'v1', [
+            ('a', 'v1'),
+        ])
+        self.assertRaises(CycleError, g.addPath, 'a', 'v1', [
+            ('c', 'v1'),
+            ('b', 'v1'),
+        ])
+        self.assertEqual(list(g.inputsFor('a', 'v1')), [])
+        self.assertEqual(list(g.pathsRequiring('b', 'v1')), [])
+        self.assertEqual(list(g.pathsRequiring('c', 'v1')), [])
+        self.assertEqual(g.lineagesFor('c', 'v1'), frozenset())
+        self.assertNotIn(('c', 'v1'), g._order)
+        self.assertEqual(g.freeze().lineagesFor('c', 'v1'), frozenset())
+        self.assertEqual(g.paths(), [('b', 'v1', (('a', 'v1'),))])
+
+
+    def test_addPath_reverseChain(self):
+        """
+        Paths can be added in any order, even if that means the garden has to
+        shuffle things around to keep track of what comes before what.
+        """
+        g = Garden()
+        for i in xrange(200):
+            g.addPath(str(i), 'v1', [
+                (str(i + 1), 'v1'),
+            ])
+        self.assertRaises(CycleError, g.addPath, '200', 'v1', [
+            ('0', 'v1'),
+        ])
+        self.assertRaises(CycleError, g.addPath, '150', 'v1', [
+            ('20', 'v1'),
+        ])
+        g.addPath('20', 'v1', [
+            ('150', 'v1'),
+        ])
+
+
+    def test_addPath_deepChain(self):
+        """
+        Very deep gardens are fine.
+        """
+        g = Garden()
+        for i in xrange(5000):
+            g.addPath(str(i + 1), 'v1', [
+                (str(i), 'v1'),
+            ])
+        self.assertRaises(CycleError, g.addPath, '0', 'v1', [
+            ('5000', 'v1'),
+        ])
+
+
+    def test_addPath_wideDiamonds(self):
+        """
+        Gardens made of many diamonds stacked on top of each other can be
+        checked for cycles quickly.
+        """
+        g = Garden()
+        for i in xrange(100):
+            top = ('top', str(i))
+            bottom = ('top', str(i + 1))
+            g.addPath('left', str(i), [top])
+            g.addPath('right', str(i), [top])
+            g.addPath(*bottom, inputs=[
+                ('left', str(i)),
+                ('right', str(i)),
+            ])
+        self.assertRaises(CycleError, g.addPath, 'top', '0', [
+            ('top', '100'),
+        ])
+        self.assertRaises(CycleError, g.addPath, 'left', '0', [
+            ('right', '50'),
+        ])
+
+
+    def test_addPaths(self):
+        """
+        You can add a bunch of paths at once.
+        """
+        g = Garden()
+        g.addPath('letter', 'v1', [
+            ('percent', 'v1'),
+        ])
+        g.addPaths([
+            ('percent', 'v1', [('assignments', 'v1'), ('exams', 'v1')]),
+            ('percent', 'v2', [['assignments', 'v1'], ['exams', 'v1']]),
+            ('letter', 'v1', [('percent', 'v2')]),
+        ])
+        self.assertEqual(list(g.inputsFor('percent', 'v1')), [
+            [('assignments', 'v1'), ('exams', 'v1')],
+        ])
+        self.assertEqual(list(g.inputsFor('percent', 'v2')), [
+            [('assignments', 'v1'), ('exams', 'v1')],
+        ])
+        self.assertEqual(list(g.inputsFor('letter', 'v1')), [
+            [('percent', 'v1')],
+            [('percent', 'v2')],
+        ])
+        self.assertEqual(list(g.pathsRequiring('exams', 'v1')), [
+            ('percent', 'v1'),
+            ('percent', 'v2'),
+        ])
+        
+        # paths added one at a time are still checked against them
+        self.assertRaises(CycleError, g.addPath, 'exams', 'v1', [
+            ('letter', 'v1'),
+        ])
+
+
+    def test_addPaths_cycle(self):
+        """
+        If the paths contain a cycle, none of them are added and the error
+        says where the cycle is.
+        """
+        g = Garden()
+        g.addPath('c', 'v1', [
+            ('b', 'v1'),
+        ])
+        exc = self.assertRaises(CycleError, g.addPaths, [
+            ('b', 'v1', [('a', 'v1')]),
+            ('x', 'v1', [('c', 'v1')]),
+            ('a', 'v1', [('z', 'v1'), ('c', 'v1')]),
+        ])
+        cycle = exc.args[0]
+        self.assertEqual(cycle[0], cycle[-1])
+        start = cycle.index(('a', 'v1'))
+        self.assertEqual((cycle[:-1] * 2)[start:start + 3], [
+            ('a', 'v1'),
+            ('b', 'v1'),
+            ('c', 'v1'),
+        ])
+        self.assertEqual(list(g.inputsFor('b', 'v1')), [])
+        self.assertEqual(list(g.inputsFor('x', 'v1')), [])
+        self.assertEqual(list(g.pathsRequiring('c', 'v1')), [])
+
+
+    def test_addPaths_obviousCycle(self):
+        """
+        A path that requires itself is a cycle too.
+        """
+        g = Garden()
+        exc = self.assertRaises(CycleError, g.addPaths, [
+            ('a', 'v1', [('a', 'v1')]),
+        ])
+        self.assertEqual(exc.args[0], [('a', 'v1'), ('a', 'v1')])
+
+
+    def test_lineagesFor(self):
+        """
+        The lineages data can have are those of input data and of data
+        computed along any of the paths from data with any of the inputs'
+        lineages.
+        """
+        g = Garden()
+        g.addPath('cake', '1', [
+            ('eggs', '1'),
+            ('flour', '1'),
+        ])
+        g.addPath('flour', '1', [
+            ('wheat', '1'),
+        ])
+        eggs = linealHash('eggs', '1')
+        wheat = linealHash('wheat', '1')
+        flour = [linealHash('flour', '1'),
+                 linealHash('flour', '1', [wheat])]
+        self.assertEqual(g.lineagesFor('eggs', '1'), frozenset([eggs]))
+        self.assertEqual(g.lineagesFor('flour', '1'), frozenset(flour))
+        self.assertEqual(g.lineagesFor('cake', '1'), frozenset([
+            linealHash('cake', '1'),
+            linealHash('cake', '1', [eggs, flour[0]]),
+            linealHash('cake', '1', [eggs, flour[1]]),
+        ]))
+        self.assertEqual(g.lineagesFor('pie', '1'), frozenset())
+        self.assertEqual(g.lineagesFor('cake', '1'),
+                         g.freeze().lineagesFor('cake', '1'))
+        self.assertEqual(g.freeze().lineagesFor('pie', '1'), frozenset())
+
+
+    def test_lineagesFor_tooMany(self):
+        """
+        If there are too many lineages to list, C{None} is returned instead,
+        and quickly, for everything downstream too.
+        """
+        g = Garden()
+        for i in xrange(5):
+            middle = []
+            for j in xrange(3):
+                g.addPath('middle%d' % (j,), str(i), [('top', str(i))])
+                middle.append(('middle%d' % (j,), str(i)))
+            g.addPath('top', str(i + 1), middle)
+        self.assertEqual(len(g.lineagesFor('top', '1')), 9)
+        self.assertEqual(len(g.lineagesFor('middle0', '1')), 10)
+        self.assertEqual(g.lineagesFor('top', '2'), None)
+        self.assertEqual(g.lineagesFor('top', '5'), None)
+        self.assertEqual(g.freeze().lineagesFor('top', '5'), None)
+
+
+    def test_lineagesFor_changes(self):
+        """
+        Changing the paths changes the lineages.
+        """
+        g = Garden()
+        g.addPath('cake', '1', [('eggs', '1')])
+        before = g.lineagesFor('cake', '1')
+        g.addPath('eggs', '1', [('chicken', '1')])
+        self.assertEqual(len(g.lineagesFor('cake', '1')), 3)
+        g.removePath('eggs', '1', [('chicken', '1')])
+        self.assertEqual(g.lineagesFor('cake', '1'), before)
+        g.addPaths([('cake', '1', [('flour', '1')])])
+        self.assertEqual(len(g.lineagesFor('cake', '1')), 3)
+
+
+    def test_depthOf(self):
+        """
+        The depth is the number of paths in the longest chain leading to a
+        destination, and it changes when the paths do.
+        """
+        g = Garden()
+        g.addPath('mix', '1', [('eggs', '1'), ('flour', '1')])
+        g.addPath('cake', '1', [('mix', '1'), ('eggs', '1')])
+        self.assertEqual(g.depthOf('cake', '1'), 2)
+        self.assertEqual(g.depthOf('mix', '1'), 1)
+        self.assertEqual(g.depthOf('eggs', '1'), 0)
+        self.assertEqual(g.depthOf('pie', '1'), 0)
+        self.assertEqual(g.freeze().depthOf('cake', '1'), 2)
+        
+        g.addPath('eggs', '1', [('chicken', '1')])
+        self.assertEqual(g.depthOf('cake', '1'), 3)
+        g.removePath('eggs', '1', [('chicken', '1')])
+        self.assertEqual(g.depthOf('cake', '1'), 2)
+        g.addPaths([('chicken', '1', [('egg', '1')])])
+        self.assertEqual(g.depthOf('chicken', '1'), 1)
+
+
+    def test_depthOf_deepChain(self):
+        """
+        Very deep gardens are fine.
+        """
+        g = Garden()
+        for i in xrange(2000):
+            g.addPath(str(i + 1), 'v1', [(str(i), 'v1')])
+        self.assertEqual(g.depthOf('2000', 'v1'), 2000)
+        self.assertEqual(g.freeze().depthOf('2000', 'v1'), 2000)
+
+
+
+class FrozenGardenTest(TestCase):
+
+
+    def mkGarden(self):
+        g = Garden()
+        g.addPath('letter', 'v1', [
+            ('percent', 'v1'),
+        ])
+        g.addPath('percent', 'v1', [
+            ('assignments', 'v1'),
+            ('exams', 'v1'),
+        ])
+        g.addPath('letter', 'v1', [
+            ('percent', 'v2'),
+        ])
+        return g
+
+
+    def test_freeze(self):
+        """
+        A frozen garden has the same paths as the garden it came from.
+        """
+        g = self.mkGarden()
+        f = g.freeze()
+        self.assertTrue(isinstance(f, FrozenGarden))
+        for node in ['letter', 'percent', 'assignments', 'exams']:
+            for version in ['v1', 'v2']:
+                self.assertEqual(list(f.pathsRequiring(node, version)),
+                                 list(g.pathsRequiring(node, version)))
+                self.assertEqual([list(x) for x in f.inputsFor(node, version)],
+                                 list(g.inputsFor(node, version)))
+        self.assertTrue(f.hasPath('percent', 'v1', [
+            ('assignments', 'v1'),
+            ('exams', 'v1'),
+        ]))
+        self.assertTrue(f.hasPath('letter', 'v1', [('percent', 'v2')]))
+        self.assertFalse(f.hasPath('letter', 'v1', [('percent', 'v3')]))
+        self.assertFalse(f.hasPath('letter', 'v1', []))
+        self.assertFalse(f.hasPath('percent', 'v1', [('assignments', 'v1')]))
+        self.assertFalse(f.hasPath('nothing', 'v1', []))
+
+
+    def test_missing(self):
+        """
+        Looking up things that aren't there returns nothing.
+        """
+        f = self.mkGarden().freeze()
+        self.assertEqual(f.pathsRequiring('nothing', 'v1'), ())
+        self.assertEqual(f.inputsFor('nothing', 'v1'), ())
+        self.assertEqual(f.inputsFor('exams', 'v1'), ())
+        self.assertEqual(f.pathsRequiring('letter', 'v1'), ())
+
+
+    def test_lookupsBuiltOnce(self):
+        """
+        The same tuples are returned each time, rather than new ones built
+        for every lookup, whether the garden was frozen or loaded.
+        """
+        g = self.mkGarden()
+        fh = StringIO()
+        g.dump(fh)
+        for f in [g.freeze(), loadGarden(StringIO(fh.getvalue()))]:
+            self.assertIdentical(f.inputsFor('letter', 'v1'),
+                                 f.inputsFor('letter', 'v1'))
+            self.assertIdentical(f.pathsRequiring('percent', 'v1'),
+                                 f.pathsRequiring('percent', 'v1'))
+            self.assertEqual(f.pathsRequiring('percent', 'v1'),
+                             (('letter', 'v1'),))
+
+
+    def test_reachability(self):
+        """
+        A frozen garden can answer upstream and downstream questions too.
+        """
+        g = self.mkGarden()
+        f = g.freeze()
+        self.assertEqual(f.downstreamOf('exams', 'v1'), (
+            ('percent', 'v1'),
+            ('letter', 'v1'),
+        ))
+        self.assertEqual(f.upstreamOf('letter', 'v1'),
+                         g.upstreamOf('letter', 'v1'))
+        self.assertEqual(set(f.upstreamOf('letter', 'v1')), set([
+            ('assignments', 'v1'),
+            ('exams', 'v1'),
+            ('percent', 'v1'),
+            ('percent', 'v2'),
+        ]))
+        self.assertEqual(f.upstreamOf('nothing', 'v1'), ())
+
+
+    def test_snapshot(self):
+        """
+        Paths added to a garden after it's frozen aren't in the frozen one.
+        """
+        g = self.mkGarden()
+        f = g.freeze()
+        g.addPath('letter', 'v2', [
+            ('percent', 'v1'),
+        ])
+        self.assertEqual(f.inputsFor('letter', 'v2'), ())
+        self.assertEqual(f.pathsRequiring('percent', 'v1'), (('letter', 'v1'),))
+
+
+    def test_dump(self):
+        """
+        A garden can be written to a file and loaded back.
+        """
+        g = self.mkGarden()
+        fh = StringIO()
+        g.dump(fh)
+        
+        f = loadGarden(StringIO(fh.getvalue()))
+        self.assertTrue(isinstance(f, FrozenGarden))
+        expected = g.freeze()
+        for node in ['letter', 'percent', 'assignments', 'exams']:
+            for version in ['v1', 'v2']:
+                self.assertEqual(f.pathsRequiring(node, version),
+                                 expected.pathsRequiring(node, version))
+                self.assertEqual(f.inputsFor(node, version),
+                                 expected.inputsFor(node, version))
+                self.assertEqual(f.downstreamOf(node, version),
+                                 expected.downstreamOf(node, version))
+        self.assertTrue(f.hasPath('letter', 'v1', [('percent', 'v2')]))
+
+
+    def test_dump_empty(self):
+        """
+        Empty gardens can be dumped and loaded too.
+        """
+        fh = StringIO()
+        Garden().dump(fh)
+        f = loadGarden(StringIO(fh.getvalue()))
+        self.assertEqual(f.inputsFor('foo', 'v1'), ())
+
+
+    def test_load_garbage(self):
+        """
+        Loading something that isn't a dumped garden fails.
+        """
+        self.assertRaises(ValueError, loadGarden, StringIO('garbage'))
+        
+        fh = StringIO()
+        self.mkGarden().dump(fh)
+        self.assertRaises(ValueError, loadGarden, StringIO(fh.getvalue()[:-3]))
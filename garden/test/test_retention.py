@@ -0,0 +1,176 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, task
+
+from mock import create_autospec
+
+from garden.retention import LineageCollector
+from garden.store import InMemoryStore
+from garden import path
+from garden.path import Garden
+from garden.data import Data, linealHash
+from garden.util import LRUCache
+
+
+
+class FakeGardener(object):
+
+
+    def __init__(self, garden):
+        self.garden = garden
+
+
+
+class LineageCollectorTest(TestCase):
+
+
+    def setUp(self):
+        self.garden = Garden()
+        self.garden.addPath('cake', '1', [
+            ('eggs', '1'),
+        ])
+        self.gardener = FakeGardener(self.garden)
+        self.store = InMemoryStore()
+        self.eggs = linealHash('eggs', '1')
+        self.cake = linealHash('cake', '1', [self.eggs])
+        self.old_cake = linealHash('cake', '1', [linealHash('eggs', '0')])
+
+
+    def put(self, entity, name, version, lineage, value='value'):
+        self.store.put(Data(entity, name, version, lineage, value))
+
+
+    def test_staleKeys(self):
+        """
+        Computed data for things that aren't in the garden, or with lineages
+        the garden doesn't lead to, is stale.
+        """
+        pie = linealHash('pie', '1', [self.eggs])
+        c = LineageCollector(self.gardener, self.store)
+        self.assertEqual(c.staleKeys([
+            Data('Bob', 'eggs', '1', self.eggs, 'value'),
+            Data('Bob', 'cake', '1', self.cake, 'value'),
+            Data('Bob', 'cake', '1', self.old_cake, 'value'),
+            Data('Bob', 'pie', '1', pie, 'value'),
+        ]), [
+            ('cake', '1', self.old_cake),
+            ('pie', '1', pie),
+        ])
+
+
+    def test_staleKeys_inputs(self):
+        """
+        Input data is never stale, even if it isn't in the garden, since it
+        can't be computed again.
+        """
+        c = LineageCollector(self.gardener, self.store)
+        self.assertEqual(c.staleKeys([
+            Data('Bob', 'eggs', '0', linealHash('eggs', '0'), 'value'),
+            Data('Bob', 'cake', '1', linealHash('cake', '1'), 'value'),
+        ]), [])
+
+
+    def test_staleKeys_tooManyLineages(self):
+        """
+        Data with too many lineages to list isn't taken to be stale.
+        """
+        self.patch(path, 'MAX_LINEAGES', 1)
+        c = LineageCollector(self.gardener, self.store)
+        self.assertEqual(c.staleKeys([
+            Data('Bob', 'cake', '1', self.old_cake, 'value'),
+        ]), [])
+
+
+    def test_run(self):
+        """
+        Stale data is deleted from every entity.
+        """
+        for entity in ['Bob', 'Sam']:
+            self.put(entity, 'eggs', '1', self.eggs)
+            self.put(entity, 'cake', '1', self.cake)
+            self.put(entity, 'cake', '1', self.old_cake)
+        c = LineageCollector(self.gardener, self.store)
+        self.assertEqual(self.successResultOf(c.run()), 2)
+        self.assertEqual(c.entities_done, 2)
+        for entity in ['Bob', 'Sam']:
+            r = self.successResultOf(self.store.get(entity, 'cake', '1'))
+            self.assertEqual(r, [Data(entity, 'cake', '1', self.cake, 'value')])
+
+
+    def test_newGarden(self):
+        """
+        The gardener's current garden is used.
+        """
+        self.put('Bob', 'cake', '1', self.cake)
+        garden = Garden()
+        garden.addPath('cake', '2', [('eggs', '1')])
+        self.gardener.garden = garden
+        c = LineageCollector(self.gardener, self.store)
+        self.assertEqual(self.successResultOf(c.run()), 1)
+        self.assertEqual(self.successResultOf(self.store.entities()), [])
+
+
+    def test_batches(self):
+        """
+        Deleting is done a few at a time with a delay in between.
+        """
+        for i in xrange(5):
+            self.put('Bob', 'pie', '1', str(i))
+        self.store.delete = create_autospec(self.store.delete,
+                                            side_effect=self.store.delete)
+        clock = task.Clock()
+        c = LineageCollector(self.gardener, self.store, batch_size=2,
+                             delay=1, reactor=clock)
+        d = c.run()
+        self.assertEqual(self.store.delete.call_count, 1)
+        clock.advance(1)
+        self.assertEqual(self.store.delete.call_count, 2)
+        c.stop()
+        clock.advance(1)
+        self.assertEqual(self.successResultOf(d), 4)
+        self.assertEqual(self.store.delete.call_count, 2)
+        self.assertEqual(len(self.successResultOf(self.store.get('Bob'))), 1)
+
+
+    def test_pages(self):
+        """
+        An entity's data is looked at a page at a time.
+        """
+        for i in xrange(5):
+            self.put('Bob', 'pie', '1', str(i))
+        self.put('Bob', 'eggs', '1', self.eggs)
+        self.store.getPage = create_autospec(self.store.getPage,
+                                             side_effect=self.store.getPage)
+        c = LineageCollector(self.gardener, self.store, page_size=2)
+        self.assertEqual(self.successResultOf(c.collectEntity('Bob')), 5)
+        self.assertEqual(self.store.getPage.call_count, 3)
+        self.assertEqual(self.successResultOf(self.store.get('Bob')), [
+            Data('Bob', 'eggs', '1', self.eggs, 'value'),
+        ])
+
+
+    def test_forgetHashes(self):
+        """
+        If the gardener caches hashes, the hashes of deleted data are
+        forgotten.
+        """
+        self.put('Bob', 'cake', '1', self.cake)
+        self.put('Bob', 'cake', '1', self.old_cake)
+        self.gardener.hashes = LRUCache(10)
+        self.gardener.hashes[('Bob', 'cake', '1', self.cake)] = 'hash1'
+        self.gardener.hashes[('Bob', 'cake', '1', self.old_cake)] = 'hash2'
+        c = LineageCollector(self.gardener, self.store)
+        self.successResultOf(c.run())
+        self.assertEqual(self.gardener.hashes.get(('Bob', 'cake', '1',
+                                                   self.cake)), 'hash1')
+        self.assertNotIn(('Bob', 'cake', '1', self.old_cake),
+                         self.gardener.hashes)
+
+
+    def test_error(self):
+        """
+        Errors deleting stop the run.
+        """
+        self.put('Bob', 'pie', '1', 'xxxx')
+        self.store.delete = lambda *a: defer.fail(ValueError('foo'))
+        c = LineageCollector(self.gardener, self.store)
+        self.failureResultOf(c.run(), ValueError)
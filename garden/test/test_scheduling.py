@@ -0,0 +1,414 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, task
+
+from zope.interface.verify import verifyObject
+
+from garden.interface import IReceiver, ISourceable, ISource, IWork
+from garden.scheduling import (WorkCoalescer, WorkQueue, InFlight,
+                               depthPriority, pathPriority)
+from garden.path import Garden
+from garden.data import Work
+from garden.test.fake import FakeReceiver
+
+
+
+def mkWork(entity, value, lineage='xxxx'):
+    return Work(entity, 'cake', '1', lineage, [('eggs', '1', 'aaaa', value)])
+
+
+
+class FakeProducer(object):
+
+    paused = 0
+    resumed = 0
+
+
+    def pauseProducing(self):
+        self.paused += 1
+
+
+    def resumeProducing(self):
+        self.resumed += 1
+
+
+
+class InFlightTest(TestCase):
+
+
+    def setUp(self):
+        self.released = []
+        self.tracker = InFlight(lambda: self.released.append(True))
+
+
+    def test_workDone(self):
+        """
+        All the work for the destination and path of a result is released
+        when the result comes back, and only once.
+        """
+        passedOn1 = self.tracker.hold(mkWork('bob', 'foo'))
+        self.tracker.hold(mkWork('bob', 'bar'))
+        self.tracker.hold(mkWork('joe', 'foo'))
+        self.assertEqual(len(self.tracker), 3)
+
+        self.tracker.workDone(mkWork('bob', 'foo').toResult('value'))
+        self.assertEqual(len(self.released), 2)
+        self.assertEqual(len(self.tracker), 1)
+
+        passedOn1('done')
+        self.assertEqual(len(self.released), 2)
+
+
+    def test_passedOn(self):
+        """
+        Work is released when passing it on finishes, if no result came back
+        first.
+        """
+        passedOn = self.tracker.hold(mkWork('bob', 'foo'))
+        self.assertEqual(passedOn('done'), 'done')
+        self.assertEqual(len(self.released), 1)
+        self.assertEqual(len(self.tracker), 0)
+
+        self.tracker.workDone(mkWork('bob', 'foo').toResultError('error'))
+        self.assertEqual(len(self.released), 1)
+
+
+
+class WorkCoalescerTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.recv = FakeReceiver([IWork])
+
+
+    def mkCoalescer(self, *args, **kwargs):
+        c = WorkCoalescer(reactor=self.clock, *args, **kwargs)
+        ISource(c).subscribe(self.recv)
+        return c
+
+
+    def test_IReceiver(self):
+        verifyObject(IReceiver, WorkCoalescer(1))
+
+
+    def test_ISourceable(self):
+        verifyObject(ISourceable, WorkCoalescer(1))
+
+
+    def test_delay(self):
+        """
+        Work is passed on once nothing more has come in for it for a while.
+        """
+        c = self.mkCoalescer(5)
+        d = c.workReceived(mkWork('bob', 'foo'))
+        self.clock.advance(4)
+        self.assertEqual(self.recv.receive.call_count, 0)
+        self.assertNoResult(d)
+        self.assertEqual(c.pending(), 1)
+
+        self.clock.advance(1)
+        self.recv.receive.assert_called_once_with(mkWork('bob', 'foo'))
+        self.successResultOf(d)
+        self.assertEqual(c.pending(), 0)
+
+
+    def test_coalesce(self):
+        """
+        Only the latest work for the same destination and path is passed on,
+        and more work makes the wait start over.
+        """
+        c = self.mkCoalescer(5)
+        d1 = c.workReceived(mkWork('bob', 'foo'))
+        self.clock.advance(3)
+        d2 = c.workReceived(mkWork('bob', 'bar'))
+        c.workReceived(mkWork('bob', 'foo', lineage='yyyy'))
+        c.workReceived(mkWork('joe', 'foo'))
+        self.assertEqual(c.coalesced, 1)
+
+        self.clock.advance(2)
+        self.assertEqual(self.recv.receive.call_count, 0)
+        self.assertNoResult(d1)
+
+        self.clock.advance(3)
+        self.assertEqual(self.recv.receive.call_count, 3)
+        self.assertIn(mkWork('bob', 'bar'),
+                      [x[0][0] for x in self.recv.receive.call_args_list])
+        self.assertNotIn(mkWork('bob', 'foo'),
+                         [x[0][0] for x in self.recv.receive.call_args_list])
+        self.assertEqual(self.successResultOf(d1), self.successResultOf(d2))
+
+
+    def test_maxDelay(self):
+        """
+        Work isn't held longer than C{max_delay} even if more keeps coming.
+        """
+        c = self.mkCoalescer(5, max_delay=8)
+        c.workReceived(mkWork('bob', 'foo'))
+        self.clock.advance(4)
+        c.workReceived(mkWork('bob', 'bar'))
+        self.clock.advance(3)
+        c.workReceived(mkWork('bob', 'baz'))
+        self.assertEqual(self.recv.receive.call_count, 0)
+        self.clock.advance(1)
+        self.recv.receive.assert_called_once_with(mkWork('bob', 'baz'))
+
+
+    def test_error(self):
+        """
+        If passing the work on fails, everything waiting on it fails.
+        """
+        self.recv = FakeReceiver([IWork],
+                                 lambda x: defer.fail(Exception('foo')))
+        c = self.mkCoalescer(5)
+        d1 = c.workReceived(mkWork('bob', 'foo'))
+        d2 = c.workReceived(mkWork('bob', 'bar'))
+        self.clock.advance(5)
+        self.failureResultOf(d1)
+        self.failureResultOf(d2)
+
+
+    def test_flush(self):
+        """
+        You can pass on all held work right away.
+        """
+        c = self.mkCoalescer(5)
+        d = c.workReceived(mkWork('bob', 'foo'))
+        c.workReceived(mkWork('joe', 'foo'))
+        self.successResultOf(c.flush())
+        self.assertEqual(self.recv.receive.call_count, 2)
+        self.successResultOf(d)
+        self.assertEqual(c.pending(), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
+class depthPriorityTest(TestCase):
+
+
+    def test_depth(self):
+        """
+        The depth is the number of paths in the longest chain leading to the
+        destination.
+        """
+        garden = Garden()
+        garden.addPath('mix', '1', [('eggs', '1'), ('flour', '1')])
+        garden.addPath('cake', '1', [('mix', '1'), ('eggs', '1')])
+        garden.addPath('cake', '1', [('flour', '1')])
+        self.assertEqual(depthPriority(garden, mkWork('bob', 'foo')), 2)
+        self.assertEqual(depthPriority(garden, Work('bob', 'mix', '1', 'xxxx',
+                                                    [])), 1)
+        self.assertEqual(depthPriority(garden, Work('bob', 'eggs', '1', 'xxxx',
+                                                    [])), 0)
+
+
+
+class pathPriorityTest(TestCase):
+
+
+    def test_priority(self):
+        """
+        Priorities come from a dictionary, with a default.
+        """
+        priority = pathPriority({('cake', '1'): 5}, default=2)
+        self.assertEqual(priority(None, mkWork('bob', 'foo')), 5)
+        self.assertEqual(priority(None, Work('bob', 'mix', '1', 'xxxx', [])), 2)
+
+
+
+class WorkQueueTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.recv = FakeReceiver([IWork], lambda x: defer.Deferred())
+
+
+    def mkQueue(self, *args, **kwargs):
+        q = WorkQueue(reactor=self.clock, *args, **kwargs)
+        ISource(q).subscribe(self.recv)
+        return q
+
+
+    def sent(self):
+        return [x[0][0] for x in self.recv.receive.call_args_list]
+
+
+    def test_IReceiver(self):
+        verifyObject(IReceiver, WorkQueue())
+
+
+    def test_ISourceable(self):
+        verifyObject(ISourceable, WorkQueue())
+
+
+    def test_concurrency(self):
+        """
+        No more than C{concurrency} pieces of work are passed on and not done
+        at once.
+        """
+        q = self.mkQueue(concurrency=2)
+        d1 = q.workReceived(mkWork('a', '1'))
+        q.workReceived(mkWork('a', '2'))
+        q.workReceived(mkWork('a', '3'))
+        self.assertEqual(self.sent(), [mkWork('a', '1'), mkWork('a', '2')])
+
+        self.recv.results[0].callback('done')
+        self.assertEqual(self.successResultOf(d1)[0], (True, 'done'))
+        self.assertEqual(self.sent()[-1], mkWork('a', '3'))
+
+
+    def test_fairness(self):
+        """
+        Entities take turns, so work for an entity with little queued isn't
+        stuck behind all the work of one with a lot.
+        """
+        q = self.mkQueue(concurrency=1)
+        for i in xrange(4):
+            q.workReceived(mkWork('bulk', str(i)))
+        q.workReceived(mkWork('joe', 'foo'))
+        for i in xrange(4):
+            self.recv.results[i].callback('done')
+        self.assertEqual(self.sent(), [
+            mkWork('bulk', '0'),
+            mkWork('bulk', '1'),
+            mkWork('joe', 'foo'),
+            mkWork('bulk', '2'),
+            mkWork('bulk', '3'),
+        ])
+
+
+    def test_entityWeight(self):
+        """
+        Entities with more weight get more turns.
+        """
+        q = self.mkQueue(concurrency=1,
+                         entity_weight=lambda e: 2 if e == 'big' else 1)
+        q.workReceived(mkWork('first', 'foo'))
+        for i in xrange(4):
+            q.workReceived(mkWork('big', str(i)))
+            q.workReceived(mkWork('small', str(i)))
+        for i in xrange(6):
+            self.recv.results[i].callback('done')
+        self.assertEqual([x.entity for x in self.sent()[1:]],
+                         ['big', 'small', 'big', 'big', 'small', 'big'])
+
+
+    def test_priority(self):
+        """
+        Work with a lower priority goes first.
+        """
+        q = self.mkQueue(concurrency=1, garden='garden',
+                         priority=lambda g, w: -int(w.inputs[0].value))
+        q.workReceived(mkWork('a', '0'))
+        q.workReceived(mkWork('a', '1'))
+        q.workReceived(mkWork('b', '3'))
+        q.workReceived(mkWork('c', '2'))
+        for i in xrange(3):
+            self.recv.results[i].callback('done')
+        self.assertEqual([x.inputs[0].value for x in self.sent()],
+                         ['0', '3', '2', '1'])
+
+
+    def test_synchronous(self):
+        """
+        Work that's done right away doesn't pile up the stack.
+        """
+        self.recv = FakeReceiver([IWork])
+        q = self.mkQueue(concurrency=1)
+        for i in xrange(2000):
+            q.workReceived(mkWork(str(i), 'foo'))
+        self.assertEqual(self.recv.receive.call_count, 2000)
+        self.assertEqual(q.in_flight, 0)
+
+
+    def test_workDone(self):
+        """
+        Work is done once a result for it comes back, even if passing it on
+        hasn't finished.
+        """
+        q = self.mkQueue(concurrency=1)
+        d1 = q.workReceived(mkWork('a', '1'))
+        q.workReceived(mkWork('b', '2'))
+        q.workDone(mkWork('a', '1').toResult('value'))
+        self.assertEqual(self.sent(), [mkWork('a', '1'), mkWork('b', '2')])
+        self.assertEqual(q.in_flight, 1)
+
+        self.recv.results[0].callback('done')
+        self.successResultOf(d1)
+        self.assertEqual(q.in_flight, 1)
+
+
+    def test_error(self):
+        """
+        Work that fails makes room for more, and the failure is passed back.
+        """
+        self.recv = FakeReceiver([IWork],
+                                 lambda x: defer.fail(Exception('foo')))
+        q = self.mkQueue(concurrency=1)
+        d1 = q.workReceived(mkWork('a', '1'))
+        d2 = q.workReceived(mkWork('a', '2'))
+        self.failureResultOf(d1)
+        self.failureResultOf(d2)
+        self.assertEqual(q.in_flight, 0)
+
+
+    def test_stats(self):
+        """
+        You can see how much work is queued and how long it waited.
+        """
+        q = self.mkQueue(concurrency=1)
+        q.workReceived(mkWork('a', '1'))
+        q.workReceived(mkWork('a', '2'))
+        q.workReceived(mkWork('a', '3'))
+        self.assertEqual(q.stats(), {
+            'queued': 2,
+            'in_flight': 1,
+            'paused': False,
+            'dispatched': 1,
+            'mean_wait': 0,
+            'max_wait': 0,
+        })
+        self.clock.advance(4)
+        self.recv.results[0].callback('done')
+        self.clock.advance(2)
+        self.recv.results[1].callback('done')
+        self.assertEqual(q.stats(), {
+            'queued': 0,
+            'in_flight': 1,
+            'paused': False,
+            'dispatched': 3,
+            'mean_wait': 10 / 3.0,
+            'max_wait': 6,
+        })
+
+
+    def test_maxQueued(self):
+        """
+        Producers are paused while C{max_queued} work is queued, until half of
+        it has been passed on.
+        """
+        producer = FakeProducer()
+        q = self.mkQueue(concurrency=1, max_queued=4)
+        q.registerProducer(producer)
+        for i in xrange(4):
+            q.workReceived(mkWork('a', str(i)))
+        self.assertEqual(producer.paused, 0)
+
+        q.workReceived(mkWork('a', '4'))
+        self.assertEqual(producer.paused, 1)
+        self.assertTrue(q.stats()['paused'])
+
+        late = FakeProducer()
+        q.registerProducer(late)
+        self.assertEqual(late.paused, 1)
+
+        q.workReceived(mkWork('a', '5'))
+        self.assertEqual(producer.paused, 1)
+
+        for i in xrange(2):
+            self.recv.results[i].callback('done')
+        self.assertEqual(producer.resumed, 0)
+        self.recv.results[2].callback('done')
+        self.assertEqual(producer.resumed, 1)
+        self.assertEqual(late.resumed, 1)
+        self.assertFalse(q.paused)
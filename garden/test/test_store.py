@@ -1,12 +1,17 @@
 from twisted.trial.unittest import TestCase
 from twisted.python.filepath import FilePath
-from twisted.internet import defer
+from twisted.internet import defer, task
 from zope.interface.verify import verifyObject
 
+from mock import create_autospec
+import os
+
 
 from garden.interface import IDataStore
-from garden.store import SqliteStore, InMemoryStore
-from garden.data import Data
+from garden import store as store_module
+from garden.store import (SqliteStore, InMemoryStore, CachingStore, LogStore,
+                          ShardedStore, eachPage, sqlite, _RECORD)
+from garden.data import Data, valueHash
 
 
 
@@ -66,6 +71,31 @@ class IDataStoreTestMixin(object):
         ])
 
 
+    @defer.inlineCallbacks
+    def test_IDataStore_putMany(self):
+        """
+        You can put a bunch of things in at once and find out which of them
+        changed.
+        """
+        store = self.getInstance()
+        yield store.put(Data('Sam', 'cake', '1', 'ffff', 'value'))
+        r = yield store.putMany([
+            Data('Sam', 'cake', '1', 'ffff', 'value'),
+            Data('Sam', 'cake', '2', 'ffff', 'value'),
+            Data('Bob', 'cake', '1', 'ffff', 'value'),
+            Data('Bob', 'cake', '1', 'ffff', 'new value'),
+            Data('Bob', 'cake', '1', 'ffff', 'new value'),
+        ])
+        self.assertEqual([x['changed'] for x in r], [
+            False, True, True, True, False])
+        
+        r = yield store.get('Bob', 'cake', '1', 'ffff')
+        self.assertEqual(r, [Data('Bob', 'cake', '1', 'ffff', 'new value')])
+        
+        r = yield store.putMany([])
+        self.assertEqual(r, [])
+
+
     @defer.inlineCallbacks
     def test_IDataStore_get_many(self):
         """
@@ -144,6 +174,355 @@ class IDataStoreTestMixin(object):
 
 
 
+    @defer.inlineCallbacks
+    def test_getMany(self):
+        """
+        You can get the data for several names and versions (and lineages) of
+        an entity at once.
+        """
+        store = self.getInstance()
+        yield store.putMany([
+            Data('Sam', 'cake', '1', 'ffff', 'value 1'),
+            Data('Sam', 'cake', '1', 'gggg', 'value 2'),
+            Data('Sam', 'flour', '1', 'ffff', 'value 3'),
+            Data('Bob', 'cake', '1', 'ffff', 'value 4'),
+        ])
+        r = yield store.getMany('Sam', [
+            ('cake', '1'),
+            ('flour', '1', 'ffff'),
+            ('flour', '1', 'gggg'),
+            ('eggs', '1'),
+            ('cake', '1', 'gggg'),
+            ('cake', '1'),
+        ])
+        self.assertEqual(r[0], [
+            Data('Sam', 'cake', '1', 'ffff', 'value 1'),
+            Data('Sam', 'cake', '1', 'gggg', 'value 2'),
+        ])
+        self.assertEqual(r[1:], [
+            [Data('Sam', 'flour', '1', 'ffff', 'value 3')],
+            [],
+            [],
+            [Data('Sam', 'cake', '1', 'gggg', 'value 2')],
+            r[0],
+        ])
+        
+        r = yield store.getMany('Sam', [])
+        self.assertEqual(r, [])
+
+
+    @defer.inlineCallbacks
+    def test_getMany_overlappingMany(self):
+        """
+        Data asked for by overlapping keys comes back once for each key, even
+        when there are too many keys to get in one go.
+        """
+        store = self.getInstance()
+        yield store.putMany([
+            Data('Sam', 'cake', '1', 'ffff', 'value 1'),
+            Data('Sam', 'cake', '1', 'gggg', 'value 2'),
+        ])
+        keys = [('cake', '1')]
+        keys.extend([('flour', str(x)) for x in xrange(500)])
+        keys.append(('cake', '1', 'gggg'))
+        keys.append(('cake', '1'))
+        r = yield store.getMany('Sam', keys)
+        self.assertEqual(sorted(r[0]), [
+            Data('Sam', 'cake', '1', 'ffff', 'value 1'),
+            Data('Sam', 'cake', '1', 'gggg', 'value 2'),
+        ])
+        self.assertEqual(r[-2], [Data('Sam', 'cake', '1', 'gggg', 'value 2')])
+        self.assertEqual(sorted(r[-1]), sorted(r[0]))
+        self.assertEqual(sum([len(x) for x in r[1:-2]]), 0)
+
+
+    @defer.inlineCallbacks
+    def test_getManyEntities(self):
+        """
+        You can get data for several entities at once.
+        """
+        store = self.getInstance()
+        yield store.putMany([
+            Data('Sam', 'cake', '1', 'ffff', 'value 1'),
+            Data('Bob', 'cake', '1', 'ffff', 'value 2'),
+        ])
+        r = yield store.getManyEntities([
+            ('Bob', 'cake', '1'),
+            ('Sam', 'cake', '1', 'ffff'),
+            ('Joe', 'cake', '1'),
+        ])
+        self.assertEqual(r, [
+            [Data('Bob', 'cake', '1', 'ffff', 'value 2')],
+            [Data('Sam', 'cake', '1', 'ffff', 'value 1')],
+            [],
+        ])
+        
+        # lots of them
+        keys = [('Sam', 'cake', str(x)) for x in xrange(1000)]
+        r = yield store.getManyEntities(keys)
+        self.assertEqual(r[1], [Data('Sam', 'cake', '1', 'ffff', 'value 1')])
+        self.assertEqual(sum([len(x) for x in r]), 1)
+
+
+    @defer.inlineCallbacks
+    def test_getHashes(self):
+        """
+        You can get the hashes of values without getting the values.
+        """
+        store = self.getInstance()
+        yield store.putMany([
+            Data('Sam', 'cake', '1', 'ffff', 'value 1'),
+            Data('Sam', 'cake', '1', 'gggg', 'value 2'),
+            Data('Bob', 'cake', '1', 'ffff', 'value 3'),
+        ])
+        yield store.put(Data('Sam', 'cake', '1', 'gggg', 'value 4'))
+        r = yield store.getHashes('Sam', [
+            ('cake', '1', 'gggg'),
+            ('cake', '1', 'ffff'),
+            ('cake', '1', 'hhhh'),
+            ('cake', '2', 'ffff'),
+        ])
+        self.assertEqual(r, [
+            valueHash('value 4'),
+            valueHash('value 1'),
+            None,
+            None,
+        ])
+        
+        r = yield store.getHashes('Sam', [])
+        self.assertEqual(r, [])
+
+
+    @defer.inlineCallbacks
+    def test_entities(self):
+        """
+        You can list the entities that have data, optionally only those with
+        data of a particular name and/or version.
+        """
+        store = self.getInstance()
+        r = yield store.entities()
+        self.assertEqual(r, [])
+        
+        data = [
+            Data('Sam', 'cake', '1', 'ffff', 'value 1'),
+            Data('Sam', 'cake', '2', 'ffff', 'value 2'),
+            Data('Sam', 'flour', '1', 'ffff', 'value 4'),
+            Data('Bob', 'cake', '1', 'aaaa', 'value 6'),
+            Data('Bob', 'cake', '1', 'bbbb', 'value 7'),
+            Data('Joe', 'apples', '2', 'bbbb', 'value 7'),
+        ]
+        for d in data:
+            yield store.put(d)
+        
+        r = yield store.entities()
+        self.assertEqual(r, ['Bob', 'Joe', 'Sam'])
+        
+        r = yield store.entities('cake')
+        self.assertEqual(r, ['Bob', 'Sam'])
+        
+        r = yield store.entities('cake', '2')
+        self.assertEqual(r, ['Sam'])
+        
+        r = yield store.entities(version='2')
+        self.assertEqual(r, ['Joe', 'Sam'])
+        
+        r = yield store.entities('nothing')
+        self.assertEqual(r, [])
+
+
+    @defer.inlineCallbacks
+    def test_getPage(self):
+        """
+        You can get an entity's data a page at a time.
+        """
+        store = self.getInstance()
+        data = []
+        for i in xrange(7):
+            data.append(Data('Sam', 'cake', '1', 'lineage %d' % (i,),
+                             'value %d' % (i,)))
+        data.append(Data('Sam', 'flour', '1', 'ffff', 'value'))
+        yield store.putMany(data)
+        yield store.put(Data('Bob', 'cake', '1', 'ffff', 'value'))
+        
+        pages = []
+        after = None
+        while True:
+            page, after = yield store.getPage('Sam', after=after, limit=3)
+            pages.append(page)
+            if after is None:
+                break
+        self.assertEqual([len(x) for x in pages], [3, 3, 2])
+        self.assertEqual(sorted(sum(pages, [])), sorted(data))
+        
+        page, after = yield store.getPage('Sam', 'cake', '1', limit=7)
+        self.assertEqual(sorted(page), sorted(data[:7]))
+        self.assertEqual(after, None)
+        
+        page, after = yield store.getPage('Sam', 'flour', limit=1)
+        self.assertEqual(page, [data[7]])
+        self.assertEqual(after, None)
+        
+        page, after = yield store.getPage('Sam', 'cake', '2')
+        self.assertEqual((page, after), ([], None))
+        page, after = yield store.getPage('Nobody')
+        self.assertEqual((page, after), ([], None))
+
+
+    @defer.inlineCallbacks
+    def test_getPage_changing(self):
+        """
+        Data deleted between pages doesn't make the next page skip anything.
+        """
+        store = self.getInstance()
+        yield store.putMany([Data('Sam', 'cake', '1', str(i), 'value')
+                             for i in xrange(6)])
+        page1, after = yield store.getPage('Sam', limit=3)
+        yield store.delete('Sam', [(x.name, x.version, x.lineage)
+                                   for x in page1])
+        page2, after = yield store.getPage('Sam', after=after, limit=3)
+        self.assertEqual(after, None)
+        self.assertEqual(sorted([x.lineage for x in page1 + page2]),
+                         [str(i) for i in xrange(6)])
+
+
+    @defer.inlineCallbacks
+    def test_getPage_added(self):
+        """
+        Data added or deleted between pages doesn't make a later page repeat
+        the data already gotten or skip data that's still there.
+        """
+        store = self.getInstance()
+        yield store.putMany([Data('Sam', 'cake', '1', str(i), 'value')
+                             for i in [1, 3, 5, 7]])
+        page1, after = yield store.getPage('Sam', limit=2)
+        yield store.putMany([Data('Sam', 'cake', '1', str(i), 'value')
+                             for i in [0, 4, 8]])
+        yield store.delete('Sam', [('cake', '1', '5')])
+        page2, after = yield store.getPage('Sam', after=after, limit=10)
+        got = [x.lineage for x in page1 + page2]
+        self.assertEqual(len(got), len(set(got)))
+        self.assertEqual(set(['1', '3', '7']) - set(got), set())
+        self.assertNotIn('5', [x.lineage for x in page2])
+        self.assertEqual(after, None)
+
+
+    @defer.inlineCallbacks
+    def test_getPage_version(self):
+        """
+        You can page through the data for a version of every name.
+        """
+        store = self.getInstance()
+        yield store.putMany([
+            Data('Sam', 'cake', '1', 'ffff', 'value'),
+            Data('Sam', 'cake', '2', 'ffff', 'value'),
+            Data('Sam', 'flour', '1', 'ffff', 'value'),
+            Data('Sam', 'pie', '2', 'ffff', 'value'),
+        ])
+        page, after = yield store.getPage('Sam', version='2', limit=1)
+        self.assertEqual(page, [Data('Sam', 'cake', '2', 'ffff', 'value')])
+        page, after = yield store.getPage('Sam', version='2', after=after)
+        self.assertEqual(page, [Data('Sam', 'pie', '2', 'ffff', 'value')])
+        self.assertEqual(after, None)
+
+
+    @defer.inlineCallbacks
+    def test_delete(self):
+        """
+        You can delete data points of an entity, and find out how many were
+        deleted.
+        """
+        store = self.getInstance()
+        yield store.putMany([
+            Data('Sam', 'cake', '1', 'ffff', 'value 1'),
+            Data('Sam', 'cake', '1', 'gggg', 'value 2'),
+            Data('Sam', 'flour', '1', 'ffff', 'value 3'),
+            Data('Bob', 'cake', '1', 'ffff', 'value 1'),
+        ])
+        r = yield store.delete('Sam', [
+            ('cake', '1', 'gggg'),
+            ('flour', '1', 'ffff'),
+            ('cake', '1', 'hhhh'),
+        ])
+        self.assertEqual(r, 2)
+        
+        r = yield store.get('Sam')
+        self.assertEqual(r, [Data('Sam', 'cake', '1', 'ffff', 'value 1')])
+        r = yield store.getMany('Sam', [('cake', '1'), ('flour', '1')])
+        self.assertEqual(r, [
+            [Data('Sam', 'cake', '1', 'ffff', 'value 1')],
+            [],
+        ])
+        r = yield store.getHashes('Sam', [('cake', '1', 'gggg')])
+        self.assertEqual(r, [None])
+        r = yield store.entities('flour')
+        self.assertEqual(r, [])
+        
+        r = yield store.delete('Sam', [('cake', '1', 'ffff')])
+        self.assertEqual(r, 1)
+        r = yield store.entities()
+        self.assertEqual(r, ['Bob'])
+        r = yield store.delete('Sam', [])
+        self.assertEqual(r, 0)
+        
+        r = yield store.put(Data('Sam', 'cake', '1', 'gggg', 'value 2'))
+        self.assertEqual(r['changed'], True)
+        r = yield store.get('Sam', 'cake', '1')
+        self.assertEqual(r, [Data('Sam', 'cake', '1', 'gggg', 'value 2')])
+
+
+
+
+class eachPageTest(TestCase):
+
+
+    def test_eachPage(self):
+        """
+        Each page is handed over in turn, waiting for whatever's done with it.
+        """
+        store = InMemoryStore()
+        for i in xrange(5):
+            store.put(Data('Sam', 'cake', '1', str(i), 'value'))
+        pages = []
+        waiting = []
+        def gotPage(page):
+            pages.append(page)
+            waiting.append(defer.Deferred())
+            return waiting[-1]
+        d = eachPage(store, 'Sam', gotPage, limit=2)
+        self.assertEqual(len(pages), 1)
+        waiting[-1].callback(None)
+        self.assertEqual(len(pages), 2)
+        waiting[-1].callback(None)
+        waiting[-1].callback(None)
+        self.assertEqual([len(x) for x in pages], [2, 2, 1])
+        self.assertEqual(self.successResultOf(d), 5)
+
+
+    def test_stop(self):
+        """
+        If the function returns C{False}, that's the last page.
+        """
+        store = InMemoryStore()
+        for i in xrange(5):
+            store.put(Data('Sam', 'cake', '1', str(i), 'value'))
+        store.getPage = create_autospec(store.getPage,
+                                        side_effect=store.getPage)
+        d = eachPage(store, 'Sam', lambda page: defer.succeed(False), limit=2)
+        self.assertEqual(self.successResultOf(d), 2)
+        self.assertEqual(store.getPage.call_count, 1)
+
+
+    def test_empty(self):
+        """
+        If there's no data, the function isn't called.
+        """
+        func = create_autospec(lambda page: None)
+        d = eachPage(InMemoryStore(), 'Sam', func)
+        self.assertEqual(self.successResultOf(d), 0)
+        self.assertEqual(func.call_count, 0)
+
+
+
 class SqliteStoreTest(TestCase, IDataStoreTestMixin):
 
     
@@ -151,6 +530,162 @@ class SqliteStoreTest(TestCase, IDataStoreTestMixin):
         return SqliteStore(':memory:')
 
 
+    @defer.inlineCallbacks
+    def test_hashesAddedToOldDatabases(self):
+        """
+        Databases made before hashes were stored get hashes for all their
+        values.
+        """
+        tmpfile = FilePath(self.mktemp())
+        db = sqlite.connect(tmpfile.path)
+        db.execute('''create table data (
+                id integer primary key,
+                entrydate timestamp default current_timestamp,
+                entity text,
+                name text,
+                version text,
+                lineage text,
+                value text,
+                unique (entity, name, version, lineage)
+            )''')
+        db.executemany('''insert into data (entity, name, version, lineage,
+            value) values (?, ?, ?, ?, ?)''', [
+            ('Bob', 'eggs', '1', str(x), 'value %d' % (x,)) for x in xrange(1000)
+        ] + [('Bob', 'flour', '1', 'ffff', 'flour')])
+        db.commit()
+        db.close()
+        
+        store = SqliteStore(tmpfile.path)
+        r = yield store.getHashes('Bob', [('flour', '1', 'ffff')])
+        self.assertEqual(r, [valueHash('flour')])
+        r = yield store.runQuery('select count(*) from data where hash is null')
+        self.assertEqual(r, [(0,)])
+        r = yield store.get('Bob', 'flour')
+        self.assertEqual(r, [Data('Bob', 'flour', '1', 'ffff', 'flour')])
+
+
+    @defer.inlineCallbacks
+    def test_valuesMovedToBlobsInOldDatabases(self):
+        """
+        The values in databases made before they were kept in their own table
+        are moved there, once each.
+        """
+        tmpfile = FilePath(self.mktemp())
+        db = sqlite.connect(tmpfile.path)
+        db.execute('''create table data (
+                id integer primary key,
+                entrydate timestamp default current_timestamp,
+                entity text,
+                name text,
+                version text,
+                lineage text,
+                value text,
+                hash text,
+                unique (entity, name, version, lineage)
+            )''')
+        db.executemany('''insert into data (entity, name, version, lineage,
+            value, hash) values (?, ?, ?, ?, ?, ?)''', [
+            ('Bob', 'eggs', '1', 'ffff', 'A', valueHash('A')),
+            ('Sam', 'eggs', '1', 'ffff', 'A', valueHash('A')),
+            ('Sam', 'flour', '1', 'ffff', 'B', valueHash('B')),
+        ])
+        db.commit()
+        db.close()
+        
+        store = SqliteStore(tmpfile.path)
+        r = yield store.get('Sam')
+        self.assertEqual(sorted(r), [
+            Data('Sam', 'eggs', '1', 'ffff', 'A'),
+            Data('Sam', 'flour', '1', 'ffff', 'B'),
+        ])
+        r = yield store.runQuery('select value, refs from blobs '
+                                 'order by value')
+        self.assertEqual(r, [('A', 2), ('B', 1)])
+        r = yield store.runQuery('pragma table_info(data)')
+        self.assertNotIn('value', [x[1] for x in r])
+        
+        yield store.put(Data('Bob', 'eggs', '1', 'ffff', 'B'))
+        r = yield store.runQuery('select value, refs from blobs '
+                                 'order by value')
+        self.assertEqual(r, [('A', 1), ('B', 2)])
+
+
+    @defer.inlineCallbacks
+    def test_valuesMovedOnce(self):
+        """
+        Once an old database's values have been moved, opening it again
+        doesn't move them again.
+        """
+        tmpfile = FilePath(self.mktemp())
+        db = sqlite.connect(tmpfile.path)
+        db.execute('''create table data (
+                id integer primary key,
+                entrydate timestamp default current_timestamp,
+                entity text,
+                name text,
+                version text,
+                lineage text,
+                value text,
+                unique (entity, name, version, lineage)
+            )''')
+        db.execute('''insert into data (entity, name, version, lineage, value)
+            values ('Bob', 'eggs', '1', 'ffff', 'A')''')
+        db.commit()
+        db.close()
+        
+        store = SqliteStore(tmpfile.path)
+        yield store.put(Data('Bob', 'eggs', '2', 'ffff', 'B'))
+        store.pool.close()
+        
+        self.patch(SqliteStore, '_migrateValues',
+                   lambda *a: self.fail("Migrated again"))
+        store = SqliteStore(tmpfile.path)
+        r = yield store.get('Bob', 'eggs')
+        self.assertEqual(sorted(r), [
+            Data('Bob', 'eggs', '1', 'ffff', 'A'),
+            Data('Bob', 'eggs', '2', 'ffff', 'B'),
+        ])
+        r = yield store.runQuery('select value, refs from blobs '
+                                 'order by value')
+        self.assertEqual(r, [('A', 1), ('B', 1)])
+
+
+    @defer.inlineCallbacks
+    def test_valuesStoredOnce(self):
+        """
+        Each distinct value is stored once no matter how many entities have
+        it, and is forgotten once nothing has it.
+        """
+        store = SqliteStore(':memory:')
+        yield store.putMany([
+            Data('Bob', 'grade', '1', 'ffff', 'A'),
+            Data('Sam', 'grade', '1', 'ffff', 'A'),
+            Data('Joe', 'grade', '1', 'ffff', 'A'),
+        ])
+        r = yield store.runQuery('select value, refs from blobs')
+        self.assertEqual(r, [('A', 3)])
+        
+        yield store.put(Data('Bob', 'grade', '1', 'ffff', 'A'))
+        yield store.put(Data('Sam', 'grade', '1', 'ffff', 'B'))
+        r = yield store.runQuery('select value, refs from blobs '
+                                 'order by value')
+        self.assertEqual(r, [('A', 2), ('B', 1)])
+        
+        yield store.putMany([
+            Data('Bob', 'grade', '1', 'ffff', 'B'),
+            Data('Joe', 'grade', '1', 'ffff', 'C'),
+        ])
+        r = yield store.runQuery('select value, refs from blobs '
+                                 'order by value')
+        self.assertEqual(r, [('B', 2), ('C', 1)])
+        r = yield store.get('Bob', 'grade', '1')
+        self.assertEqual(r, [Data('Bob', 'grade', '1', 'ffff', 'B')])
+        
+        yield store.delete('Joe', [('grade', '1', 'ffff')])
+        r = yield store.runQuery('select value, refs from blobs')
+        self.assertEqual(r, [('B', 2)])
+
+
     @defer.inlineCallbacks
     def test_persist(self):
         """
@@ -171,9 +706,650 @@ class SqliteStoreTest(TestCase, IDataStoreTestMixin):
         
 
 
+class SqliteStore_readersTest(TestCase, IDataStoreTestMixin):
+
+
+    def getInstance(self):
+        return SqliteStore(FilePath(self.mktemp()).path, readers=2)
+
+
+    def test_wal(self):
+        """
+        With readers, the database uses write-ahead logging and reads are done
+        by connections that can't write.
+        """
+        store = self.getInstance()
+        self.assertEqual(store.read_pool.max, 2)
+        self.assertEqual(store.pool.max, 1)
+        
+        def check(result):
+            self.assertEqual(result, [('wal',)])
+            d = store.read_pool.runOperation("insert into data (entity) "
+                                             "values ('foo')")
+            return self.assertFailure(d, sqlite.OperationalError)
+        return store.runReadQuery('pragma journal_mode').addCallback(check)
+
+
+    def test_memory(self):
+        """
+        In-memory databases can't be shared by connections, so they don't get
+        readers.
+        """
+        store = SqliteStore(':memory:', readers=2)
+        self.assertEqual(store.read_pool, store.pool)
+
+
+
+class SqliteStore_groupCommitTest(TestCase, IDataStoreTestMixin):
+
+
+    def getInstance(self):
+        return SqliteStore(':memory:', group_interval=0.001)
+
+
+    def test_interval(self):
+        """
+        Puts are written together once the interval has passed.
+        """
+        clock = task.Clock()
+        store = SqliteStore(':memory:', reactor=clock, group_interval=5)
+        store.pool.runInteraction = create_autospec(store.pool.runInteraction,
+            side_effect=store.pool.runInteraction)
+        d1 = store.put(Data('Sam', 'cake', '1', 'ffff', 'value'))
+        d2 = store.put(Data('Sam', 'cake', '1', 'ffff', 'value'))
+        d3 = store.put(Data('Sam', 'cake', '1', 'ffff', 'value 2'))
+        clock.advance(4)
+        self.assertEqual(store.pool.runInteraction.call_count, 0)
+        self.assertNoResult(d1)
+        
+        clock.advance(1)
+        self.assertEqual(store.pool.runInteraction.call_count, 1)
+        d = defer.gatherResults([d1, d2, d3])
+        def check(results):
+            self.assertEqual([x['changed'] for x in results],
+                             [True, False, True])
+            self.assertEqual(clock.getDelayedCalls(), [])
+        return d.addCallback(check)
+
+
+    @defer.inlineCallbacks
+    def test_size(self):
+        """
+        Puts are written as soon as enough of them are waiting.
+        """
+        clock = task.Clock()
+        store = SqliteStore(':memory:', reactor=clock, group_interval=5,
+                            group_size=2)
+        d1 = store.put(Data('Sam', 'cake', '1', 'ffff', 'value'))
+        d2 = store.put(Data('Sam', 'cake', '2', 'ffff', 'value'))
+        d3 = store.put(Data('Sam', 'cake', '3', 'ffff', 'value'))
+        yield defer.gatherResults([d1, d2])
+        self.assertNoResult(d3)
+        clock.advance(5)
+        yield d3
+        r = yield store.get('Sam')
+        self.assertEqual(len(r), 3)
+
+
+    @defer.inlineCallbacks
+    def test_putMany(self):
+        """
+        Things queued by put are written before a later putMany.
+        """
+        store = SqliteStore(':memory:', group_interval=10)
+        d = store.put(Data('Sam', 'cake', '1', 'ffff', 'value'))
+        r = yield store.putMany([Data('Sam', 'cake', '1', 'ffff', 'value 2')])
+        self.assertEqual(r, [{'changed': True}])
+        r = yield d
+        self.assertEqual(r, {'changed': True})
+        r = yield store.get('Sam')
+        self.assertEqual(r, [Data('Sam', 'cake', '1', 'ffff', 'value 2')])
+
+
+
+class SqliteStore_noUpsertTest(SqliteStoreTest):
+    """
+    Versions of SQLite older than 3.24.0 don't do upserts.
+    """
+
+
+    def setUp(self):
+        self.patch(store_module, '_HAS_UPSERT', False)
+
+
+
 class InMemoryStore_IDataStoreTest(TestCase, IDataStoreTestMixin):
 
 
     def getInstance(self):
         return InMemoryStore()
 
+
+
+
+class LogStore_IDataStoreTest(TestCase, IDataStoreTestMixin):
+
+
+    def getInstance(self):
+        store = LogStore(self.mktemp())
+        self.addCleanup(store.close)
+        return store
+
+
+
+class LogStoreTest(TestCase):
+
+
+    def open(self, path, **kwargs):
+        store = LogStore(path, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+
+    def segments(self, path):
+        return sorted([x for x in os.listdir(path) if x.endswith('.seg')])
+
+
+    @defer.inlineCallbacks
+    def test_getPage_sorted(self):
+        """
+        Pages come in key order, so data added between pages after the ones
+        already gotten shows up on a later page, even after a replay.
+        """
+        path = self.mktemp()
+        store = self.open(path)
+        yield store.putMany([Data('Sam', 'cake', '1', str(i), 'value')
+                             for i in [1, 3, 5, 7]])
+        store.close()
+        store = self.open(path)
+        page1, after = yield store.getPage('Sam', limit=2)
+        yield store.putMany([Data('Sam', 'cake', '1', str(i), 'value')
+                             for i in [0, 4, 8]])
+        yield store.delete('Sam', [('cake', '1', '5')])
+        page2, after = yield store.getPage('Sam', after=after, limit=10)
+        self.assertEqual([x.lineage for x in page1], ['1', '3'])
+        self.assertEqual([x.lineage for x in page2], ['4', '7', '8'])
+        self.assertEqual(after, None)
+
+
+    def test_replay(self):
+        """
+        Data put in a store is there when it's opened again.
+        """
+        path = self.mktemp()
+        store = LogStore(path)
+        store.put(Data('Bob', 'eggs', '1', 'ffff', 'one'))
+        store.put(Data('Bob', 'eggs', '1', 'ffff', 'two'))
+        store.put(Data(u'B\xf6b', 'flour', '1', 'ffff', 'three'))
+        store.close()
+        
+        store = self.open(path)
+        r = self.successResultOf(store.get('Bob'))
+        self.assertEqual(r, [Data('Bob', 'eggs', '1', 'ffff', 'two')])
+        r = self.successResultOf(store.get(u'B\xf6b'))
+        self.assertEqual(r, [Data(u'B\xf6b', 'flour', '1', 'ffff', 'three')])
+        r = self.successResultOf(store.getHashes('Bob', [
+            ('eggs', '1', 'ffff')]))
+        self.assertEqual(r, [valueHash('two')])
+        self.assertEqual(store.garbage(), _RECORD.size + 15,
+                         "The first value of Bob's eggs")
+
+
+    def test_unchanged(self):
+        """
+        Putting the value that's already there doesn't write anything.
+        """
+        store = self.open(self.mktemp())
+        store.put(Data('Bob', 'eggs', '1', 'ffff', 'one'))
+        size = store.size()
+        r = self.successResultOf(store.put(
+            Data('Bob', 'eggs', '1', 'ffff', 'one')))
+        self.assertEqual(r, {'changed': False})
+        self.assertEqual(store.size(), size)
+
+
+    def test_segments(self):
+        """
+        A new segment is started when the current one is full, or when the
+        store is opened.  Empty segments are removed when the store is
+        opened.
+        """
+        path = self.mktemp()
+        store = LogStore(path, segment_size=200)
+        for i in xrange(10):
+            store.put(Data('Bob', 'eggs', '1', str(i), 'x' * 50))
+        store.put(Data('Bob', 'eggs', '1', 'big', 'x' * 500))
+        store.close()
+        segments = self.segments(path)
+        self.assertTrue(len(segments) > 5, segments)
+        self.assertEqual(segments[0], '00000000-0000.seg')
+        
+        store = LogStore(path, segment_size=200)
+        store.close()
+        store = self.open(path, segment_size=200)
+        self.assertEqual(self.segments(path), segments + [
+            '%08d-0000.seg' % (len(segments),)])
+        r = self.successResultOf(store.get('Bob', 'eggs', '1', 'big'))
+        self.assertEqual(r, [Data('Bob', 'eggs', '1', 'big', 'x' * 500)])
+        self.assertEqual(len(self.successResultOf(store.get('Bob'))), 11)
+
+
+    def test_corruptTail(self):
+        """
+        A record that wasn't completely written (or was corrupted) and
+        everything after it in the same segment is ignored.
+        """
+        path = self.mktemp()
+        store = LogStore(path)
+        store.put(Data('Bob', 'eggs', '1', 'ffff', 'one'))
+        store.put(Data('Sam', 'eggs', '1', 'ffff', 'two'))
+        store.close()
+        seg = FilePath(path).child(self.segments(path)[0])
+        content = seg.getContent()
+        seg.setContent(content[:-1] + 'X')
+        
+        store = self.open(path)
+        self.assertEqual(self.successResultOf(store.entities()), ['Bob'])
+        store.put(Data('Sam', 'eggs', '1', 'ffff', 'three'))
+        r = self.successResultOf(store.get('Sam'))
+        self.assertEqual(r, [Data('Sam', 'eggs', '1', 'ffff', 'three')])
+
+
+    def test_compact(self):
+        """
+        Compacting copies the live records into new segments and removes the
+        old ones.
+        """
+        path = self.mktemp()
+        clock = task.Clock()
+        store = self.open(path, segment_size=100, reactor=clock)
+        for i in xrange(5):
+            store.put(Data('Bob', 'eggs', '1', 'ffff', 'value %d' % (i,)))
+            store.put(Data('Sam', 'eggs', '1', str(i), 'value'))
+        self.assertTrue(store.garbage() > 0)
+        old = self.segments(path)
+        
+        d = store.compact()
+        clock.advance(0)
+        self.successResultOf(d)
+        self.assertEqual(store.garbage(), 0)
+        segments = self.segments(path)
+        self.assertEqual(set(old) & set(segments), set())
+        r = self.successResultOf(store.get('Bob'))
+        self.assertEqual(r, [Data('Bob', 'eggs', '1', 'ffff', 'value 4')])
+        self.assertEqual(len(self.successResultOf(store.get('Sam'))), 5)
+        
+        store.close()
+        store = self.open(path, segment_size=100)
+        r = self.successResultOf(store.get('Bob'))
+        self.assertEqual(r, [Data('Bob', 'eggs', '1', 'ffff', 'value 4')])
+        self.assertEqual(len(self.successResultOf(store.get('Sam'))), 5)
+
+
+    def test_compactWhilePutting(self):
+        """
+        Data put while compacting is in progress wins over what's being
+        copied, even after the store is opened again.
+        """
+        path = self.mktemp()
+        clock = task.Clock()
+        store = LogStore(path, reactor=clock)
+        for i in xrange(300):
+            store.put(Data(str(i), 'eggs', '1', 'ffff', 'old'))
+        
+        d = store.compact()
+        store.put(Data('0', 'eggs', '1', 'ffff', 'new'))
+        store.put(Data('299', 'eggs', '1', 'ffff', 'new'))
+        self.assertNoResult(d)
+        while not d.called:
+            clock.advance(0)
+        self.successResultOf(d)
+        
+        r = self.successResultOf(store.getMany('0', [('eggs', '1')]))
+        self.assertEqual(r, [[Data('0', 'eggs', '1', 'ffff', 'new')]])
+        store.close()
+        
+        store = self.open(path)
+        r = self.successResultOf(store.getManyEntities([
+            ('0', 'eggs', '1'),
+            ('1', 'eggs', '1'),
+            ('299', 'eggs', '1'),
+        ]))
+        self.assertEqual(r, [
+            [Data('0', 'eggs', '1', 'ffff', 'new')],
+            [Data('1', 'eggs', '1', 'ffff', 'old')],
+            [Data('299', 'eggs', '1', 'ffff', 'new')],
+        ])
+
+
+    def test_delete(self):
+        """
+        Deletions are remembered when the store is opened again, until
+        compaction gets rid of them along with what they deleted.
+        """
+        path = self.mktemp()
+        clock = task.Clock()
+        store = LogStore(path, reactor=clock)
+        store.put(Data('Bob', 'eggs', '1', 'ffff', 'one'))
+        store.put(Data('Bob', 'eggs', '1', 'gggg', 'two'))
+        self.successResultOf(store.delete('Bob', [('eggs', '1', 'ffff')]))
+        store.close()
+        
+        store = self.open(path, reactor=clock)
+        r = self.successResultOf(store.get('Bob'))
+        self.assertEqual(r, [Data('Bob', 'eggs', '1', 'gggg', 'two')])
+        self.assertTrue(store.garbage() > 0)
+        
+        d = store.compact()
+        clock.advance(0)
+        self.successResultOf(d)
+        self.assertEqual(store.garbage(), 0)
+        store.close()
+        
+        store = self.open(path, reactor=clock)
+        r = self.successResultOf(store.get('Bob'))
+        self.assertEqual(r, [Data('Bob', 'eggs', '1', 'gggg', 'two')])
+
+
+    def test_closeWhileCompacting(self):
+        """
+        Closing the store while a periodic compaction is in progress abandons
+        it quietly, and the store can be opened again.
+        """
+        path = self.mktemp()
+        clock = task.Clock()
+        store = LogStore(path, compact_interval=10, reactor=clock)
+        for i in xrange(300):
+            store.put(Data(str(i), 'eggs', '1', 'ffff', 'old'))
+            store.put(Data(str(i), 'eggs', '1', 'ffff', 'new'))
+        clock.advance(10)
+        d = store.compact()
+        self.assertNoResult(d)
+        
+        store.close()
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertFalse(store._compact_call.running)
+        
+        store = self.open(path)
+        r = self.successResultOf(store.getMany('299', [('eggs', '1')]))
+        self.assertEqual(r, [[Data('299', 'eggs', '1', 'ffff', 'new')]])
+
+
+    def test_compactInterval(self):
+        """
+        Compaction can be done periodically, when enough of what's stored is
+        garbage.
+        """
+        clock = task.Clock()
+        store = self.open(self.mktemp(), compact_interval=10,
+                          compact_ratio=0.5, reactor=clock)
+        store.compact = create_autospec(store.compact)
+        store.put(Data('Bob', 'eggs', '1', 'ffff', 'one'))
+        clock.advance(10)
+        self.assertEqual(store.compact.call_count, 0)
+        store.put(Data('Bob', 'eggs', '1', 'ffff', 'two'))
+        clock.advance(10)
+        self.assertEqual(store.compact.call_count, 1)
+
+
+
+class CachingStore_IDataStoreTest(TestCase, IDataStoreTestMixin):
+
+
+    def getInstance(self):
+        return CachingStore(InMemoryStore(), max_entries=2)
+
+
+
+class CachingStore_sqliteTest(TestCase, IDataStoreTestMixin):
+
+
+    def getInstance(self):
+        return CachingStore(SqliteStore(':memory:'), max_bytes=20,
+                            policy='lfu')
+
+
+
+class CachingStoreTest(TestCase):
+
+
+    def setUp(self):
+        self.store = InMemoryStore()
+        self.store.get = create_autospec(self.store.get,
+                                         side_effect=self.store.get)
+        self.store.getManyEntities = create_autospec(
+            self.store.getManyEntities,
+            side_effect=self.store.getManyEntities)
+
+
+    def test_policy(self):
+        """
+        You can choose which data to forget first.
+        """
+        self.assertRaises(ValueError, CachingStore, self.store, 10,
+                          policy='foo')
+
+
+    def test_get(self):
+        """
+        Data for a name and version is fetched from the other store once, and
+        after that served from memory.
+        """
+        self.store.put(Data('joe', 'cake', '1', 'xxxx', 'chocolate'))
+        self.store.put(Data('joe', 'cake', '1', 'yyyy', 'vanilla'))
+        cache = CachingStore(self.store, max_entries=10)
+        
+        r1 = self.successResultOf(cache.get('joe', 'cake', '1'))
+        r2 = self.successResultOf(cache.get('joe', 'cake', '1'))
+        r3 = self.successResultOf(cache.get('joe', 'cake', '1', 'yyyy'))
+        self.assertEqual(r1, [
+            Data('joe', 'cake', '1', 'xxxx', 'chocolate'),
+            Data('joe', 'cake', '1', 'yyyy', 'vanilla'),
+        ])
+        self.assertEqual(r1, r2)
+        self.assertEqual(r3, [Data('joe', 'cake', '1', 'yyyy', 'vanilla')])
+        self.store.get.assert_called_once_with('joe', 'cake', '1')
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+
+    def test_getManyEntities(self):
+        """
+        Only what isn't cached is fetched, all at once.
+        """
+        self.store.put(Data('joe', 'cake', '1', 'xxxx', 'chocolate'))
+        self.store.put(Data('sam', 'cake', '1', 'xxxx', 'vanilla'))
+        cache = CachingStore(self.store, max_entries=10)
+        self.successResultOf(cache.get('joe', 'cake', '1'))
+        
+        r = self.successResultOf(cache.getManyEntities([
+            ('joe', 'cake', '1'),
+            ('sam', 'cake', '1', 'xxxx'),
+            ('sam', 'cake', '1'),
+            ('bob', 'cake', '1'),
+        ]))
+        self.assertEqual(r, [
+            [Data('joe', 'cake', '1', 'xxxx', 'chocolate')],
+            [Data('sam', 'cake', '1', 'xxxx', 'vanilla')],
+            [Data('sam', 'cake', '1', 'xxxx', 'vanilla')],
+            [],
+        ])
+        self.store.getManyEntities.assert_called_once_with([
+            ('sam', 'cake', '1'),
+            ('bob', 'cake', '1'),
+        ])
+
+
+    def test_getWithoutNameAndVersion(self):
+        """
+        A get that isn't for a particular name and version goes straight to
+        the other store.
+        """
+        self.store.put(Data('joe', 'cake', '1', 'xxxx', 'chocolate'))
+        cache = CachingStore(self.store, max_entries=10)
+        r = self.successResultOf(cache.get('joe'))
+        self.assertEqual(r, [Data('joe', 'cake', '1', 'xxxx', 'chocolate')])
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+
+    def test_put(self):
+        """
+        Data is written through to the other store and the cache is updated
+        with it.
+        """
+        self.store.put(Data('joe', 'cake', '1', 'xxxx', 'chocolate'))
+        cache = CachingStore(self.store, max_entries=10)
+        self.successResultOf(cache.get('joe', 'cake', '1'))
+        
+        r = self.successResultOf(cache.put(
+            Data('joe', 'cake', '1', 'xxxx', 'vanilla')))
+        self.assertEqual(r, {'changed': True})
+        self.successResultOf(cache.putMany([
+            Data('joe', 'cake', '1', 'yyyy', 'lemon'),
+            Data('joe', 'pie', '1', 'xxxx', 'apple'),
+        ]))
+        self.assertEqual(self.successResultOf(self.store.get('joe', 'cake')), [
+            Data('joe', 'cake', '1', 'xxxx', 'vanilla'),
+            Data('joe', 'cake', '1', 'yyyy', 'lemon'),
+        ])
+        self.store.get.reset_mock()
+        
+        r = self.successResultOf(cache.get('joe', 'cake', '1'))
+        self.assertEqual(r, [
+            Data('joe', 'cake', '1', 'xxxx', 'vanilla'),
+            Data('joe', 'cake', '1', 'yyyy', 'lemon'),
+        ])
+        self.assertEqual(self.store.get.call_count, 0)
+        self.assertFalse(('joe', 'pie', '1') in cache.cache, "Shouldn't "
+                         "cache what it doesn't know all the lineages of")
+
+
+    def test_staleFetch(self):
+        """
+        Data fetched from the other store before a put finished isn't cached.
+        """
+        cache = CachingStore(self.store, max_entries=10)
+        fetch_d = defer.Deferred()
+        self.store.get.side_effect = None
+        self.store.get.return_value = fetch_d
+        
+        d = cache.get('joe', 'cake', '1')
+        self.successResultOf(cache.put(
+            Data('joe', 'cake', '1', 'xxxx', 'vanilla')))
+        fetch_d.callback([])
+        self.assertEqual(self.successResultOf(d), [])
+        self.assertFalse(('joe', 'cake', '1') in cache.cache)
+        self.assertEqual(cache._fetching, {})
+
+
+    def test_maxBytes(self):
+        """
+        You can limit the size of the cached values.
+        """
+        self.store.put(Data('joe', 'cake', '1', 'xxxx', 'x' * 6))
+        self.store.put(Data('sam', 'cake', '1', 'xxxx', 'x' * 6))
+        cache = CachingStore(self.store, max_bytes=10)
+        self.successResultOf(cache.get('joe', 'cake', '1'))
+        self.successResultOf(cache.get('sam', 'cake', '1'))
+        self.assertEqual(len(cache.cache), 1)
+        self.assertEqual(cache.cache.weight, 6)
+
+
+    def test_flush(self):
+        """
+        Flushing flushes the other store if it can be flushed.
+        """
+        cache = CachingStore(self.store)
+        self.successResultOf(cache.flush())
+        self.store.flush = create_autospec(lambda: None,
+                                           return_value=defer.succeed('foo'))
+        self.assertEqual(self.successResultOf(cache.flush()), 'foo')
+
+
+
+class ShardedStore_IDataStoreTest(TestCase, IDataStoreTestMixin):
+
+
+    def getInstance(self):
+        return ShardedStore([InMemoryStore() for i in xrange(3)])
+
+
+
+class ShardedStore_sqliteTest(TestCase, IDataStoreTestMixin):
+
+
+    def getInstance(self):
+        return ShardedStore([SqliteStore(':memory:') for i in xrange(3)])
+
+
+
+class ShardedStoreTest(TestCase):
+
+
+    def setUp(self):
+        self.shards = [InMemoryStore() for i in xrange(4)]
+        self.store = ShardedStore(self.shards)
+
+
+    def test_shardFor(self):
+        """
+        Each entity always goes to the same shard, and entities are spread
+        across the shards.
+        """
+        store = ShardedStore(self.shards)
+        self.assertIdentical(store.shardFor('Bob'),
+                             self.store.shardFor('Bob'))
+        self.assertIdentical(store.shardFor(u'Bob'), store.shardFor('Bob'))
+        used = set([id(store.shardFor('entity%d' % (i,)))
+                    for i in xrange(100)])
+        self.assertEqual(len(used), 4)
+
+
+    def test_put(self):
+        """
+        Data is put in the entity's shard only.
+        """
+        self.store.put(Data('Bob', 'eggs', '1', 'ffff', 'value'))
+        shard = self.store.shardFor('Bob')
+        for s in self.shards:
+            entities = self.successResultOf(s.entities())
+            self.assertEqual(entities, ['Bob'] if s is shard else [])
+
+
+    def test_putMany(self):
+        """
+        Data for many entities is split into one putMany per shard, and the
+        results come back in the order the data was given.
+        """
+        for s in self.shards:
+            s.putMany = create_autospec(s.putMany, side_effect=s.putMany)
+        self.store.put(Data('entity3', 'eggs', '1', 'ffff', 'value'))
+        data = [Data('entity%d' % (i,), 'eggs', '1', 'ffff', 'value')
+                for i in xrange(20)]
+        r = self.successResultOf(self.store.putMany(data))
+        self.assertEqual(r, [{'changed': i != 3} for i in xrange(20)])
+        for s in self.shards:
+            self.assertEqual(s.putMany.call_count, 1)
+
+
+    def test_error(self):
+        """
+        If a shard fails, so does the whole operation, with the shard's
+        error.
+        """
+        self.shards[0].putMany = lambda x: defer.fail(ValueError('foo'))
+        data = [Data('entity%d' % (i,), 'eggs', '1', 'ffff', 'value')
+                for i in xrange(20)]
+        self.failureResultOf(self.store.putMany(data), ValueError)
+        
+        self.shards[1].entities = lambda *a: defer.fail(ValueError('foo'))
+        self.failureResultOf(self.store.entities(), ValueError)
+
+
+    def test_flush(self):
+        """
+        All the shards that can be flushed are.
+        """
+        self.shards[0].flush = create_autospec(lambda: None,
+                                               return_value=defer.succeed(1))
+        self.successResultOf(self.store.flush())
+        self.assertEqual(self.shards[0].flush.call_count, 1)
@@ -1,7 +1,7 @@
 from twisted.trial.unittest import TestCase
 
 
-from garden.util import RoundRobinChooser
+from garden.util import RoundRobinChooser, LRUCache, LFUCache
 
 
 
@@ -53,3 +53,158 @@ class RoundRobinChooserTest(TestCase):
         self.assertRaises(Exception, ch.next)
 
 
+
+
+
+class LRUCacheTest(TestCase):
+
+
+    def test_basic(self):
+        """
+        You can put things in and get them out.
+        """
+        c = LRUCache(10)
+        c['a'] = 1
+        c['b'] = 2
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c['b'], 2)
+        self.assertEqual(c.get('c'), None)
+        self.assertEqual(c.get('c', 'default'), 'default')
+        self.assertRaises(KeyError, c.__getitem__, 'c')
+        self.assertTrue('a' in c)
+        self.assertFalse('c' in c)
+        self.assertEqual(len(c), 2)
+        c['a'] = 3
+        self.assertEqual(c['a'], 3)
+        self.assertEqual(len(c), 2)
+
+
+    def test_evict(self):
+        """
+        When there's too much, the least recently used thing is forgotten.
+        """
+        c = LRUCache(3)
+        c['a'] = 1
+        c['b'] = 2
+        c['c'] = 3
+        c.get('a')
+        c['d'] = 4
+        self.assertEqual(len(c), 3)
+        self.assertFalse('b' in c)
+        c['c'] = 5
+        c['e'] = 6
+        self.assertFalse('a' in c)
+        self.assertEqual(c['c'], 5)
+        self.assertEqual(c['d'], 4)
+        self.assertEqual(c['e'], 6)
+
+
+    def test_pop(self):
+        """
+        You can take things out.
+        """
+        c = LRUCache(2)
+        c['a'] = 1
+        c['b'] = 2
+        self.assertEqual(c.pop('a'), 1)
+        self.assertEqual(c.pop('a', 'default'), 'default')
+        self.assertEqual(len(c), 1)
+        c['c'] = 3
+        c['d'] = 4
+        self.assertEqual(len(c), 2)
+        self.assertFalse('b' in c)
+
+
+    def test_maxWeight(self):
+        """
+        You can limit the total weight of the values instead of (or as well
+        as) their number.
+        """
+        c = LRUCache(max_weight=10, weigh=len)
+        c['a'] = 'xxxx'
+        c['b'] = 'xxxx'
+        self.assertEqual(c.weight, 8)
+        c['c'] = 'xxxx'
+        self.assertFalse('a' in c)
+        self.assertEqual(c.weight, 8)
+        c['b'] = 'x'
+        self.assertEqual(c.weight, 5)
+        c.pop('c')
+        self.assertEqual(c.weight, 1)
+        c['d'] = 'x' * 11
+        self.assertEqual(len(c), 0, "Something too big to hold pushes "
+                         "everything out, including itself")
+        self.assertEqual(c.weight, 0)
+
+
+
+class LFUCacheTest(TestCase):
+
+
+    def test_basic(self):
+        """
+        You can put things in and get them out.
+        """
+        c = LFUCache(10)
+        c['a'] = 1
+        c['b'] = 2
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c['b'], 2)
+        self.assertEqual(c.get('c', 'default'), 'default')
+        self.assertRaises(KeyError, c.__getitem__, 'c')
+        self.assertTrue('a' in c)
+        self.assertEqual(len(c), 2)
+        c['a'] = 3
+        self.assertEqual(c['a'], 3)
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.pop('a'), 3)
+        self.assertEqual(c.pop('a', 'gone'), 'gone')
+        self.assertEqual(len(c), 1)
+
+
+    def test_evict(self):
+        """
+        When there's too much, the least frequently used thing is forgotten,
+        and of those that are used as often, the least recently used.
+        """
+        c = LFUCache(3)
+        c['a'] = 1
+        c['b'] = 2
+        c['c'] = 3
+        c.get('a')
+        c.get('a')
+        c.get('b')
+        c['d'] = 4
+        self.assertFalse('c' in c)
+        c['e'] = 5
+        self.assertFalse('d' in c)
+        c.get('e')
+        c['f'] = 6
+        self.assertEqual(sorted(['a', 'b', 'e']), sorted(
+            [x for x in 'abcdef' if x in c]))
+        self.assertFalse('f' in c)
+
+
+    def test_maxWeight(self):
+        """
+        You can limit the total weight of the values.
+        """
+        c = LFUCache(max_weight=10, weigh=len)
+        c['a'] = 'xxxx'
+        c['b'] = 'xxxx'
+        c.get('a')
+        c['c'] = 'xxxx'
+        self.assertFalse('b' in c)
+        self.assertEqual(c.weight, 8)
+
+
+    def test_manyGets(self):
+        """
+        Lots of use of the same few things doesn't use up lots of memory.
+        """
+        c = LFUCache(2)
+        c['a'] = 1
+        c['b'] = 2
+        for i in xrange(1000):
+            c.get('a')
+        self.assertTrue(len(c._heap) < 50)
@@ -1,5 +1,5 @@
 from twisted.trial.unittest import TestCase
-from twisted.internet import defer
+from twisted.internet import defer, threads
 from zope.interface.verify import verifyClass, verifyObject
 
 from garden.interface import ISource, IWorker, IWork, IResult, IResultError
@@ -181,3 +181,30 @@ class ThreadedWorkerTest(TestCase):
         receiver.receive.assert_called_once_with(work.toResultError(repr(exc)))
 
 
+    def test_capacity(self):
+        """
+        No more than C{capacity} pieces of work are done in threads at once.
+        """
+        running = []
+        def deferToThread(func, *args):
+            running.append(defer.Deferred())
+            return running[-1]
+        self.patch(threads, 'deferToThread', deferToThread)
+        receiver = FakeReceiver([IResult])
+        
+        w = ThreadedWorker(capacity=2)
+        self.assertEqual(w.capacity, 2)
+        ISource(w).subscribe(receiver)
+        w.registerFunction('foo', 'v1', lambda a: a)
+        
+        dlist = []
+        for value in ['a', 'b', 'c']:
+            dlist.append(w.workReceived(Work('bob', 'foo', 'v1', 'xxxx', [
+                ('a', 'v1', 'xxxx', value),
+            ])))
+        self.assertEqual(len(running), 2)
+        running[0].callback('a')
+        self.successResultOf(dlist[0])
+        self.assertEqual(len(running), 3)
+
+
@@ -1,18 +1,74 @@
+import os
+import signal
+
 from twisted.python import usage, reflect, log
 from twisted.internet import reactor, endpoints
-from twisted.application import internet
+from twisted.application import internet, service
 
 from garden.interface import IWorker, ISource
-from garden.path import Garden
-from garden.gardener import Gardener
+from garden.path import Garden, loadGarden
+from garden.gardener import Gardener, currentLineagesOnly
+from garden.store import CachingStore, ShardedStore
+from garden.scheduling import WorkQueue, depthPriority
+
+
+queue_priorities = {
+    'none': None,
+    'depth': depthPriority,
+}
 
 
 class Options(usage.Options):
     
+    optFlags = [
+        ['current-lineages-only', None, "Only do work with inputs that have "
+            "lineages the current garden leads to"],
+    ]
+    
     optParameters = [
         ['module', 'm', None, "Module containing getGarden() and getWorker()"
             " functions"],
+        ['garden-file', None, None, "File written by Garden.dump() to use "
+            "instead of the module's getGarden()"],
         ['sqlite-db', None, ":memory:", "SQLite database name"],
+        ['sqlite-group-commit', None, None, "If given, group writes to the "
+            "SQLite database into one commit every this many milliseconds",
+            float],
+        ['sqlite-readers', None, 0, "If more than 0, use write-ahead logging "
+            "and a pool of this many connections for reading from the SQLite "
+            "database", int],
+        ['sqlite-shards', None, 1, "Split the data by entity between this "
+            "many SQLite databases, named like the --sqlite-db with a number "
+            "before the extension", int],
+        ['log-store', None, None, "If given, store data in log files in "
+            "this directory instead of in an SQLite database"],
+        ['cache-entries', None, None, "If given, cache the data for this "
+            "many (entity, name, version)s in memory", int],
+        ['cache-bytes', None, None, "If given, cache up to this many bytes of "
+            "data in memory", int],
+        ['cache-policy', None, 'lru', "Which cached data to forget first: "
+            "'lru' (least recently used) or 'lfu' (least frequently used)"],
+        ['collect-interval', None, None, "If given, delete data that the "
+            "garden can't produce any more every this many seconds", float],
+        ['collect-delay', None, 0.1, "Seconds to wait between each small "
+            "delete when deleting data the garden can't produce", float],
+        ['hash-cache-size', None, 0, "If more than 0, keep the hashes of "
+            "this many recently used values in memory for checking results",
+            int],
+        ['max-work-in-flight', None, 0, "If more than 0, wait for a result "
+            "to come back before sending more work when there are this many "
+            "pieces of work in flight in all", int],
+        ['coalesce-delay', None, None, "If given, wait until no new work has "
+            "come in for a destination for this many milliseconds and only "
+            "do the latest", float],
+        ['queue-concurrency', None, 0, "If more than 0, queue work and send "
+            "no more than this many pieces out at once, taking turns between "
+            "entities", int],
+        ['max-queued', None, 0, "If more than 0, queue work and stop taking "
+            "HTTP input while this many pieces are queued, until half of them "
+            "have been sent out", int],
+        ['queue-priority', None, 'none', "Which queued work to send out "
+            "first: 'none' or 'depth' (work nearer the inputs first)"],
         ['http-input-endpoint', 'w', 'tcp:9990',
             "Endpoint on which to have the HTTP InputSource receive input"],
     ]
@@ -22,6 +78,134 @@ class Options(usage.Options):
             # this is hoped to be a temporary requirement (which is why the
             # module option is an option and not an arg in the first place)
             raise usage.UsageError("You must specify a module")
+        if self['cache-policy'] not in CachingStore.policies:
+            raise usage.UsageError("Unknown cache policy: %r" % (
+                                   self['cache-policy'],))
+        if self['queue-priority'] not in queue_priorities:
+            raise usage.UsageError("Unknown queue priority: %r" % (
+                                   self['queue-priority'],))
+
+
+
+def shardNames(db, shards):
+    """
+    Get the names of the SQLite databases to use for C{shards} shards of the
+    database C{db}.
+    """
+    if shards <= 1:
+        return [db]
+    if db == ':memory:':
+        return [db] * shards
+    base, ext = os.path.splitext(db)
+    return ['%s.%d%s' % (base, i, ext) for i in xrange(shards)]
+
+
+
+def getGarden(options, module):
+    """
+    Get the garden from the C{--garden-file} if there is one, or else from
+    C{module.getGarden()}.
+    
+    @rtype: L{FrozenGarden}
+    """
+    if options['garden-file']:
+        log.msg('loadGarden(%r)' % (options['garden-file'],))
+        fh = open(options['garden-file'], 'rb')
+        try:
+            return loadGarden(fh)
+        finally:
+            fh.close()
+    garden = module.getGarden()
+    assert isinstance(garden, Garden)
+    return garden.freeze()
+
+
+
+def reloadGarden(options, module, gardener):
+    """
+    Reload the garden (see L{getGarden}), reloading C{module} first, and swap
+    it into the running C{gardener}.
+    """
+    try:
+        if not options['garden-file']:
+            module = reload(module)
+        added, removed = gardener.setGarden(getGarden(options, module))
+    except Exception:
+        log.err(None, "Error reloading garden; keeping the old one")
+        return
+    for path in added:
+        log.msg('Added path: %r' % (path,))
+    for path in removed:
+        log.msg('Removed path: %r' % (path,))
+
+
+
+def makeStore(options):
+    """
+    Make the store described by C{options}: a L{LogStore}, or one or more
+    (sharded) L{SqliteStore}s, maybe with a L{CachingStore} in front.
+    
+    @rtype: L{IDataStore}
+    """
+    if options['log-store']:
+        from garden.store import LogStore
+        log.msg('LogStore(%r)' % (options['log-store'],))
+        store = LogStore(options['log-store'], compact_interval=300)
+        reactor.addSystemEventTrigger('after', 'shutdown', store.close)
+    else:
+        from garden.store import SqliteStore
+        sqlite_uri = options['sqlite-db']
+        group_interval = options['sqlite-group-commit']
+        if group_interval is not None:
+            group_interval /= 1000.0
+        readers = options['sqlite-readers']
+        stores = []
+        for uri in shardNames(sqlite_uri, options['sqlite-shards']):
+            log.msg('SqliteStore(%r, group_interval=%r, readers=%r)' % (
+                    uri, group_interval, readers))
+            stores.append(SqliteStore(uri, group_interval=group_interval,
+                                      readers=readers))
+        store = stores[0]
+        if len(stores) > 1:
+            store = ShardedStore(stores)
+    if options['cache-entries'] or options['cache-bytes']:
+        log.msg('CachingStore(max_entries=%r, max_bytes=%r, policy=%r)' % (
+                options['cache-entries'], options['cache-bytes'],
+                options['cache-policy']))
+        store = CachingStore(store, options['cache-entries'],
+                             options['cache-bytes'], options['cache-policy'])
+    return store
+
+
+
+def makeGardener(options, garden, store, worker):
+    """
+    Make the L{Gardener} described by C{options}, with a L{WorkQueue} if
+    work is to be queued.
+    """
+    coalesce_delay = options['coalesce-delay']
+    if coalesce_delay is not None:
+        coalesce_delay /= 1000.0
+    work_queue = None
+    if options['queue-concurrency'] or options['max-queued']:
+        # without a concurrency, send out as much as the worker can take
+        concurrency = options['queue-concurrency'] or \
+            getattr(worker, 'capacity', None) or 10
+        max_queued = options['max-queued'] or None
+        log.msg('WorkQueue(concurrency=%r, priority=%r, max_queued=%r)' % (
+                concurrency, options['queue-priority'], max_queued))
+        work_queue = WorkQueue(concurrency,
+                               queue_priorities[options['queue-priority']],
+                               max_queued=max_queued)
+    policy = None
+    if options['current-lineages-only']:
+        policy = currentLineagesOnly
+    return Gardener(garden, store,
+                    hash_cache_size=options['hash-cache-size'],
+                    max_work_in_flight=options['max-work-in-flight'],
+                    combination_policy=policy,
+                    coalesce_delay=coalesce_delay,
+                    work_queue=work_queue)
 
 
 
@@ -34,18 +218,15 @@ def makeService(options):
     # worker
     worker = IWorker(module.getWorker())
     
-    # garden
-    garden = module.getGarden()
-    assert isinstance(garden, Garden)
+    # garden (swapped for a fresh one on SIGHUP)
+    garden = getGarden(options, module)
     
     # store
-    from garden.store import SqliteStore
-    sqlite_uri = options['sqlite-db']
-    log.msg('SqliteStore(%r)' % (sqlite_uri,))
-    store = SqliteStore(sqlite_uri)
+    store = makeStore(options)
+    reactor.addSystemEventTrigger('before', 'shutdown', store.flush)
     
     # http input/output
-    from garden.http import WebInputSource, WebDataFeed
+    from garden.http import WebInputSource, WebDataFeed, WebDataQuery
     from twisted.web.resource import Resource
     from twisted.web.server import Site
     http_input_source = WebInputSource()
@@ -53,6 +234,7 @@ def makeService(options):
     root = Resource()
     root.putChild('', http_input_source)
     root.putChild('feed', http_data_receiver)
+    root.putChild('data', WebDataQuery(store))
     site = Site(root)
     
     endpoint = endpoints.serverFromString(reactor,
@@ -60,14 +242,34 @@ def makeService(options):
     http_service = internet.StreamServerEndpointService(endpoint, site)
     
     # gardener
-    gardener = Gardener(garden, store)
+    gardener = makeGardener(options, garden, store, worker)
     
     # hook them all together
     gardener.subscribe(worker)
     ISource(worker).subscribe(gardener)
     ISource(http_input_source).subscribe(gardener)
+    gardener.registerProducer(http_input_source)
     gardener.subscribe(http_data_receiver)
     
+    def hup(signum, frame):
+        reactor.callFromThread(reloadGarden, options, module, gardener)
+    signal.signal(signal.SIGHUP, hup)
+    
+    if options['collect-interval']:
+        from garden.retention import LineageCollector
+        collector = LineageCollector(gardener, store,
+                                     delay=options['collect-delay'])
+        def collect():
+            d = collector.run()
+            d.addCallback(lambda n: log.msg('Deleted %d stale data points' % (
+                          n,)))
+            return d.addErrback(log.err, "Error deleting stale data")
+        services = service.MultiService()
+        http_service.setServiceParent(services)
+        internet.TimerService(options['collect-interval'],
+                              collect).setServiceParent(services)
+        return services
+    
     return http_service
 
 
@@ -1,3 +1,475 @@
+from twisted.trial.unittest import TestCase
+from twisted.python import usage
+from twisted.python.filepath import FilePath
+from twisted.internet import defer
+from twisted.application import internet, service
 
+import signal
+import sys
 
+from garden.twistd import combo
+from garden.twistd.combo import (Options, reloadGarden, shardNames, makeStore,
+                                 makeGardener)
+from garden.gardener import Gardener, currentLineagesOnly
+from garden.path import Garden
+from garden.data import Input
+from garden.interface import ISource
+from garden.store import (InMemoryStore, SqliteStore, LogStore, CachingStore,
+                          ShardedStore)
+from garden.scheduling import WorkCoalescer, WorkQueue, depthPriority
+from garden.util import LFUCache
+from garden.worker import BlockingWorker, ThreadedWorker
 
+
+
+def getGarden():
+    """
+    The garden for L{makeService} when this module is given as the
+    C{--module}.
+    """
+    garden = Garden()
+    garden.addPath('cake', '1', [('eggs', '1')])
+    return garden
+
+
+
+def writeGarden(path, garden):
+    fh = open(path, 'wb')
+    try:
+        garden.dump(fh)
+    finally:
+        fh.close()
+
+
+
+class HeldWorker(BlockingWorker):
+    """
+    I hold on to work until told to do it.
+    """
+
+
+    def __init__(self):
+        BlockingWorker.__init__(self)
+        self.held = []
+
+
+    def workReceived(self, work):
+        self.held.append(work)
+        return defer.Deferred()
+
+
+    def doHeld(self):
+        return BlockingWorker.workReceived(self, self.held.pop(0))
+
+
+
+worker_class = BlockingWorker
+workers = []
+
+
+def getWorker():
+    """
+    The worker for L{makeService} when this module is given as the
+    C{--module}: a C{worker_class} that bakes.
+    """
+    worker = worker_class()
+    worker.registerFunction('cake', '1', lambda eggs: eggs + ' cake')
+    worker.registerFunction('pie', '1', lambda apples: apples + ' pie')
+    workers.append(worker)
+    return worker
+
+
+
+class FakeReactor(object):
+
+
+    def __init__(self):
+        self.triggers = []
+        self.calls = []
+
+
+    def addSystemEventTrigger(self, phase, event, func, *args):
+        self.triggers.append((phase, func, args))
+
+
+    def callFromThread(self, func, *args):
+        self.calls.append((func, args))
+
+
+    def shutdown(self):
+        for phase in ['before', 'during', 'after']:
+            for x in self.triggers:
+                if x[0] == phase:
+                    x[1](*x[2])
+
+
+
+def parse(*args):
+    options = Options()
+    options.parseOptions(['--module', __name__] + list(args))
+    return options
+
+
+
+class OptionsTest(TestCase):
+
+
+    def test_module(self):
+        """
+        A module is required.
+        """
+        options = Options()
+        self.assertRaises(usage.UsageError, options.parseOptions, [])
+        options.parseOptions(['--module', 'foo'])
+        self.assertEqual(options['module'], 'foo')
+
+
+    def test_cachePolicy(self):
+        """
+        Only known cache policies are allowed.
+        """
+        self.assertEqual(parse('--cache-policy', 'lfu')['cache-policy'], 'lfu')
+        self.assertRaises(usage.UsageError, parse, '--cache-policy', 'foo')
+
+
+    def test_queuePriority(self):
+        """
+        Only known queue priorities are allowed.
+        """
+        self.assertEqual(parse('--queue-priority', 'depth')['queue-priority'],
+                         'depth')
+        self.assertRaises(usage.UsageError, parse, '--queue-priority', 'foo')
+
+
+
+class makeStoreTest(TestCase):
+
+
+    def test_sqlite(self):
+        """
+        By default, data is stored in an SQLite database in memory.
+        """
+        store = makeStore(parse())
+        self.assertTrue(isinstance(store, SqliteStore))
+        self.assertEqual(store.connstr, ':memory:')
+        self.assertEqual(store.group_interval, None)
+
+
+    def test_sqliteGroupCommit(self):
+        """
+        Group commit intervals are given in milliseconds.
+        """
+        db = self.mktemp()
+        store = makeStore(parse('--sqlite-db', db, '--sqlite-group-commit',
+                                '5'))
+        self.assertEqual(store.connstr, db)
+        self.assertEqual(store.group_interval, 0.005)
+
+
+    def test_sqliteReaders(self):
+        """
+        Readers get a pool of connections of their own.
+        """
+        store = makeStore(parse())
+        self.assertIdentical(store.read_pool, store.pool)
+        
+        store = makeStore(parse('--sqlite-db', self.mktemp(),
+                                '--sqlite-readers', '2'))
+        self.assertNotIdentical(store.read_pool, store.pool)
+        self.assertEqual(store.read_pool.max, 2)
+
+
+    def test_sqliteShards(self):
+        """
+        With more than one shard, each gets its own database behind a
+        L{ShardedStore}.
+        """
+        db = self.mktemp() + '.sqlite'
+        store = makeStore(parse('--sqlite-db', db, '--sqlite-shards', '3'))
+        self.assertTrue(isinstance(store, ShardedStore))
+        self.assertEqual([x.connstr for x in store.stores], shardNames(db, 3))
+
+
+    def test_logStore(self):
+        """
+        Data can be stored in log files instead, which are closed on shutdown.
+        """
+        reactor = FakeReactor()
+        self.patch(combo, 'reactor', reactor)
+        path = self.mktemp()
+        store = makeStore(parse('--log-store', path))
+        self.addCleanup(reactor.shutdown)
+        self.assertTrue(isinstance(store, LogStore))
+        self.assertEqual(store.path, path)
+        self.assertEqual(reactor.triggers, [('after', store.close, ())])
+
+
+    def test_cache(self):
+        """
+        If there's a limit on cache entries or bytes, a L{CachingStore} is put
+        in front of the store.
+        """
+        store = makeStore(parse('--cache-bytes', '2000', '--cache-policy',
+                                'lfu'))
+        self.assertTrue(isinstance(store, CachingStore))
+        self.assertTrue(isinstance(store.store, SqliteStore))
+        self.assertTrue(isinstance(store.cache, LFUCache))
+        self.assertEqual(store.cache.max_weight, 2000)
+        
+        store = makeStore(parse('--cache-entries', '100'))
+        self.assertTrue(isinstance(store, CachingStore))
+        self.assertEqual(store.cache.max_size, 100)
+        
+        store = makeStore(parse())
+        self.assertFalse(isinstance(store, CachingStore))
+
+
+
+class makeGardenerTest(TestCase):
+
+
+    def make(self, *args, **kwargs):
+        worker = kwargs.get('worker', BlockingWorker())
+        return makeGardener(parse(*args), Garden(), InMemoryStore(), worker)
+
+
+    def test_hashCacheSize(self):
+        """
+        The hashes of recently used values can be cached.
+        """
+        self.assertEqual(self.make().hashes, None)
+        g = self.make('--hash-cache-size', '1000')
+        self.assertEqual(g.hashes.max_size, 1000)
+
+
+    def test_workInFlight(self):
+        """
+        The work in flight can be limited, and work only done with current
+        lineages.
+        """
+        g = self.make()
+        self.assertEqual(g.work_maker._in_flight, None)
+        self.assertEqual(g.work_maker.policy, None)
+        
+        g = self.make('--max-work-in-flight', '50', '--current-lineages-only')
+        self.assertEqual(g.work_maker._in_flight.limit, 50)
+        self.assertEqual(g.work_maker.policy, currentLineagesOnly)
+
+
+    def test_coalesceDelay(self):
+        """
+        Work can be coalesced, with the delay given in milliseconds.
+        """
+        self.assertEqual(self.make().coalescer, None)
+        g = self.make('--coalesce-delay', '250')
+        self.assertTrue(isinstance(g.coalescer, WorkCoalescer))
+        self.assertEqual(g.coalescer.delay, 0.25)
+
+
+    def test_queue(self):
+        """
+        Work is queued if there's a queue concurrency, and the priority comes
+        from the options.
+        """
+        self.assertEqual(self.make().work_queue, None)
+        g = self.make('--queue-concurrency', '4', '--queue-priority', 'depth')
+        self.assertTrue(isinstance(g.work_queue, WorkQueue))
+        self.assertEqual(g.work_queue.concurrency, 4)
+        self.assertEqual(g.work_queue.priority, depthPriority)
+        self.assertIdentical(g.work_queue.garden, g.garden)
+
+
+    def test_maxQueued(self):
+        """
+        Work is also queued if there's a most to queue.  Without a queue
+        concurrency, as much work is sent out at once as the worker can take,
+        or else 10.
+        """
+        g = self.make('--max-queued', '100', worker=ThreadedWorker(3))
+        self.assertEqual(g.work_queue.max_queued, 100)
+        self.assertEqual(g.work_queue.concurrency, 3)
+        self.assertEqual(g.work_queue.priority, None)
+        
+        g = self.make('--max-queued', '100')
+        self.assertEqual(g.work_queue.concurrency, 10)
+
+
+
+class makeServiceTest(TestCase):
+
+
+    def setUp(self):
+        self.patch(combo, 'reactor', FakeReactor())
+        self.addCleanup(combo.reactor.shutdown)
+        self.addCleanup(signal.signal, signal.SIGHUP,
+                        signal.getsignal(signal.SIGHUP))
+        del workers[:]
+
+
+    def make(self, *args):
+        options = parse('--log-store', self.mktemp(), '--http-input-endpoint',
+                        'tcp:0', *args)
+        return combo.makeService(options)
+
+
+    def children(self, svc):
+        """
+        Get the resources served over HTTP by C{svc}.
+        """
+        if isinstance(svc, service.MultiService):
+            svc = [x for x in svc
+                   if isinstance(x, internet.StreamServerEndpointService)][0]
+        return svc.factory.resource.children
+
+
+    def test_input(self):
+        """
+        Input over HTTP is stored and made into work for the worker, whose
+        results are stored and can be queried over HTTP.
+        """
+        svc = self.make()
+        self.assertTrue(isinstance(svc, internet.StreamServerEndpointService))
+        children = self.children(svc)
+        store = children['data'].store
+        self.assertTrue(isinstance(store, LogStore))
+        
+        self.successResultOf(ISource(children['']).emit(
+            Input('joe', 'eggs', '1', 'brown')))
+        data = self.successResultOf(store.get('joe', 'cake', '1'))
+        self.assertEqual([x.value for x in data], ['brown cake'])
+        self.assertEqual(len(combo.reactor.triggers), 2)
+
+
+    def test_gardenFile(self):
+        """
+        The garden can come from a garden file instead of the module.
+        """
+        garden = Garden()
+        garden.addPath('pie', '1', [('apples', '1')])
+        path = self.mktemp()
+        writeGarden(path, garden)
+        children = self.children(self.make('--garden-file', path))
+        store = children['data'].store
+        
+        ISource(children['']).emit(Input('joe', 'apples', '1', 'green'))
+        ISource(children['']).emit(Input('joe', 'eggs', '1', 'brown'))
+        data = self.successResultOf(store.get('joe', 'pie', '1'))
+        self.assertEqual([x.value for x in data], ['green pie'])
+        self.assertEqual(self.successResultOf(store.get('joe', 'cake', '1')),
+                         [])
+
+
+    def test_sighup(self):
+        """
+        On SIGHUP, the garden is reloaded from the reactor thread.
+        """
+        garden = Garden()
+        garden.addPath('pie', '1', [('apples', '1')])
+        path = self.mktemp()
+        writeGarden(path, garden)
+        children = self.children(self.make('--garden-file', path))
+        store = children['data'].store
+        
+        garden.addPath('cake', '1', [('eggs', '1')])
+        writeGarden(path, garden)
+        handler = signal.getsignal(signal.SIGHUP)
+        handler(signal.SIGHUP, None)
+        self.assertEqual(len(combo.reactor.calls), 1)
+        func, args = combo.reactor.calls[0]
+        func(*args)
+        
+        ISource(children['']).emit(Input('joe', 'eggs', '1', 'brown'))
+        data = self.successResultOf(store.get('joe', 'cake', '1'))
+        self.assertEqual([x.value for x in data], ['brown cake'])
+
+
+    def test_maxQueued(self):
+        """
+        HTTP input is paused while the work queue is full, and resumed once
+        results come back.
+        """
+        self.patch(sys.modules[__name__], 'worker_class', HeldWorker)
+        svc = self.make('--queue-concurrency', '1', '--max-queued', '1')
+        http_input = self.children(svc)['']
+        worker = workers[-1]
+        
+        ISource(http_input).emit(Input('joe', 'eggs', '1', 'brown'))
+        ISource(http_input).emit(Input('bob', 'eggs', '1', 'white'))
+        self.assertTrue(http_input.paused)
+        
+        worker.doHeld()
+        self.assertFalse(http_input.paused)
+        self.assertEqual(len(worker.held), 1)
+
+
+    def test_collect(self):
+        """
+        Stale data is collected on a timer alongside the HTTP service.
+        """
+        svc = self.make('--collect-interval', '3600')
+        self.assertTrue(isinstance(svc, service.MultiService))
+        timers = [x for x in svc if isinstance(x, internet.TimerService)]
+        self.assertEqual(len(timers), 1)
+        self.assertEqual(timers[0].step, 3600)
+        self.assertIn('data', self.children(svc))
+
+
+
+class shardNamesTest(TestCase):
+
+
+    def test_one(self):
+        """
+        One shard uses the database as it's named.
+        """
+        self.assertEqual(shardNames('/tmp/data.sqlite', 1),
+                         ['/tmp/data.sqlite'])
+
+
+    def test_many(self):
+        """
+        Each shard's database has its number before the extension.
+        """
+        self.assertEqual(shardNames('/tmp/data.sqlite', 3), [
+            '/tmp/data.0.sqlite',
+            '/tmp/data.1.sqlite',
+            '/tmp/data.2.sqlite',
+        ])
+        self.assertEqual(shardNames('data', 2), ['data.0', 'data.1'])
+        self.assertEqual(shardNames(':memory:', 2), [':memory:', ':memory:'])
+
+
+
+class reloadGardenTest(TestCase):
+
+
+    def test_gardenFile(self):
+        """
+        The garden is reloaded from the garden file and put in the Gardener.
+        """
+        garden = Garden()
+        garden.addPath('cake', '1', [('eggs', '1')])
+        garden_file = FilePath(self.mktemp())
+        fh = garden_file.open('wb')
+        garden.dump(fh)
+        fh.close()
+        
+        options = Options()
+        options.parseOptions(['--module', 'foo', '--garden-file',
+                              garden_file.path])
+        gardener = Gardener(Garden().freeze(), InMemoryStore())
+        reloadGarden(options, None, gardener)
+        self.assertTrue(gardener.garden.hasPath('cake', '1', [('eggs', '1')]))
+
+
+    def test_error(self):
+        """
+        If the new garden can't be made, the old one is kept.
+        """
+        options = Options()
+        options.parseOptions(['--module', 'foo', '--garden-file', 'nope'])
+        old = Garden().freeze()
+        gardener = Gardener(old, InMemoryStore())
+        reloadGarden(options, None, gardener)
+        self.assertEqual(gardener.garden, old)
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
@@ -1,3 +1,7 @@
+import heapq
+
+
+
 class RoundRobinChooser(object):
     """
     I choose among a group of options by cycling through them.
@@ -43,4 +47,207 @@ class RoundRobinChooser(object):
         """
         if not self.options:
             raise IndexError("No options to choose from")
-        return self._gen.next()
\ No newline at end of file
+        return self._gen.next()
+
+
+class LRUCache(object):
+    """
+    I'm a mapping that holds at most C{max_size} items, forgetting the least
+    recently used one when another is added.
+    
+    If C{max_weight} is given, I also forget items while the total of
+    C{weigh(value)} for all my values is more than that.
+    """
+    
+    weight = 0
+    
+    
+    def __init__(self, max_size=None, max_weight=None, weigh=None):
+        self.max_size = max_size
+        self.max_weight = max_weight
+        self.weigh = weigh
+        # key -> [previous link, next link, key, value, weight]
+        self._links = {}
+        # the links make a circle starting and ending here, with the most
+        # recently used at the end.
+        self._root = root = []
+        root[:] = [root, root, None, None, 0]
+
+
+    def __len__(self):
+        return len(self._links)
+
+
+    def __contains__(self, key):
+        return key in self._links
+
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+
+
+    def get(self, key, default=None):
+        """
+        Get the value for C{key} (or C{default} if I don't have it), marking
+        it as recently used.
+        """
+        link = self._links.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._append(link)
+        return link[3]
+
+
+    def __getitem__(self, key):
+        if key not in self._links:
+            raise KeyError(key)
+        return self.get(key)
+
+
+    def __setitem__(self, key, value):
+        weight = 0
+        if self.weigh is not None:
+            weight = self.weigh(value)
+        link = self._links.get(key)
+        if link is not None:
+            self._unlink(link)
+            self.weight -= link[4]
+            link[3] = value
+            link[4] = weight
+        else:
+            link = self._links[key] = [None, None, key, value, weight]
+        self.weight += weight
+        self._append(link)
+        while _overfull(self):
+            oldest = self._root[1]
+            self._unlink(oldest)
+            del self._links[oldest[2]]
+            self.weight -= oldest[4]
+
+
+    def pop(self, key, default=None):
+        """
+        Forget C{key}.
+        
+        @return: Its value, or C{default} if I didn't have it.
+        """
+        link = self._links.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        self.weight -= link[4]
+        return link[3]
+
+
+
+class LFUCache(object):
+    """
+    I'm like L{LRUCache}, but I forget the least frequently used item first
+    (and of those, the least recently used).
+    """
+    
+    weight = 0
+    
+    
+    def __init__(self, max_size=None, max_weight=None, weigh=None):
+        self.max_size = max_size
+        self.max_weight = max_weight
+        self.weigh = weigh
+        # key -> [value, weight, use count, time of last use]
+        self._items = {}
+        # (use count, time of last use, key) for eviction.  There may be
+        # stale entries in here, which are skipped.
+        self._heap = []
+        self._clock = 0
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+    def __contains__(self, key):
+        return key in self._items
+
+
+    def _used(self, key, item):
+        self._clock += 1
+        item[2] += 1
+        item[3] = self._clock
+        heapq.heappush(self._heap, (item[2], item[3], key))
+        if len(self._heap) > 4 * len(self._items) + 16:
+            self._heap = [(x[2], x[3], k) for k, x in self._items.iteritems()]
+            heapq.heapify(self._heap)
+
+
+    def get(self, key, default=None):
+        """
+        Get the value for C{key} (or C{default} if I don't have it), counting
+        it as a use.
+        """
+        item = self._items.get(key)
+        if item is None:
+            return default
+        self._used(key, item)
+        return item[0]
+
+
+    def __getitem__(self, key):
+        if key not in self._items:
+            raise KeyError(key)
+        return self.get(key)
+
+
+    def __setitem__(self, key, value):
+        weight = 0
+        if self.weigh is not None:
+            weight = self.weigh(value)
+        item = self._items.get(key)
+        if item is not None:
+            self.weight -= item[1]
+            item[0] = value
+            item[1] = weight
+        else:
+            item = self._items[key] = [value, weight, 0, 0]
+        self.weight += weight
+        self._used(key, item)
+        while _overfull(self):
+            count, last_used, oldest = heapq.heappop(self._heap)
+            item = self._items.get(oldest)
+            if item is None or item[2] != count or item[3] != last_used:
+                continue
+            del self._items[oldest]
+            self.weight -= item[1]
+
+
+    def pop(self, key, default=None):
+        """
+        Forget C{key}.
+        
+        @return: Its value, or C{default} if I didn't have it.
+        """
+        item = self._items.pop(key, None)
+        if item is None:
+            return default
+        self.weight -= item[1]
+        return item[0]
+
+
+
+def _overfull(cache):
+    """
+    Whether C{cache} holds more than its limits allow.
+    """
+    if cache.max_size is not None and len(cache) > cache.max_size:
+        return True
+    return cache.max_weight is not None and cache.weight > cache.max_weight
@@ -1,5 +1,5 @@
 from zope.interface import implements
-from twisted.internet import threads
+from twisted.internet import threads, defer
 
 from garden.interface import ISource, IWorker, IWork, IResult, IResultError
 
@@ -71,14 +71,22 @@ class BlockingWorker(object):
 class ThreadedWorker(object):
     """
     I do work in threads, rather than blocking the main thread.
+    
+    If C{capacity} is given, no more than that many pieces of work are done in
+    threads at once; the rest wait their turn.  It's also there for whoever
+    sends me work to see how much I can take (see L{WorkQueue}).
     """
     
     implements(IWorker)
     sourceInterfaces = IResult, IResultError
 
 
-    def __init__(self):
+    def __init__(self, capacity=None):
         self._functions = {}
+        self.capacity = capacity
+        self._slots = None
+        if capacity:
+            self._slots = defer.DeferredSemaphore(capacity)
 
 
     def receiverMapping(self):
@@ -117,7 +125,10 @@ class ThreadedWorker(object):
         func = self._functions[(work.name, work.version)]
         args = _getInputValues(work.inputs)
         
-        result = threads.deferToThread(func, *args)
+        if self._slots is not None:
+            result = self._slots.run(threads.deferToThread, func, *args)
+        else:
+            result = threads.deferToThread(func, *args)
         
         def gotResult(result, work):
             return work.toResult(result)